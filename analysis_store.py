@@ -0,0 +1,204 @@
+"""Append-only storage for per-file analysis results.
+
+Results are appended to a JSONL log as they complete instead of rewriting the
+whole codebase_analysis.json after every file. The log is the source of truth
+during a run; `compact_results` turns it into the final JSON array.
+"""
+import json
+import logging
+import os
+import time
+
+FSYNC_BATCH_SIZE = 20  # Records written between fsync calls
+FSYNC_INTERVAL = 5.0  # Max seconds between fsync calls
+
+class ResultStore:
+    """Append-only JSONL writer with batched fsync."""
+    def __init__(self, path: str, fsync_batch_size: int = FSYNC_BATCH_SIZE,
+                 fsync_interval: float = FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_batch_size = fsync_batch_size
+        self.fsync_interval = fsync_interval
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def append(self, record: dict):
+        """Append one result; fsync once enough records or time have accumulated."""
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.pending += 1
+        if (self.pending >= self.fsync_batch_size
+                or time.monotonic() - self.last_sync >= self.fsync_interval):
+            self.sync()
+
+    def delete(self, filepath: str):
+        """Record that `filepath` no longer exists so readers drop its results."""
+        self.append({'filepath': filepath, 'deleted': True})
+
+    def sync(self):
+        """Flush buffered records to disk."""
+        if self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _index_log(log_path: str) -> dict:
+    """Map each filepath to the byte offset of its latest record in the log."""
+    offsets = {}
+    with open(log_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                    if record.get('deleted'):
+                        offsets.pop(record['filepath'], None)
+                    else:
+                        offsets[record['filepath']] = offset
+                except (ValueError, KeyError, TypeError):
+                    # A torn final line from an interrupted run is skipped
+                    logging.warning(f"Skipping malformed record at byte {offset} of {log_path}")
+            offset += len(line)
+    return offsets
+
+def iter_results(log_path: str, sort: bool = False):
+    """Yield the latest result for each file in the log without loading it all.
+
+    Later records for a filepath replace earlier ones and deletion records drop
+    it. Only the offset index is kept in memory; records are read back one at a
+    time.
+    """
+    if not os.path.exists(log_path):
+        return
+    offsets = _index_log(log_path)
+    positions = [offsets[key] for key in sorted(offsets)] if sort else sorted(offsets.values())
+    with open(log_path, 'rb') as f:
+        for position in positions:
+            f.seek(position)
+            yield json.loads(f.readline())
+
+def append_log(source_log: str, store: ResultStore) -> int:
+    """Append every record of another results log to `store`, deletions included.
+
+    Replaying in order keeps the latest-record-wins semantics of the source, so
+    logs written elsewhere (e.g. by parallel shards) can be merged one by one.
+    """
+    count = 0
+    with open(source_log, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict) or 'filepath' not in record:
+                logging.warning(f"Skipping malformed record in {source_log}")
+                continue
+            store.append(record)
+            count += 1
+    return count
+
+def iter_json_array(path: str, chunk_size: int = 65536):
+    """Yield the elements of a top-level JSON array while reading it in chunks."""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ""
+        eof = False
+        started = False
+
+        def fill():
+            nonlocal buffer, eof
+            chunk = f.read(chunk_size)
+            if chunk:
+                buffer += chunk
+            else:
+                eof = True
+
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                if eof:
+                    if started:
+                        raise ValueError(f"Unterminated JSON array in {path}")
+                    return
+                fill()
+                continue
+            if not started:
+                if buffer[0] != '[':
+                    raise ValueError(f"Expected a JSON array in {path}")
+                buffer = buffer[1:]
+                started = True
+                continue
+            if buffer[0] == ',':
+                buffer = buffer[1:]
+                continue
+            if buffer[0] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            yield item
+            buffer = buffer[end:]
+
+def iter_analyses(log_path: str, json_path: str):
+    """Yield analyses from the JSONL log if present, else from the JSON array."""
+    if os.path.exists(log_path):
+        yield from iter_results(log_path, sort=True)
+    elif os.path.exists(json_path):
+        yield from iter_json_array(json_path)
+
+def migrate_json_to_log(json_path: str, log_path: str) -> int:
+    """Seed the results log from an existing codebase_analysis.json once."""
+    if os.path.exists(log_path) or not os.path.exists(json_path):
+        return 0
+    count = 0
+    try:
+        with ResultStore(log_path) as store:
+            for record in iter_json_array(json_path):
+                if isinstance(record, dict) and 'filepath' in record:
+                    store.append(record)
+                    count += 1
+    except ValueError as e:
+        logging.warning(f"Could not migrate existing analyses from {json_path}: {e}")
+    return count
+
+def compact_results(log_path: str, output_file: str) -> int:
+    """Write the final JSON array from the log and drop superseded log records."""
+    if not os.path.exists(log_path):
+        return 0
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    count = 0
+    tmp_output = f"{output_file}.tmp"
+    tmp_log = f"{log_path}.tmp"
+    with open(tmp_output, 'w', encoding='utf-8') as out, open(tmp_log, 'w', encoding='utf-8') as log:
+        out.write("[")
+        for record in iter_results(log_path, sort=True):
+            out.write(",\n" if count else "\n")
+            out.write(json.dumps(record, indent=2, ensure_ascii=False))
+            log.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+        out.write("\n]\n" if count else "]\n")
+        log.flush()
+        os.fsync(log.fileno())
+    os.replace(tmp_output, output_file)
+    os.replace(tmp_log, log_path)
+    return count
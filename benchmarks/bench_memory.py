@@ -0,0 +1,88 @@
+"""Peak memory of a full analysis run as the repository grows.
+
+Generates synthetic repositories of increasing size and runs `main()` on each
+in a fresh child process against the fake Messages API, reporting the peak RSS,
+how far it rose above the interpreter with the analyzer imported, and the
+growth per file between consecutive sizes (so fixed costs such as loading the
+API client cancel out):
+
+    python benchmarks/bench_memory.py --files 1000 4000 16000
+
+Results are streamed to the append-only log instead of being held, so the
+growth per file should stay small and roughly constant; a run whose growth
+tracks the size of the analyses means something is retaining them again.
+With --tracemalloc the Python heap peak is reported as well (slower).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_run import _import_analyzer, peak_rss_mb, run_child  # noqa: E402
+from fake_anthropic_server import FakeAnthropicServer  # noqa: E402
+from synthetic_repo import generate_repo  # noqa: E402
+
+def run_memory(workdir: str, repo_root: str, concurrency: int, trace: bool = False) -> dict:
+    """Run main() once from scratch and report its peak memory."""
+    ca = _import_analyzer(workdir, repo_root)
+    baseline = peak_rss_mb()
+    if trace:
+        import tracemalloc
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(ca.main(concurrency=concurrency, use_cache=False, use_git=False))
+    wall = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024) if trace else None
+    with open(ca.PROGRESS_FILE) as f:
+        processed = len(json.load(f)['processed_files'])
+    return {'wall': wall, 'processed': processed, 'baseline_mb': baseline, 'peak_rss_mb': peak_rss_mb(),
+            'traced_peak_mb': traced_peak}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark peak memory of codebase_analysis by repository size.")
+    parser.add_argument("--files", type=int, nargs='+', default=[500, 2000, 8000],
+                        help="Repository sizes (code files) to run")
+    parser.add_argument("--lines", type=int, default=40, help="Body lines per synthetic file")
+    parser.add_argument("--concurrency", type=int, default=16, help="Initial concurrency")
+    parser.add_argument("--latency", type=float, default=0.01, help="Fake API mean latency in seconds")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report the traced Python heap peak")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"{'files':>7} {'processed':>9} {'wall s':>8} {'base MB':>8} {'peak MB':>8} {'growth MB':>10} "
+          f"{'KB/file':>8}" + (f" {'heap MB':>8}" if args.tracemalloc else ""))
+    previous = None
+    for files in sorted(args.files):
+        workdir = tempfile.mkdtemp(prefix="bench_memory_")
+        repo_root = os.path.join(workdir, 'repo')
+        server = None
+        try:
+            generate_repo(repo_root, files, args.lines, seed=args.seed)
+            server = FakeAnthropicServer(latency=args.latency, seed=args.seed).start()
+            os.environ.update(ANTHROPIC_BASE_URL=server.base_url, ANTHROPIC_API_KEY='fake')
+            report = run_child('run_memory', module='bench_memory', workdir=workdir, repo_root=repo_root,
+                               concurrency=args.concurrency, trace=args.tracemalloc)
+        finally:
+            if server:
+                server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+        growth = report['peak_rss_mb'] - report['baseline_mb']
+        per_file = (f"{(growth - previous[1]) * 1024 / max(1, files - previous[0]):>8.2f}" if previous
+                    else f"{'-':>8}")
+        previous = (files, growth)
+        line = (f"{files:>7} {report['processed']:>9} {report['wall']:>8.2f} {report['baseline_mb']:>8.1f} "
+                f"{report['peak_rss_mb']:>8.1f} {growth:>10.1f} {per_file}")
+        if args.tracemalloc:
+            line += f" {report['traced_peak_mb']:>8.1f}"
+        print(line)
@@ -0,0 +1,181 @@
+"""End-to-end benchmark of the analyzer against the fake Messages API.
+
+Generates a synthetic repository, starts the fake server in-process and runs
+`main()` in a fresh child process per configuration, so wall time, peak memory
+and bytes written cover the analyzer alone and no API credits are spent:
+
+    python benchmarks/bench_run.py --files 2000 --latency 0.05 --concurrency 4 8 16
+
+The local phases (discovery, import analysis, result persistence and todo
+generation) are timed on the same tree first, so regressions in any of them
+show up without network noise.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_anthropic_server import FakeAnthropicServer, fake_analysis  # noqa: E402
+from synthetic_repo import generate_repo  # noqa: E402
+
+def io_counters() -> dict:
+    """Bytes written by this process so far, from /proc (zeros where unavailable)."""
+    counters = {'wchar': 0, 'write_bytes': 0}
+    with contextlib.suppress(OSError):
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in counters:
+                    counters[key] = int(value)
+    return counters
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale / (1024 * 1024)
+
+def _import_analyzer(workdir: str, repo_root: str):
+    """Import codebase_analysis with its outputs under `workdir`, analyzing `repo_root`."""
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import codebase_analysis as ca
+    ca.configure_runtime()
+    ca.CODEBASE_ROOT = repo_root
+    ca.PLAN_FILE = os.path.join(repo_root, '.cursorrules')
+    ca.API_KEY = 'fake'
+    return ca
+
+def run_phases(workdir: str, repo_root: str) -> dict:
+    """Time the local, API-free stages of a run."""
+    ca = _import_analyzer(workdir, repo_root)
+    from analysis_store import ResultStore, compact_results, iter_results
+    from generate_todo import build_todo_index, write_todo
+
+    timings = {}
+    start = time.perf_counter()
+    files = list(ca.discover_files(repo_root, use_git=False))
+    timings['discovery'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resolver = ca.ModuleResolver(repo_root)
+    for filepath in files:
+        ca.analyze_imports(filepath, resolver=resolver)
+    timings['import_analysis'] = time.perf_counter() - start
+
+    log_path = os.path.join(workdir, 'phases', 'results.jsonl')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    start = time.perf_counter()
+    with ResultStore(log_path) as store:
+        for filepath in files:
+            store.append(fake_analysis(filepath))
+    compact_results(log_path, os.path.join(workdir, 'phases', 'results.json'))
+    timings['persistence'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_todo(os.path.join(workdir, 'phases', 'todo.md'), build_todo_index(iter_results(log_path), repo_root))
+    timings['todo'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ca.generate_dependency_summary(iter_results(log_path), repo_root)
+    ca.generate_directory_tree(repo_root)
+    timings['summaries'] = time.perf_counter() - start
+    return {'files': len(files), 'seconds': timings}
+
+def run_analysis(workdir: str, repo_root: str, concurrency: int, stream: bool, prep_workers: int = None) -> dict:
+    """Run main() once from scratch and report its wall time, memory and writes."""
+    import asyncio
+    ca = _import_analyzer(workdir, repo_root)
+    io_before = io_counters()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(ca.main(concurrency=concurrency, use_cache=False, use_git=False, stream=stream,
+                            prep_workers=ca.PREP_WORKERS if prep_workers is None else prep_workers))
+    wall = time.perf_counter() - start
+    io_after = io_counters()
+    with open(ca.PROGRESS_FILE) as f:
+        progress = json.load(f)
+    return {
+        'wall': wall,
+        'processed': len(progress['processed_files']),
+        'failed': len(progress['failed_files']),
+        'peak_rss_mb': peak_rss_mb(),
+        'prep_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'wchar': io_after['wchar'] - io_before['wchar'],
+        'write_bytes': io_after['write_bytes'] - io_before['write_bytes'],
+    }
+
+def run_child(mode: str, module: str = 'bench_run', **kwargs) -> dict:
+    """Run one measurement (`mode` of a benchmark `module`) in a fresh interpreter and return its JSON report."""
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as report:
+        code = ("import json, sys; sys.path.insert(0, %r); import %s as bench; "
+                "json.dump(getattr(bench, %r)(**json.loads(sys.argv[1])), open(sys.argv[2], 'w'))"
+                % (BENCH_DIR, module, mode))
+        subprocess.run([sys.executable, '-c', code, json.dumps(kwargs), report.name], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ.copy())
+        return json.load(report)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark codebase_analysis end to end against a fake API.")
+    parser.add_argument("--files", type=int, default=500, help="Code files in the synthetic repository")
+    parser.add_argument("--lines", type=int, default=40, help="Body lines per synthetic file")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[8], help="Initial concurrency values to run")
+    parser.add_argument("--prep-workers", type=int, default=None, help="Prep processes (default: the analyzer's)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake API mean latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 529")
+    parser.add_argument("--rpm", type=int, default=None, help="Fake API requests per minute before 429s")
+    parser.add_argument("--no-stream", action="store_true", help="Benchmark non-streaming requests")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", metavar="DIR", help="Generate into DIR and keep it instead of a temp dir")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = os.path.abspath(args.keep) if args.keep else tempfile.mkdtemp(prefix="bench_run_")
+    repo_root = os.path.join(workdir, 'repo')
+    try:
+        start = time.perf_counter()
+        generate_repo(repo_root, args.files, args.lines, seed=args.seed)
+        print(f"Synthetic repository: {args.files} files in {repo_root} "
+              f"({time.perf_counter() - start:.2f}s to generate)")
+
+        phases = run_child('run_phases', workdir=workdir, repo_root=repo_root)
+        print(f"\nLocal phases over {phases['files']} files:")
+        for phase, seconds in phases['seconds'].items():
+            print(f"  {phase:<16} {seconds * 1000:9.1f} ms  ({seconds / max(1, phases['files']) * 1e6:.1f} us/file)")
+
+        print(f"\n{'concurrency':>11} {'wall s':>8} {'req/s':>7} {'files/s':>8} {'429/529':>7} "
+              f"{'peak MB':>8} {'prep MB':>8} {'written MB':>11} {'disk MB':>8}")
+        for concurrency in args.concurrency:
+            shutil.rmtree(os.path.join(workdir, 'analysis_output'), ignore_errors=True)
+            server = FakeAnthropicServer(latency=args.latency, error_rate=args.error_rate, rpm=args.rpm,
+                                         seed=args.seed).start()
+            os.environ.update(ANTHROPIC_BASE_URL=server.base_url, ANTHROPIC_API_KEY='fake')
+            try:
+                kwargs = {'workdir': workdir, 'repo_root': repo_root, 'concurrency': concurrency,
+                          'stream': not args.no_stream}
+                if args.prep_workers is not None:
+                    kwargs['prep_workers'] = args.prep_workers
+                report = run_child('run_analysis', **kwargs)
+            finally:
+                server.stop()
+            stats = server.stats
+            throttled = stats['rate_limited'] + stats['overloaded']
+            print(f"{concurrency:>11} {report['wall']:>8.2f} {stats['requests'] / report['wall']:>7.1f} "
+                  f"{report['processed'] / report['wall']:>8.1f} {throttled:>7} {report['peak_rss_mb']:>8.1f} "
+                  f"{report['prep_peak_rss_mb']:>8.1f} {report['wchar'] / 1e6:>11.2f} "
+                  f"{report['write_bytes'] / 1e6:>8.2f}")
+            if report['failed']:
+                print(f"{'':>11} {report['failed']} files failed")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,63 @@
+"""Startup time of codebase_analysis imports and its offline commands.
+
+Runs each command in a fresh interpreter from a scratch working directory
+(so analysis_output/ of the repository is left alone) and reports the median
+and best wall time, next to bare interpreter startup:
+
+    python benchmarks/bench_startup.py --repeat 10
+
+It also lists which heavy dependencies a plain `import codebase_analysis`
+pulls in; the API client and progress bar should only load for `analyze`.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO_DIR, "codebase_analysis.py")
+HEAVY_MODULES = ('anthropic', 'httpx', 'tqdm', 'colorama', 'aiohttp', 'dotenv')
+
+COMMANDS = (
+    ('python -c pass', ['-c', 'pass']),
+    ('import codebase_analysis', ['-c', f'import sys; sys.path.insert(0, {REPO_DIR!r}); import codebase_analysis']),
+    ('--help', [SCRIPT, '--help']),
+    ('tree', [SCRIPT, 'tree']),
+    ('todo', [SCRIPT, 'todo']),
+    ('deps', [SCRIPT, 'deps', '--no-git']),
+)
+
+def time_command(args, cwd: str, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def heavy_modules_on_import(cwd: str) -> list:
+    code = (f"import sys; sys.path.insert(0, {REPO_DIR!r}); import codebase_analysis; "
+            f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True, capture_output=True, text=True)
+    return output.stdout.split()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark codebase_analysis startup time.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="bench_startup_") as cwd:
+        # Warm the bytecode cache so the first measured run is not an outlier
+        time_command(COMMANDS[1][1], cwd, 1)
+        print(f"{'command':<26} {'median ms':>10} {'best ms':>9}")
+        for label, command in COMMANDS:
+            timings = time_command(command, cwd, max(1, args.repeat))
+            print(f"{label:<26} {statistics.median(timings) * 1000:>10.1f} {min(timings) * 1000:>9.1f}")
+        loaded = heavy_modules_on_import(cwd)
+        print(f"\nHeavy modules loaded by import: {', '.join(loaded) if loaded else 'none'}")
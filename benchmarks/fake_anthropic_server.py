@@ -0,0 +1,400 @@
+"""Local stand-in for the Anthropic Messages API.
+
+Lets codebase_analysis.py run end to end without spending API credits, with
+configurable latency, error rate and rate-limit behaviour:
+
+    python benchmarks/fake_anthropic_server.py --port 8765 --rpm 60 --error-rate 0.05
+    ANTHROPIC_API_KEY=fake ANTHROPIC_BASE_URL=http://127.0.0.1:8765 python codebase_analysis.py
+
+The Message Batches endpoints are mimicked as well; a batch ends
+`--batch-delay` seconds after it is created. Requests with "stream": true get
+server-sent events, `--chunk-delay` apart, and `--malformed-rate` makes a
+fraction of responses leave the analysis schema.
+
+It can also be started in-process with `FakeAnthropicServer(...).start()`.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def _iso(seconds_from_now: float) -> str:
+    reset = datetime.now(timezone.utc) + timedelta(seconds=seconds_from_now)
+    return reset.isoformat().replace('+00:00', 'Z')
+
+def _text_of(content) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(block.get('text', '') for block in content or [] if isinstance(block, dict))
+
+def fake_analysis(filepath: str) -> dict:
+    """A schema-valid analysis whose content is derived from the file path."""
+    name = filepath.replace('\\', '/').rsplit('/', 1)[-1]
+    return {
+        "filepath": filepath,
+        "analysis": {
+            "implemented": [
+                {"requirement": f"{name} exists", "status": "Partially Implemented", "details": "Stub response"}
+            ],
+            "missing": [
+                {"requirement": "Add error handling", "priority": "High", "details": f"{name} lacks error handling"},
+                {"requirement": "Add loading state", "priority": "Medium", "details": f"{name} has no loading state"}
+            ],
+            "suggestions": [
+                {"type": "Improvement", "description": f"Add tests for {name}"}
+            ]
+        },
+        "validation": {
+            "issues": [f"Missing type annotations in {name}"],
+            "suggestions": [{"type": "Organization", "description": "Group related helpers"}]
+        }
+    }
+
+class FakeAnthropicServer:
+    """Threaded HTTP server implementing the subset of the API the analyzer uses."""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.05,
+                 jitter: float = 0.5, error_rate: float = 0.0, rpm: int = None,
+                 input_tpm: int = None, seed: int = None, batch_delay: float = 1.0,
+                 chunk_delay: float = 0.0, malformed_rate: float = 0.0, window: float = 60.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.input_tpm = input_tpm
+        self.window = window  # Seconds the rpm/input_tpm budgets are counted over
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_times = deque()
+        self.token_times = deque()
+        self.cached_prefixes = set()
+        self.batch_delay = batch_delay
+        self.chunk_delay = chunk_delay
+        self.malformed_rate = malformed_rate
+        self.batches = {}
+        self.stats = {
+            'requests': 0, 'ok': 0, 'rate_limited': 0, 'overloaded': 0,
+            'in_flight': 0, 'peak_in_flight': 0, 'streamed': 0, 'malformed': 0, 'disconnected': 0
+        }
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeAnthropicServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _admit(self, tokens: int):
+        """Apply the rolling-window budgets; return (status, headers)."""
+        now = time.monotonic()
+        window = self.window
+        with self.lock:
+            while self.request_times and now - self.request_times[0] >= window:
+                self.request_times.popleft()
+            while self.token_times and now - self.token_times[0][0] >= window:
+                self.token_times.popleft()
+            used_tokens = sum(count for _, count in self.token_times)
+            headers = {}
+            if self.rpm:
+                reset = self.request_times[0] + window - now if self.request_times else window
+                headers.update({
+                    'anthropic-ratelimit-requests-limit': str(self.rpm),
+                    'anthropic-ratelimit-requests-remaining': str(max(0, self.rpm - len(self.request_times) - 1)),
+                    'anthropic-ratelimit-requests-reset': _iso(reset),
+                })
+                if len(self.request_times) >= self.rpm:
+                    headers['retry-after'] = str(max(1, int(reset + 0.999)))
+                    headers['anthropic-ratelimit-requests-remaining'] = '0'
+                    return 429, headers
+            if self.input_tpm:
+                reset = self.token_times[0][0] + window - now if self.token_times else window
+                headers.update({
+                    'anthropic-ratelimit-input-tokens-limit': str(self.input_tpm),
+                    'anthropic-ratelimit-input-tokens-remaining': str(max(0, self.input_tpm - used_tokens - tokens)),
+                    'anthropic-ratelimit-input-tokens-reset': _iso(reset),
+                })
+                if used_tokens + tokens > self.input_tpm and self.token_times:
+                    headers['retry-after'] = str(max(1, int(reset + 0.999)))
+                    return 429, headers
+            if self.error_rate and self.random.random() < self.error_rate:
+                return 529, headers
+            self.request_times.append(now)
+            self.token_times.append((now, tokens))
+            return 200, headers
+
+    def _sleep(self):
+        if self.latency:
+            spread = self.latency * self.jitter
+            time.sleep(max(0.0, self.latency + self.random.uniform(-spread, spread)))
+
+    def message_response(self, body: dict, malformed: bool = False) -> dict:
+        """Build a message for a /v1/messages request body.
+
+        A `malformed` message starts like an analysis but then runs on with a
+        key outside the schema, as a runaway completion would.
+        """
+        system = body.get('system') or []
+        if isinstance(system, str):
+            system = [{'type': 'text', 'text': system}]
+        prefix_text = _text_of(system)
+        cached_tokens = len(prefix_text) // 4 if any(
+            isinstance(block, dict) and block.get('cache_control') for block in system) else 0
+        prefix_key = hashlib.sha256(prefix_text.encode('utf-8')).hexdigest()
+        with self.lock:
+            cache_hit = cached_tokens and prefix_key in self.cached_prefixes
+            if cached_tokens:
+                self.cached_prefixes.add(prefix_key)
+
+        user_text = "".join(_text_of(m.get('content')) for m in body.get('messages', []) if m.get('role') == 'user')
+        filepaths = re.findall(r'^File: (.+)$', user_text, re.MULTILINE)
+        if len(filepaths) > 1:
+            payload = {"files": [fake_analysis(path.strip()) for path in filepaths]}
+        else:
+            payload = fake_analysis(filepaths[0].strip() if filepaths else "unknown")
+        text = json.dumps(payload, indent=2)
+        if malformed:
+            text = text[:text.index('"analysis"')] + '"notes": "' + "This file is interesting. " * 200 + '"\n}'
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get('model', 'fake-model'),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": len(user_text) // 4 + (0 if cached_tokens else len(prefix_text) // 4),
+                "output_tokens": len(text) // 4,
+                "cache_creation_input_tokens": 0 if cache_hit else cached_tokens,
+                "cache_read_input_tokens": cached_tokens if cache_hit else 0
+            }
+        }
+
+    def stream_events(self, message: dict, chunk_chars: int = 40):
+        """Yield `(event, data)` pairs that stream `message` the way the API does."""
+        text = message['content'][0]['text']
+        start = dict(message, content=[], stop_reason=None,
+                     usage=dict(message['usage'], output_tokens=1))
+        yield 'message_start', {'type': 'message_start', 'message': start}
+        yield 'content_block_start', {'type': 'content_block_start', 'index': 0,
+                                      'content_block': {'type': 'text', 'text': ''}}
+        for offset in range(0, len(text), chunk_chars):
+            yield 'content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                          'delta': {'type': 'text_delta', 'text': text[offset:offset + chunk_chars]}}
+        yield 'content_block_stop', {'type': 'content_block_stop', 'index': 0}
+        yield 'message_delta', {'type': 'message_delta',
+                                'delta': {'stop_reason': message['stop_reason'], 'stop_sequence': None},
+                                'usage': {'output_tokens': message['usage']['output_tokens']}}
+        yield 'message_stop', {'type': 'message_stop'}
+
+    def create_batch(self, body: dict) -> dict:
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        with self.lock:
+            self.batches[batch_id] = {
+                'created': time.time(),
+                'requests': body.get('requests', []),
+                'results': None
+            }
+        return self.batch_status(batch_id)
+
+    def batch_status(self, batch_id: str) -> dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+        created = batch['created']
+        ended = time.time() - created >= self.batch_delay
+        total = len(batch['requests'])
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else total,
+                "succeeded": total if ended else 0,
+                "errored": 0, "canceled": 0, "expired": 0
+            },
+            "created_at": datetime.fromtimestamp(created, timezone.utc).isoformat().replace('+00:00', 'Z'),
+            "expires_at": datetime.fromtimestamp(created + 86400, timezone.utc).isoformat().replace('+00:00', 'Z'),
+            "ended_at": (datetime.fromtimestamp(created + self.batch_delay, timezone.utc)
+                         .isoformat().replace('+00:00', 'Z') if ended else None),
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def batch_results(self, batch_id: str) -> bytes:
+        with self.lock:
+            batch = self.batches[batch_id]
+        if batch['results'] is None:
+            lines = [
+                json.dumps({
+                    "custom_id": request['custom_id'],
+                    "result": {"type": "succeeded", "message": self.message_response(request['params'])}
+                })
+                for request in batch['requests']
+            ]
+            batch['results'] = ("\n".join(lines) + "\n").encode('utf-8')
+        return batch['results']
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, payload: dict, headers: dict = None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('request-id', f"req_{uuid.uuid4().hex[:24]}")
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, message: dict, headers: dict = None):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'close')
+                self.send_header('request-id', f"req_{uuid.uuid4().hex[:24]}")
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    for event, data in server.stream_events(message):
+                        self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8'))
+                        self.wfile.flush()
+                        if server.chunk_delay and event == 'content_block_delta':
+                            time.sleep(server.chunk_delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client aborted the stream
+                    with server.lock:
+                        server.stats['disconnected'] += 1
+
+            def _read_body(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0].rstrip('/')
+                match = re.fullmatch(r'/v1/messages/batches/([\w-]+)(/results)?', path)
+                if path == '/stats':
+                    with server.lock:
+                        self._send_json(200, dict(server.stats))
+                elif match and match.group(1) in server.batches:
+                    if match.group(2):
+                        data = server.batch_results(match.group(1))
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/binary')
+                        self.send_header('Content-Length', str(len(data)))
+                        self.end_headers()
+                        self.wfile.write(data)
+                    else:
+                        self._send_json(200, server.batch_status(match.group(1)))
+                else:
+                    self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+            def do_POST(self):
+                path = self.path.split('?', 1)[0].rstrip('/')
+                if path == '/v1/messages/batches':
+                    self._send_json(200, server.create_batch(self._read_body()))
+                    return
+                if path != '/v1/messages':
+                    self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+                    return
+                body = self._read_body()
+                with server.lock:
+                    server.stats['requests'] += 1
+                    server.stats['in_flight'] += 1
+                    server.stats['peak_in_flight'] = max(server.stats['peak_in_flight'], server.stats['in_flight'])
+                try:
+                    tokens = len(json.dumps(body)) // 4
+                    status, headers = server._admit(tokens)
+                    if status == 429:
+                        with server.lock:
+                            server.stats['rate_limited'] += 1
+                        self._send_json(429, {"type": "error", "error": {
+                            "type": "rate_limit_error", "message": "Fake rate limit exceeded"}}, headers)
+                        return
+                    server._sleep()
+                    if status == 529:
+                        with server.lock:
+                            server.stats['overloaded'] += 1
+                        self._send_json(529, {"type": "error", "error": {
+                            "type": "overloaded_error", "message": "Fake overload"}}, headers)
+                        return
+                    with server.lock:
+                        malformed = bool(server.malformed_rate) and server.random.random() < server.malformed_rate
+                        server.stats['ok'] += 1
+                        server.stats['malformed'] += malformed
+                    message = server.message_response(body, malformed=malformed)
+                    if body.get('stream'):
+                        with server.lock:
+                            server.stats['streamed'] += 1
+                        self._send_stream(message, headers)
+                    else:
+                        self._send_json(200, message, headers)
+                finally:
+                    with server.lock:
+                        server.stats['in_flight'] -= 1
+
+        return Handler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local fake Anthropic Messages API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Latency spread as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 529")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute before 429s")
+    parser.add_argument("--input-tpm", type=int, default=None, help="Input tokens per minute before 429s")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Seconds until a message batch ends")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Seconds between streamed text chunks")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Fraction of responses that leave the analysis schema")
+    parser.add_argument("--window", type=float, default=60.0,
+                        help="Seconds the --rpm and --input-tpm budgets are counted over")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = FakeAnthropicServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, rpm=args.rpm, input_tpm=args.input_tpm, seed=args.seed,
+        batch_delay=args.batch_delay, chunk_delay=args.chunk_delay, malformed_rate=args.malformed_rate,
+        window=args.window
+    )
+    print(f"Fake Anthropic API listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
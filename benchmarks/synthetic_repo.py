@@ -0,0 +1,142 @@
+"""Generate a synthetic Next.js-style repository for benchmarks.
+
+The tree mimics this app's layout: App Router pages, layouts and API routes,
+components, lib modules, shared types and a few Python scripts. Files import
+each other through the "@/..." alias and relative paths, plus a handful of npm
+packages, so import analysis and reverse-dependency lookups have real work to
+do. Output is deterministic for a given size and seed:
+
+    python benchmarks/synthetic_repo.py /tmp/synthetic --files 2000
+"""
+import argparse
+import json
+import os
+import random
+
+NPM_PACKAGES = ('react', 'next/server', 'next/navigation', 'zod', '@supabase/supabase-js', 'clsx')
+# Share of generated files per kind; the rest are components
+KIND_WEIGHTS = (('page', 0.2), ('layout', 0.05), ('route', 0.15), ('lib', 0.15), ('type', 0.1),
+                ('script', 0.03), ('component', 0.32))
+FEATURE_WORDS = ('documents', 'cases', 'clients', 'billing', 'calendar', 'research', 'drafting', 'intake',
+                 'filings', 'discovery', 'contracts', 'settings', 'reports', 'messages', 'deadlines')
+
+PLAN_TEMPLATE = """# Synthetic project rules
+# Purpose: benchmark fixture for codebase_analysis.py
+
+PROJECT_STRUCTURE:
+  ROOT: "synthetic"
+
+FEATURES:
+{features}
+
+API_ROUTES:
+{routes}
+
+CONVENTIONS:
+  - Every API route validates its input with zod
+  - Pages show loading and error states
+  - Shared types live in src/types
+"""
+
+def _pascal(name: str) -> str:
+    return "".join(part.capitalize() for part in name.replace('-', '_').split('_'))
+
+def _body(rng: random.Random, name: str, lines: int) -> list:
+    body = []
+    for number in range(lines):
+        body.append(f"  const {name}Value{number} = {rng.randint(0, 9999)}; // step {number} of {name}")
+    return body
+
+def plan_files(files: int, seed: int = 0) -> list:
+    """(relative path, kind, name) for every generated code file."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in KIND_WEIGHTS]
+    weights = [weight for _, weight in KIND_WEIGHTS]
+    planned = []
+    for number in range(files):
+        kind = rng.choices(kinds, weights)[0]
+        feature = f"{FEATURE_WORDS[number % len(FEATURE_WORDS)]}{number // len(FEATURE_WORDS)}"
+        name = f"{feature}_{kind}"
+        path = {
+            'page': f"src/app/{feature}/page.tsx",
+            'layout': f"src/app/{feature}/layout.tsx",
+            'route': f"src/app/api/{feature}/route.ts",
+            'lib': f"src/lib/{feature}.ts",
+            'type': f"src/types/{feature}.ts",
+            'script': f"scripts/{feature}.py",
+            'component': f"src/components/{_pascal(feature)}.tsx",
+        }[kind]
+        planned.append((path, kind, name))
+    return planned
+
+def render_file(path: str, kind: str, name: str, targets: list, rng: random.Random, lines: int) -> str:
+    """Source of one generated file importing `targets` (other planned paths)."""
+    if kind == 'script':
+        imports = ["import json", "import os"]
+        imports += [f"from scripts import {os.path.splitext(os.path.basename(target))[0]}"
+                    for target in targets if target.endswith('.py')]
+        body = [f"    {line.strip().replace('const ', '').replace(';', '')}" for line in _body(rng, name, lines)]
+        return "\n".join(imports + ["", "", f"def run_{name}():"] + body + ["    return True", ""])
+
+    imports = [f"import {{ {rng.choice(('useState', 'z', 'clsx', 'redirect'))} }} from '{rng.choice(NPM_PACKAGES)}';"]
+    for target in targets:
+        if target.endswith('.py'):
+            continue
+        module = os.path.splitext(target)[0]
+        if module.startswith('src/'):
+            imports.append(f"import {{ {_pascal(os.path.basename(module))} }} from '@/{module[4:]}';")
+    component = _pascal(name)
+    if kind in ('page', 'layout', 'component'):
+        body = [f"export default function {component}() {{"] + _body(rng, name, lines)
+        body += [f"  return <div className=\"{name}\">{{{name}Value0}}</div>;", "}"]
+    elif kind == 'route':
+        body = ["export async function POST(request: Request) {"] + _body(rng, name, lines)
+        body += ["  return Response.json({ ok: true });", "}"]
+    elif kind == 'type':
+        body = [f"export interface {component} {{"]
+        body += [f"  field{number}: string;" for number in range(lines)] + ["}"]
+    else:
+        body = [f"export function {component}() {{"] + _body(rng, name, lines) + [f"  return {name}Value0;", "}"]
+    return "\n".join(imports + [""] + body + [""])
+
+def generate_repo(root: str, files: int = 500, lines: int = 40, imports: int = 3, seed: int = 0) -> list:
+    """Write a synthetic repository of `files` code files under `root`; return their paths."""
+    rng = random.Random(seed)
+    planned = plan_files(files, seed)
+    written = []
+    features, routes = [], []
+    for index, (path, kind, name) in enumerate(planned):
+        # Import earlier files only, so the graph has a direction like real layered code
+        targets = [planned[rng.randrange(index)][0] for _ in range(min(imports, index))]
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w', encoding='utf-8') as f:
+            f.write(render_file(path, kind, name, targets, rng, lines))
+        written.append(full_path)
+        if kind == 'page':
+            features.append(f"  - {name.replace('_', ' ')}: {path}")
+        elif kind == 'route':
+            routes.append(f"  - POST /{os.path.dirname(path)[len('src/app/'):]}")
+
+    with open(os.path.join(root, '.cursorrules'), 'w', encoding='utf-8') as f:
+        f.write(PLAN_TEMPLATE.format(features="\n".join(features[:200]), routes="\n".join(routes[:200])))
+    with open(os.path.join(root, 'package.json'), 'w', encoding='utf-8') as f:
+        json.dump({'name': 'synthetic', 'private': True,
+                   'dependencies': {package.split('/')[0]: 'latest' for package in NPM_PACKAGES}}, f, indent=2)
+    with open(os.path.join(root, 'tsconfig.json'), 'w', encoding='utf-8') as f:
+        json.dump({'compilerOptions': {'baseUrl': '.', 'paths': {'@/*': ['./src/*']}}}, f, indent=2)
+    return written
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic repository for benchmarks.")
+    parser.add_argument("root", help="Directory to create the repository in")
+    parser.add_argument("--files", type=int, default=500, help="Number of code files")
+    parser.add_argument("--lines", type=int, default=40, help="Body lines per file")
+    parser.add_argument("--imports", type=int, default=3, help="Local imports per file")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    paths = generate_repo(os.path.abspath(args.root), args.files, args.lines, args.imports, args.seed)
+    print(f"Wrote {len(paths)} files to {os.path.abspath(args.root)}")
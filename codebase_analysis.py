@@ -1,81 +1,607 @@
-from dotenv import load_dotenv
-import anthropic
 import json
 import os
-import pathlib
 import time
 import logging
-from tqdm import tqdm
-from colorama import Fore, Style, init
 import asyncio
-import aiohttp
 from datetime import datetime
 import random
 import ast
 import re
-from pathlib import Path
 from typing import Dict, List, Set
+from analysis_store import (ResultStore, append_log, iter_analyses, iter_results, migrate_json_to_log,
+                            compact_results)
+from generate_todo import TodoIndex, build_todo_index, update_todo_index, write_todo
+from import_graph import ImportGraph, build_import_graph, file_stamp, relative_path
+from request_metrics import RequestMetrics, percentile, usage_cost
 import subprocess
 import sys
-
-# Load environment variables from .env file
-load_dotenv()
+import argparse
+import hashlib
+import fnmatch
+import collections
+import contextlib
+import inspect
+import posixpath
+import concurrent.futures
+import functools
+import array
+import math
+import types
 
 # --- Configuration ---
 API_KEY = os.getenv("ANTHROPIC_API_KEY")  # Get from environment variable
 MODEL_NAME = "claude-3-5-sonnet-20241022"
 PLAN_FILE = ".cursorrules"
 CODEBASE_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONCURRENCY = 4  # Number of files analyzed in parallel
 
-# Create output directory
+# Output directory, created by the commands that write to it
 OUTPUT_DIR = "analysis_output"
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_FILE = os.path.join(OUTPUT_DIR, "codebase_analysis.json")
+RESULTS_LOG = os.path.join(OUTPUT_DIR, "codebase_analysis.jsonl")
 PROGRESS_FILE = os.path.join(OUTPUT_DIR, "analysis_progress.json")
 LOG_FILE = os.path.join(OUTPUT_DIR, "codebase_analysis.log")
+PROGRESS_SAVE_INTERVAL = 5.0  # Seconds between progress file rewrites
+USAGE_LOG = os.path.join(OUTPUT_DIR, "token_usage.jsonl")
+REQUEST_TRACE = os.path.join(OUTPUT_DIR, "request_trace.jsonl")  # Per-request metrics of the last run
+TODO_INDEX = os.path.join(OUTPUT_DIR, "todo_index.jsonl")  # Clustered todo items behind todo.md
+IMPORT_GRAPH = os.path.join(OUTPUT_DIR, "import_graph.jsonl")  # Import graph behind the dependency sections
+SHARD_DIR = os.path.join(OUTPUT_DIR, "shards")  # Per-shard results and progress of --shard runs
 
-# Increase the recursion limit
-sys.setrecursionlimit(10000)
+# Packing of small files into shared requests
+SMALL_FILE_TOKENS = 1500  # Files estimated below this may share a request
+PACK_TOKEN_BUDGET = 6000  # Max estimated code tokens per packed request
+PACK_MAX_FILES = 6  # Keeps the combined response within the output budget
+PACK_MAX_OUTPUT_TOKENS = 8192
 
-# --- Initialize colorama ---
-init(autoreset=True)
+# Chunking of files too large for a single request
+CHUNK_THRESHOLD_TOKENS = 24000  # Files estimated above this are split
+CHUNK_TOKENS = 12000  # Target size of each chunk
+MIN_CHUNK_TOKENS = 1000
+
+# Offline Message Batches mode
+BATCH_POLL_INTERVAL = 60  # Seconds between status checks while waiting
+
+# Response cache settings
+CACHE_DIR = os.path.join(OUTPUT_DIR, "cache")
+PROMPT_VERSION = "2"  # Bump whenever the analysis prompt or schema changes
+CACHE_MAX_AGE_DAYS = 30
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Local pre-analysis (reading, hashing, import extraction) ahead of the API workers
+PREP_WORKERS = min(8, os.cpu_count() or 1)  # Worker processes; 0 prepares on a thread pool instead
+PREP_QUEUE_SIZE = 32  # Prepared work units buffered ahead of the API workers
+
+# Plan relevance: only the .cursorrules sections relevant to a file are sent
+PLAN_TOP_K = 0  # Sections per file; 0 sends the whole plan in the cached system prefix
+PLAN_SECTION_TOKENS = 250  # Larger plan blocks are split at their next indentation level
+PLAN_PATH_WEIGHT = 3.0  # Query weight of words from the file path relative to identifiers
+
+# Streaming responses, validated against the analysis schema as they arrive
+STREAM_RESPONSES = True
+STREAM_SCHEMA_RETRIES = 1  # Fresh attempts after a response leaves the schema
+STREAM_PREAMBLE_CHARS = 200  # Text allowed before the JSON object (e.g. a code fence)
+STREAM_MAX_STRING = 4000  # Longer strings are treated as runaway output
+STREAM_MAX_ITEMS = 100  # Longer arrays are treated as runaway output
+
+# Scheduling under --max-cost/--deadline and --dry-run projections
+SCHEDULE_PRIORITY = ('src/app/api/**', 'src/lib/**')  # Analyzed first under a cost or time limit, in this order
+ESTIMATED_OUTPUT_TOKENS = 1000  # Output tokens per file until a previous run's trace says otherwise
+ESTIMATED_LATENCY = 15.0  # Seconds per request until a previous run's trace says otherwise
+
+# Near-duplicate files: one file per group is analyzed and its result reused for the others
+DEDUP_FILES = True
+DEDUP_THRESHOLD = 0.9  # Estimated Jaccard similarity of normalized token 4-grams to share an analysis
+DEDUP_MIN_TOKENS = 50  # Smaller files are cheap to pack and too generic to compare
+DEDUP_SKETCH_SIZE = 64  # Smallest shingle hashes kept per file (bottom-k sketch)
+DEDUP_INDEXED_HASHES = 4  # Sketch values indexed to find candidate groups
+DEDUP_MAX_CANDIDATES = 16  # Groups compared per file at most
+
+# Watch mode
+WATCH_INTERVAL = 1.0  # Seconds between mtime polls
+WATCH_DEBOUNCE = 0.5  # Quiet period after the last change before re-analyzing
 
-# --- Configure logging ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def configure_runtime():
+    """Process-wide setup for command-line runs: .env, output directory and logging.
+
+    Nothing here happens at import time, so other tools can import this module
+    cheaply and without touching the filesystem.
+    """
+    global API_KEY
+    # Load environment variables from .env file
+    from dotenv import load_dotenv
+    load_dotenv()
+    API_KEY = API_KEY or os.getenv("ANTHROPIC_API_KEY")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler()
+        ]
+    )
+
+# --- Prompt ---
+SYSTEM_PROMPT = "You are an expert software engineer analyzing code implementation against requirements. Analyze the code and return a detailed analysis of implemented features, missing requirements, and suggestions for improvement."
+
+ANALYSIS_SCHEMA = """{
+    "filepath": "string",
+    "analysis": {
+        "implemented": [
+            {
+                "requirement": "string",
+                "status": "Fully Implemented | Partially Implemented",
+                "details": "string"
+            }
+        ],
+        "missing": [
+            {
+                "requirement": "string",
+                "priority": "High | Medium | Low",
+                "details": "string"
+            }
+        ],
+        "suggestions": [
+            {
+                "type": "Addition | Improvement",
+                "description": "string"
+            }
+        ]
+    },
+    "validation": {
+        "issues": ["string"],
+        "suggestions": [
+            {
+                "type": "Organization",
+                "description": "string"
+            }
+        ]
+    }
+}"""
+
+ANALYSIS_FOCUS = """Focus on:
+1. Actual implemented features vs requirements
+2. Missing critical functionality
+3. Code organization and structure
+4. Potential improvements and suggestions
+5. Validation issues (TypeScript, ESLint, etc.)"""
+
+def build_system_blocks(plan_data: str = None) -> List[dict]:
+    """Build the shared prompt prefix, marked as a prompt-cache breakpoint.
+
+    Everything here must be byte-identical across requests for cache hits, so
+    nothing file-specific may be added to these blocks. Without `plan_data`
+    the plan is left out and each request carries its relevant sections.
+    """
+    plan_text = f"""Planned Requirements:
+```
+{plan_data}
+```
+
+""" if plan_data else ""
+    return [
+        {"type": "text", "text": SYSTEM_PROMPT},
+        {
+            "type": "text",
+            "text": f"""{plan_text}For each file you are given, return the analysis as a JSON object with this EXACT structure:
+{ANALYSIS_SCHEMA}
+
+{ANALYSIS_FOCUS}""",
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
+
+def build_plan_prefix(plan_sections: str = None) -> str:
+    """Relevant plan sections placed ahead of the file when the plan is not in the system prefix."""
+    if not plan_sections:
+        return ""
+    return f"""Planned Requirements (sections relevant to this request):
+```
+{plan_sections}
+```
+
+"""
+
+def build_packed_prompt(files: List[tuple], plan_sections: str = None) -> str:
+    """Build the per-request suffix for several `(filepath, code)` pairs at once."""
+    sections = [
+        f"""File: {filepath}
+
+Implementation:
+```
+{code}
+```"""
+        for filepath, code in files
+    ]
+    return build_plan_prefix(plan_sections) + f"""Analyze each of these {len(files)} files against the planned requirements:
+
+""" + "\n\n".join(sections) + """
+
+Return a single JSON object of the form {"files": [...]} containing one analysis object per file, in the order given. Each object must have the EXACT structure above, with "filepath" set to the path shown after "File:"."""
+
+def build_chunk_prompt(filepath: str, code: str, number: int, total: int, first_line: int, last_line: int,
+                       plan_sections: str = None) -> str:
+    """Build the per-request suffix for one part of a file that is too large to send whole."""
+    return build_plan_prefix(plan_sections) + f"""Analyze this part of a larger file against the planned requirements:
+
+File: {filepath}
+Part: {number} of {total} (lines {first_line}-{last_line})
+
+Implementation:
+```
+{code}
+```
+
+Only report on what this part shows; other parts are analyzed separately and merged. Use "{filepath}" as the "filepath" value in the JSON object."""
+
+def build_file_prompt(filepath: str, code: str, plan_sections: str = None) -> str:
+    """Build the per-file suffix that follows the cached prefix."""
+    return build_plan_prefix(plan_sections) + f"""Analyze this file against the planned requirements:
+
+File: {filepath}
+
+Implementation:
+```
+{code}
+```
+
+Use "{filepath}" as the "filepath" value in the JSON object."""
+
+class TokenUsage:
+    """Per-request token accounting, including prompt cache reads and writes."""
+    FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+
+    def __init__(self, log_path: str = USAGE_LOG):
+        self.totals = dict.fromkeys(self.FIELDS, 0)
+        self.requests = 0
+        self.store = ResultStore(log_path) if log_path else None
+
+    def record(self, filepath: str, usage):
+        """Record the `usage` block of one API response."""
+        row = {'filepath': filepath, 'timestamp': datetime.now().isoformat()}
+        for field in self.FIELDS:
+            value = getattr(usage, field, 0) or 0
+            row[field] = value
+            self.totals[field] += value
+        self.requests += 1
+        if self.store:
+            self.store.append(row)
+
+    def close(self):
+        if self.store:
+            self.store.close()
+
+    def summary(self) -> str:
+        """One-line summary of token usage for the run."""
+        totals = self.totals
+        total_input = totals['cache_read_input_tokens'] + totals['cache_creation_input_tokens'] + totals['input_tokens']
+        read_share = totals['cache_read_input_tokens'] / total_input if total_input else 0.0
+        return (f"{self.requests} requests, {totals['input_tokens']} input / {totals['output_tokens']} output tokens, "
+                f"prompt cache {totals['cache_read_input_tokens']} read / {totals['cache_creation_input_tokens']} written "
+                f"({read_share:.1%} of input served from cache)")
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting (about four characters per token)."""
+    return len(text) // 4 + 1
+
+def _header_int(headers, name: str):
+    try:
+        value = headers.get(name)
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _header_reset(headers, name: str):
+    """Seconds from now until the RFC 3339 reset time in `name`, if present."""
+    value = headers.get(name) if headers else None
+    if not value:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return max(0.0, reset_at.timestamp() - time.time())
+    except ValueError:
+        return None
+
+def _retry_after(headers):
+    """Server-requested delay in seconds from retry-after headers, if present."""
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    retry_after = headers.get('retry-after')
+    try:
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        if retry_after is not None:
+            return float(retry_after)
+    except ValueError:
+        return None
+    return None
+
 class RateLimit:
-    """Rate limiter optimized for Claude 3.5 Sonnet's context window and rate limits"""
-    def __init__(self):
-        self.requests = []
+    """Adaptive rate controller for the Messages API.
+
+    Concurrency follows AIMD: it grows by roughly one slot per window of
+    successful requests and halves on 429/529 responses. Request and token
+    budgets are tracked over a rolling minute and refreshed from the
+    anthropic-ratelimit-* response headers, and throttled calls are retried
+    with jittered exponential backoff or the server's retry-after value.
+    Finished requests are reported to `metrics` when one is given.
+    """
+    WINDOW = 60.0
+    BASE_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+    MAX_RETRIES = 6
+    RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+    THROTTLE_STATUS = {429, 529}
+
+    def __init__(self, concurrent_limit: int = DEFAULT_CONCURRENCY, max_concurrency: int = None,
+                 requests_per_minute: int = None, input_tokens_per_minute: int = None, metrics=None):
         self.lock = asyncio.Lock()
-        self.base_delay = 2  # Reduced base delay between requests
-        self.concurrent_limit = 4  # Allow 4 concurrent requests
-        self.semaphore = asyncio.Semaphore(self.concurrent_limit)
-        
-    async def acquire(self):
+        self.condition = asyncio.Condition()
+        self.concurrency = float(concurrent_limit)
+        self.min_concurrency = 1
+        self.max_concurrency = max(concurrent_limit, max_concurrency or concurrent_limit * 2)
+        self.in_flight = 0
+        # Budgets start from the caller's configuration and are replaced by header values
+        self.requests_per_minute = requests_per_minute
+        self.input_tokens_per_minute = input_tokens_per_minute
+        self.request_window = collections.deque()
+        self.token_window = collections.deque()
+        self.window_tokens = 0
+        self.blocked_until = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self.metrics = metrics
+
+    @property
+    def concurrent_limit(self) -> int:
+        return max(self.min_concurrency, int(self.concurrency))
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one of the currently allowed concurrent request slots."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.concurrent_limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def _trim(self, now: float):
+        while self.request_window and now - self.request_window[0] >= self.WINDOW:
+            self.request_window.popleft()
+        while self.token_window and now - self.token_window[0][0] >= self.WINDOW:
+            self.window_tokens -= self.token_window.popleft()[1]
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        wait = self.blocked_until - now
+        if self.requests_per_minute and len(self.request_window) >= self.requests_per_minute:
+            wait = max(wait, self.request_window[0] + self.WINDOW - now)
+        if (self.input_tokens_per_minute and self.token_window
+                and self.window_tokens + tokens > self.input_tokens_per_minute):
+            wait = max(wait, self.token_window[0][0] + self.WINDOW - now)
+        return wait
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until the request and token budgets allow another request."""
         async with self.lock:
-            now = time.time()
-            self.requests = [req_time for req_time in self.requests if now - req_time < 60]
-            
-            if len(self.requests) >= self.concurrent_limit:
-                time_since_oldest = now - self.requests[-self.concurrent_limit]
-                if time_since_oldest < self.base_delay:
-                    await asyncio.sleep(self.base_delay - time_since_oldest)
-            
-            self.requests.append(time.time())
+            while True:
+                now = time.monotonic()
+                self._trim(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.request_window.append(now)
+            self.token_window.append((now, tokens))
+            self.window_tokens += tokens
             return True
 
+    def _update_budgets(self, headers):
+        if not headers:
+            return
+        requests_limit = _header_int(headers, 'anthropic-ratelimit-requests-limit')
+        tokens_limit = _header_int(headers, 'anthropic-ratelimit-input-tokens-limit')
+        if requests_limit:
+            self.requests_per_minute = requests_limit
+        if tokens_limit:
+            self.input_tokens_per_minute = tokens_limit
+
+        # Pause everyone until reset once any budget is exhausted
+        for kind in ('requests', 'input-tokens', 'output-tokens'):
+            remaining = _header_int(headers, f'anthropic-ratelimit-{kind}-remaining')
+            if remaining is not None and remaining <= 0:
+                reset = _header_reset(headers, f'anthropic-ratelimit-{kind}-reset')
+                if reset:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+
+    def on_success(self, headers=None):
+        """Additive increase after a successful request."""
+        self._update_budgets(headers)
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def on_error(self, status_code: int, headers=None, attempt: int = 0) -> float:
+        """Record a failed attempt and return how long to wait before retrying it."""
+        self._update_budgets(headers)
+        self.retries += 1
+        retry_after = _retry_after(headers)
+        if status_code in self.THROTTLE_STATUS:
+            # Multiplicative decrease on rate-limit and overload responses
+            self.throttled += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        if retry_after is not None:
+            return retry_after
+        # Full jitter keeps retrying workers from synchronizing
+        return random.uniform(0, min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** attempt))
+
+    async def call(self, send, tokens: int = 0, description: str = "", consume=None):
+        """Run `send()` under the budgets, retrying throttled or transient failures.
+
+        `send` must return a raw API response (``with_raw_response``) so that the
+        rate-limit headers can be read; the parsed message is returned. For
+        streamed requests `consume(stream, sent)` reads the parsed event stream
+        into a message, and connection errors while reading are retried too.
+        """
+        import anthropic
+        attempt = 0
+        started = time.monotonic()
+        queue_wait = 0.0
+        while True:
+            wait_started = time.monotonic()
+            await self.acquire(tokens)
+            sent = time.monotonic()
+            queue_wait += sent - wait_started
+            try:
+                raw = await send()
+                parsed = raw.parse()
+                # parse() is a coroutine on newer async SDK responses
+                if inspect.isawaitable(parsed):
+                    parsed = await parsed
+                if consume:
+                    parsed = await consume(parsed, sent)
+            except anthropic.APIStatusError as e:
+                if e.status_code not in self.RETRYABLE_STATUS or attempt >= self.MAX_RETRIES:
+                    self._record(description, started, queue_wait, sent, attempt, e.status_code, error=str(e))
+                    raise
+                delay = self.on_error(e.status_code, e.response.headers, attempt)
+                logging.warning(f"{description}: HTTP {e.status_code}, retry {attempt + 1} in {delay:.1f}s "
+                                f"(concurrency now {self.concurrent_limit})")
+            except (anthropic.APIConnectionError, StreamInterrupted) as e:
+                if attempt >= self.MAX_RETRIES:
+                    self._record(description, started, queue_wait, sent, attempt, 0, error=str(e))
+                    raise
+                delay = self.on_error(0, None, attempt)
+                logging.warning(f"{description}: {e}, retry {attempt + 1} in {delay:.1f}s")
+            except SchemaViolation as e:
+                # The request itself succeeded; the caller decides whether to ask again
+                self.on_success(raw.headers)
+                partial = getattr(e, 'partial', None)
+                self._record(description, started, queue_wait, sent, attempt, 200, getattr(partial, 'usage', None),
+                             error=str(e), ttft=getattr(partial, 'ttft', None))
+                raise
+            else:
+                self.on_success(raw.headers)
+                self._record(description, started, queue_wait, sent, attempt, 200, getattr(parsed, 'usage', None),
+                             ttft=getattr(parsed, 'ttft', None))
+                return parsed
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _record(self, description: str, started: float, queue_wait: float, sent: float, attempt: int,
+                status: int, usage=None, error: str = None, ttft: float = None):
+        if self.metrics:
+            self.metrics.record(description, started, queue_wait, time.monotonic() - sent, attempt + 1,
+                                status, usage=usage, error=error, ttft=ttft)
+
+def cache_key_for(content: str, key_suffix: str) -> str:
+    """Cache key for file contents combined with AnalysisCache.key_suffix."""
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{content_hash}:{key_suffix}".encode('utf-8')).hexdigest()
+
+class AnalysisCache:
+    """On-disk cache of analysis responses keyed by file contents, plan, model and prompt version."""
+    def __init__(self, plan_data: str, cache_dir: str = CACHE_DIR, model: str = MODEL_NAME,
+                 prompt_version: str = PROMPT_VERSION, max_age_days: float = CACHE_MAX_AGE_DAYS,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.plan_hash = hashlib.sha256(plan_data.encode('utf-8')).hexdigest()
+        self.model = model
+        self.prompt_version = prompt_version
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def key_suffix(self) -> str:
+        """Key material shared by every entry; lets worker processes compute keys."""
+        return f"{self.plan_hash}:{self.model}:{self.prompt_version}"
+
+    def key_for(self, content: str) -> str:
+        """Build the cache key for a file's contents under the current plan and model."""
+        return cache_key_for(content, self.key_suffix)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def __contains__(self, key: str) -> bool:
+        """Whether an entry exists for `key`, without counting a lookup."""
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str):
+        """Return the cached analysis for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            # Refresh mtime so eviction drops least recently used entries first
+            os.utime(path)
+            self.hits += 1
+            return entry
+        except (OSError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+    def put(self, key: str, analysis: dict):
+        """Store an analysis result under `key`."""
+        path = self._path(key)
+        # Per-process temp names let parallel shards share the cache
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(analysis, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write cache entry {key}: {e}")
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until under the size budget."""
+        now = time.time()
+        entries = []
+        total_bytes = 0
+        removed = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.endswith('.json'):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.max_age:
+                    os.remove(entry.path)
+                    removed += 1
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            removed += 1
+
+        if removed:
+            logging.info(f"Evicted {removed} cache entries from {self.cache_dir}")
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
 def load_plan(filepath):
     """Loads the plan from the .cursorrules file."""
     try:
@@ -109,70 +635,556 @@ def load_plan(filepath):
         logging.error(f"Error loading plan from {filepath}: {e}")
         return None
 
-def get_code_files(root_dir):
-    """Recursively retrieves only new unprocessed code files."""
-    # Load existing processed files
-    progress_data = load_progress()
-    processed_files = set(progress_data['processed_files'])
-    
-    # Define directories to ignore
-    IGNORED_DIRS = {
-        '.next',
-        'node_modules',
-        '__pycache__',
-        '.git',
-        'dist',
-        'build',
-        '.turbo',
-        '.vercel',
-        '.cache',
-        '.husky',
-        'coverage',
-        '.npm',
-        'package-lock.json',
-        'yarn.lock',
-        'venv',
-        'env',
-        '.env',
-        '.venv',
-        '*.pyc',
-        '.idea'
-    }
-    
-    # Define file extensions to analyze
-    CODE_EXTENSIONS = {'.js', '.jsx', '.ts', '.tsx', '.py', '.json', '.sql'}
-    
-    # Use absolute path for legal-buddy directory
-    legal_buddy_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
-    code_files = []
-    
-    print("\nScanning for new files...")
+_PLAN_KEY = re.compile(r'[^\s#-][^:]*:(\s|$)')
+_PLAN_WORDS = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+')
+PLAN_STOPWORDS = {
+    'the', 'and', 'for', 'with', 'this', 'that', 'from', 'into', 'const', 'let', 'var', 'function',
+    'return', 'import', 'export', 'default', 'true', 'false', 'null', 'undefined', 'async', 'await',
+    'type', 'interface', 'class', 'new', 'string', 'number', 'boolean', 'props', 'div', 'span',
+    'src', 'tsx', 'jsx', 'json', 'index', 'def', 'self', 'none', 'else', 'not'
+}
 
-    for path in pathlib.Path(legal_buddy_dir).rglob("*.*"):
-        file_path = str(path)
-        
-        # Skip if already processed
-        if file_path in processed_files:
+def plan_words(text: str) -> List[str]:
+    """Lowercased words of `text` for plan matching, splitting camelCase and paths."""
+    words = []
+    for word in _PLAN_WORDS.findall(text):
+        word = word.lower()
+        if len(word) < 3 or word in PLAN_STOPWORDS:
             continue
-            
-        # Skip ignored directories
-        if any(ignored in path.parts for ignored in IGNORED_DIRS):
+        # Crude plural folding so "cases" matches "Case"
+        if word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+def plan_query_terms(filepath: str, code: str) -> dict:
+    """Weighted query terms for a file: its path words plus the identifiers in its code."""
+    terms = dict.fromkeys(plan_words(code), 1.0)
+    rel_path = os.path.relpath(filepath, CODEBASE_ROOT) if os.path.isabs(filepath) else filepath
+    for word in plan_words(rel_path):
+        terms[word] = PLAN_PATH_WEIGHT
+    return terms
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+def _split_plan_block(lines: List[str], headers: List[str], max_tokens: int) -> List[tuple]:
+    """Split a block at its shallowest indentation, keeping ancestor header lines for context."""
+    text = "\n".join(headers + lines).strip("\n")
+    # Title from the ancestor keys and every key at the block's own level
+    content = [line for line in lines if line.strip()]
+    level = min((_indent(line) for line in content), default=0)
+    keys = [line.strip().rstrip(':') for line in content if _indent(line) == level and _PLAN_KEY.match(line.strip())]
+    title = " > ".join([header.strip().rstrip(':') for header in headers if header.strip()]
+                       + [", ".join(keys[:4]) + (", ..." if len(keys) > 4 else "")] * bool(keys))
+    if estimate_tokens(text) <= max_tokens or len(content) < 2:
+        return [(title, text)]
+
+    starts = [i for i, line in enumerate(lines) if line.strip() and _indent(line) == level]
+    if len(starts) == 1:
+        # A single key at this level: descend into its children
+        start = starts[0]
+        return _split_plan_block(lines[start + 1:], headers + lines[:start + 1], max_tokens)
+
+    groups = [lines[:starts[1]]] + [lines[a:b] for a, b in zip(starts[1:], starts[2:] + [len(lines)])]
+    if not headers:
+        # Each top-level key is a section of its own; unkeyed lines stay with the key above
+        keyed = [groups[0]]
+        for group in groups[1:]:
+            if _PLAN_KEY.match(group[0]):
+                keyed.append(group)
+            else:
+                keyed[-1] = keyed[-1] + group
+        if len(keyed) == 1:
+            return _split_plan_block(lines[starts[0] + 1:], lines[:starts[0] + 1], max_tokens)
+        return [section for group in keyed for section in _split_plan_block(group, [], max_tokens)]
+    sections = []
+    pending = []
+    for group in groups:
+        # Neighbouring small groups (list items, short keys) share a section
+        if pending and estimate_tokens("\n".join(headers + pending + group)) > max_tokens:
+            sections.extend(_split_plan_block(pending, headers, max_tokens))
+            pending = []
+        pending = pending + group
+    if pending:
+        sections.extend(_split_plan_block(pending, headers, max_tokens))
+    return sections
+
+def split_plan_sections(plan_data: str, max_tokens: int = PLAN_SECTION_TOKENS) -> tuple:
+    """Split the plan into `(preamble, [(title, text), ...])`.
+
+    The preamble is the leading comment block, sent with every selection.
+    Sections follow the plan's indentation, so YAML-like keys and the
+    project tree are split without needing a parser.
+    """
+    lines = plan_data.splitlines()
+    start = 0
+    while start < len(lines) and (lines[start].startswith('#') or not lines[start].strip()):
+        start += 1
+    preamble = "\n".join(lines[:start]).strip()
+    return preamble, _split_plan_block(lines[start:], [], max_tokens)
+
+class PlanIndex:
+    """BM25 index over plan sections for choosing the ones relevant to a file.
+
+    Built once per run. `select` returns the preamble plus the top-k matching
+    sections in plan order, or the whole plan when nothing matches, and keeps
+    counters for comparing against full-plan mode.
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, plan_data: str, top_k: int = PLAN_TOP_K, max_section_tokens: int = PLAN_SECTION_TOKENS):
+        self.plan_data = plan_data
+        self.top_k = top_k
+        self.preamble, self.sections = split_plan_sections(plan_data, max_section_tokens)
+        self.postings = collections.defaultdict(list)
+        self.lengths = []
+        for number, (title, text) in enumerate(self.sections):
+            counts = collections.Counter(plan_words(text))
+            self.lengths.append(sum(counts.values()))
+            for word, count in counts.items():
+                self.postings[word].append((number, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        total = len(self.sections)
+        self.idf = {word: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for word, postings in self.postings.items()}
+        self.full_tokens = estimate_tokens(plan_data)
+        self.selections = 0
+        self.sections_sent = 0
+        self.tokens_sent = 0
+        self.fallbacks = 0
+
+    def rank(self, terms: dict) -> List[int]:
+        """Section numbers with a positive score for `terms`, best first."""
+        scores = collections.defaultdict(float)
+        for word, weight in terms.items():
+            for number, count in self.postings.get(word, ()):
+                norm = 1 - self.B + self.B * self.lengths[number] / (self.average_length or 1)
+                scores[number] += weight * self.idf[word] * count * (self.K1 + 1) / (count + self.K1 * norm)
+        return sorted(scores, key=lambda number: (-scores[number], number))
+
+    def select(self, *term_sets: dict) -> str:
+        """Plan text for a request covering files with the given query terms."""
+        chosen = set()
+        for terms in term_sets:
+            chosen.update(self.rank(terms or {})[:self.top_k])
+        self.selections += 1
+        if not chosen:
+            self.fallbacks += 1
+            self.sections_sent += len(self.sections)
+            self.tokens_sent += self.full_tokens
+            return self.plan_data
+        text = "\n\n".join([self.preamble] * bool(self.preamble) +
+                            [self.sections[number][1] for number in sorted(chosen)])
+        self.sections_sent += len(chosen)
+        self.tokens_sent += estimate_tokens(text)
+        return text
+
+    def summary(self) -> str:
+        """One-line comparison of the plan text sent against full-plan mode."""
+        if not self.selections:
+            return f"{len(self.sections)} sections indexed, no requests"
+        full = self.full_tokens * self.selections
+        return (f"avg {self.sections_sent / self.selections:.1f}/{len(self.sections)} sections and "
+                f"{self.tokens_sent // self.selections}/{self.full_tokens} plan tokens per request "
+                f"({1 - self.tokens_sent / full:.1%} saved), {self.fallbacks} full-plan fallbacks")
+
+# Directories and files never analyzed, matched against exact path components
+IGNORED_DIRS = {
+    '.next',
+    'node_modules',
+    '__pycache__',
+    '.git',
+    'dist',
+    'build',
+    '.turbo',
+    '.vercel',
+    '.cache',
+    '.husky',
+    'coverage',
+    '.npm',
+    'package-lock.json',
+    'yarn.lock',
+    'venv',
+    'env',
+    '.env',
+    '.venv',
+    '*.pyc',
+    '.idea'
+}
+
+# File extensions to analyze
+CODE_EXTENSIONS = {'.js', '.jsx', '.ts', '.tsx', '.py', '.json', '.sql'}
+
+# Ignore files whose patterns are honoured during discovery
+IGNORE_FILES = ('.gitignore', '.cursorignore')
+GIT_READ_SIZE = 1 << 16  # Bytes of `git ls-files` output read at a time while streaming discovery
+
+def _gitignore_regex(pattern: str) -> str:
+    """Regex source for a gitignore glob: `*`, `?` and `[...]` stay within one path component.
+
+    `**/` matches zero or more leading directories, `/**/` zero or more inner
+    ones and a trailing `/**` everything below; any other `**` is a plain `*`.
+    """
+    parts = []
+    index, end = 0, len(pattern)
+    while index < end:
+        char = pattern[index]
+        if pattern.startswith('**', index) and (index == 0 or pattern[index - 1] == '/'):
+            if index + 2 == end:
+                parts.append('.*')
+                index += 2
+                continue
+            if pattern[index + 2] == '/':
+                parts.append('(?:.*/)?')
+                index += 3
+                continue
+        if char == '*':
+            parts.append('[^/]*')
+            while index + 1 < end and pattern[index + 1] == '*':
+                index += 1
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '\\' and index + 1 < end:
+            index += 1
+            parts.append(re.escape(pattern[index]))
+        elif char == '[':
+            start = index + 1
+            negated = pattern[start:start + 1] in ('!', '^')
+            if negated:
+                start += 1
+            # A ']' right after the opening bracket is part of the set
+            close = pattern.find(']', start + 1)
+            if close < 0:
+                parts.append(re.escape(char))
+            else:
+                body = re.sub(r'([\\\[\]^])', r'\\\1', pattern[start:close])
+                parts.append(f"[^/{body}]" if negated else f"(?!/)[{body}]")
+                index = close
+        else:
+            parts.append(re.escape(char))
+        index += 1
+    return ''.join(parts)
+
+def output_rel_dir(root_dir: str):
+    """OUTPUT_DIR relative to `root_dir` with '/' separators, or None if it is not inside it."""
+    rel_dir = os.path.relpath(os.path.abspath(OUTPUT_DIR), os.path.abspath(root_dir))
+    if rel_dir == os.curdir or rel_dir == os.pardir or rel_dir.startswith(os.pardir + os.sep):
+        return None
+    return rel_dir.replace(os.sep, '/')
+
+class IgnoreMatcher:
+    """Matches root-relative paths against .gitignore-style patterns.
+
+    `base` is the directory, relative to the root, whose ignore file the
+    patterns came from; they only apply below it and are matched relative to it.
+    """
+    def __init__(self, patterns: List[str], base: str = ""):
+        self.base = base
+        self.rules = []
+        for raw in patterns:
+            pattern = raw.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            rooted = pattern.startswith('/')
+            pattern = pattern.strip('/')
+            if not pattern:
+                continue
+            # Patterns with an inner slash are anchored to the base, others match any basename
+            anchored = rooted or '/' in pattern
+            regex = re.compile(f"(?s:{_gitignore_regex(pattern)})\\Z")
+            self.rules.append((regex, negate, dir_only, anchored))
+        self.forced = []  # Rules no later or deeper pattern can override
+
+    @staticmethod
+    def _read_patterns(path: str) -> List[str]:
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read().splitlines()
+
+    @classmethod
+    def from_root(cls, root_dir: str) -> "IgnoreMatcher":
+        patterns = []
+        for name in IGNORE_FILES:
+            patterns.extend(cls._read_patterns(os.path.join(root_dir, name)))
+        matcher = cls(patterns)
+        # The analyzer's own outputs (cache, shards, progress) are never analyzed or watched,
+        # whatever negations the ignore files contain
+        output_dir = output_rel_dir(root_dir)
+        if output_dir:
+            output_dir = re.sub(r'([*?[])', r'[\1]', output_dir)
+            matcher.forced = cls([f"/{output_dir}/"]).rules
+        return matcher
+
+    @classmethod
+    def from_nested(cls, directory: str, rel_dir: str):
+        """Matcher for the .gitignore of a subdirectory, or None if it has no rules."""
+        matcher = cls(cls._read_patterns(os.path.join(directory, '.gitignore')), base=rel_dir)
+        return matcher if matcher.rules else None
+
+    @staticmethod
+    def _match(rules, rel_path: str, is_dir: bool):
+        """Whether the last of `rules` matching `rel_path` ignores it, or None if none matches."""
+        name = rel_path.rsplit('/', 1)[-1]
+        result = None
+        for regex, negate, dir_only, anchored in rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path if anchored else name):
+                result = not negate
+        return result
+
+    def ignored(self, rel_path: str, is_dir: bool, nested=()) -> bool:
+        """Return True if `rel_path` (using '/' separators) is ignored; last match wins.
+
+        `nested` are the matchers of subdirectory .gitignore files above
+        `rel_path`, outermost first; as in git, deeper files take precedence.
+        """
+        if self._match(self.forced, rel_path, is_dir):
+            return True
+        result = self._match(self.rules, rel_path, is_dir)
+        for matcher in nested:
+            matched = self._match(matcher.rules, rel_path[len(matcher.base) + 1:], is_dir)
+            if matched is not None:
+                result = matched
+        return bool(result)
+
+def _is_code_file(name: str) -> bool:
+    return os.path.splitext(name)[1] in CODE_EXTENSIONS and name not in IGNORED_DIRS
+
+def _scan_tree(root_dir: str, matcher: IgnoreMatcher):
+    """Yield code files, walking with os.scandir and pruning ignored directories before descending.
+
+    Each subdirectory's .gitignore is read on the way down, so the scan
+    selects the same files as `git ls-files --exclude-standard`.
+    """
+    stack = [(root_dir, "", ())]
+    while stack:
+        directory, rel_dir, nested = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError as e:
+            logging.warning(f"Could not scan {directory}: {e}")
             continue
-            
-        # Only include specified file extensions
-        if path.suffix in CODE_EXTENSIONS:
-            code_files.append(str(path))
-            print(f"Found new file: {str(path)}")
+        if rel_dir and any(entry.name == '.gitignore' for entry in entries):
+            gitignore = IgnoreMatcher.from_nested(directory, rel_dir)
+            if gitignore:
+                nested = (*nested, gitignore)
+        for entry in entries:
+            if entry.name in IGNORED_DIRS:
+                continue
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if matcher.ignored(rel_path, is_dir, nested):
+                continue
+            if is_dir:
+                stack.append((entry.path, rel_path, nested))
+            elif _is_code_file(entry.name):
+                yield entry.path
+
+def _nested_ignores(root_dir: str, rel_dir: str, cache: dict) -> tuple:
+    """Matchers of the .gitignore files in `rel_dir` and its ancestors below the root, outermost first."""
+    nested = cache.get(rel_dir)
+    if nested is None:
+        parent = rel_dir.rpartition('/')[0]
+        nested = _nested_ignores(root_dir, parent, cache) if parent else ()
+        gitignore = IgnoreMatcher.from_nested(os.path.join(root_dir, *rel_dir.split('/')), rel_dir)
+        if gitignore:
+            nested = (*nested, gitignore)
+        cache[rel_dir] = nested
+    return nested
+
+def _git_code_path(root_dir: str, matcher: IgnoreMatcher, rel_path: str, nested_cache: dict):
+    """Absolute path of one `git ls-files` entry if it is an analyzable code file, else None."""
+    parts = rel_path.split('/')
+    if not _is_code_file(parts[-1]) or any(part in IGNORED_DIRS for part in parts):
+        return None
+    # .cursorignore is not known to git and tracked files are listed even when ignored, so the
+    # patterns are applied here too, with the same nested .gitignore files a directory scan reads
+    nested = ()
+    for i in range(1, len(parts)):
+        if matcher.ignored('/'.join(parts[:i]), True, nested):
+            return None
+        nested = _nested_ignores(root_dir, '/'.join(parts[:i]), nested_cache)
+    if matcher.ignored(rel_path, False, nested):
+        return None
+    path = os.path.join(root_dir, *parts)
+    # Tracked files deleted from the working tree are still listed by git
+    return path if os.path.isfile(path) else None
+
+def _git_ls_files(root_dir: str, matcher: IgnoreMatcher):
+    """Yield tracked and untracked-but-not-ignored code files via git as it lists them.
+
+    The generator returns how many files it yielded, or None if git could not
+    list the tree (e.g. outside a repo) so the caller can fall back to a scan.
+    """
+    try:
+        process = subprocess.Popen(
+            ['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'],
+            cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+    listed = 0
+    nested_cache = {}
+    with process:
+        pending = b""
+        for chunk in iter(lambda: process.stdout.read(GIT_READ_SIZE), b""):
+            *names, pending = (pending + chunk).split(b'\0')
+            for name in names:
+                path = (_git_code_path(root_dir, matcher, name.decode('utf-8', errors='replace'), nested_cache)
+                        if name else None)
+                if path:
+                    listed += 1
+                    yield path
+    if process.returncode != 0:
+        if not listed:
+            return None
+        # Paths already handed out cannot be taken back, so a late failure only warns
+        logging.warning(f"git ls-files exited with status {process.returncode}; the file list may be incomplete")
+    return listed
+
+def iter_code_files(root_dir: str, use_git: bool = True):
+    """Yield every analyzable code file under `root_dir`, in no particular order."""
+    start = time.perf_counter()
+    matcher = IgnoreMatcher.from_root(root_dir)
+    method = "git ls-files"
+    listed = None
+    if use_git:
+        listed = yield from _git_ls_files(root_dir, matcher)
+    if listed is None:
+        method = "directory scan"
+        listed = 0
+        for path in _scan_tree(root_dir, matcher):
+            listed += 1
+            yield path
+    logging.info(f"Discovered {listed} code files via {method} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+def discover_files(root_dir: str, use_git: bool = True) -> List[str]:
+    """Find all analyzable code files under `root_dir`, sorted by path."""
+    files = list(iter_code_files(root_dir, use_git=use_git))
+    files.sort()
+    return files
+
+def git_head(root_dir: str):
+    """Commit currently checked out in `root_dir`, or None outside a git repo."""
+    try:
+        completed = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root_dir, capture_output=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return completed.stdout.decode().strip() if completed.returncode == 0 else None
+
+def git_diff_files(root_dir: str, since: str):
+    """Paths under `root_dir` changed between `since` and the working tree.
+
+    Returns `(modified, deleted)` lists of root-relative paths, where modified
+    includes untracked files, or None if git cannot compare against `since`.
+    Renames count as a deletion plus an addition.
+    """
+    commands = [
+        ['git', 'diff', '--name-status', '-z', '--no-renames', '--relative', since, '--'],
+        ['git', 'ls-files', '-z', '--others', '--exclude-standard']
+    ]
+    outputs = []
+    for command in commands:
+        try:
+            completed = subprocess.run(command, cwd=root_dir, capture_output=True, timeout=60)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error(f"Could not run {' '.join(command[:2])}: {e}")
+            return None
+        if completed.returncode != 0:
+            logging.error(f"git could not diff against {since}: "
+                          f"{completed.stderr.decode('utf-8', errors='replace').strip()}")
+            return None
+        outputs.append(completed.stdout.decode('utf-8', errors='replace').split('\0'))
+
+    diff_fields, untracked = outputs
+    modified = [rel_path for rel_path in untracked if rel_path]
+    deleted = []
+    for status, rel_path in zip(diff_fields[0::2], diff_fields[1::2]):
+        if status and rel_path:
+            (deleted if status == 'D' else modified).append(rel_path)
+    return modified, deleted
+
+def get_changed_files(root_dir: str, since: str, graph: ImportGraph, use_git: bool = True):
+    """Files to re-analyze after changes since `since`, plus files that import them.
+
+    Dependents are the direct importers in the stored import `graph`.
+    Returns `(changed, dependents, deleted)` absolute-path lists, or None when
+    git cannot produce the diff.
+    """
+    diff = git_diff_files(root_dir, since)
+    if diff is None:
+        return None
+    modified, deleted = diff
+    discovered = set(iter_code_files(root_dir, use_git=use_git))
+    changed = {os.path.join(root_dir, *rel_path.split('/')) for rel_path in modified} & discovered
+    touched = set(modified) | set(deleted)
+    dependents = {path for path in reverse_dependents(touched, graph, root_dir) if path in discovered}
+    return (sorted(changed), sorted(dependents - changed),
+            sorted(os.path.join(root_dir, *rel_path.split('/')) for rel_path in deleted))
+
+def get_code_files(root_dir, skip_processed: bool = True, use_git: bool = True):
+    """Retrieves code files, by default only new unprocessed ones."""
+    # Load existing processed files
+    progress_data = load_progress()
+    processed_files = set(progress_data['processed_files']) if skip_processed else set()
+
+    print("\nScanning for new files..." if skip_processed else "\nScanning for files...")
+
+    # One pass over the streamed discovery, so only the files to analyze are ever listed
+    code_files = [path for path in iter_code_files(root_dir, use_git=use_git) if path not in processed_files]
+    code_files.sort()
+
+    print(f"Total {'new ' if skip_processed else ''}files found: {len(code_files)}")
 
-    print(f"\nTotal new files found: {len(code_files)}")
-            
     return code_files
 
-def load_progress():
+def parse_shard(value: str) -> tuple:
+    """Parse an "i/N" shard spec into (i, N) with 1 <= i <= N."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard as i/N, got {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+def shard_of(filepath: str, count: int, root_dir: str = CODEBASE_ROOT) -> int:
+    """Stable 0-based shard of `filepath` among `count` shards.
+
+    Hashes the root-relative path, so every process and machine assigns a file
+    to the same shard regardless of where the repository is checked out.
+    """
+    rel_path = os.path.relpath(filepath, root_dir).replace(os.sep, '/')
+    return int(hashlib.sha1(rel_path.encode('utf-8')).hexdigest()[:8], 16) % count
+
+def shard_output_dir(index: int, count: int) -> str:
+    return os.path.join(SHARD_DIR, f"{index}-of-{count}")
+
+def use_shard_outputs(index: int, count: int):
+    """Point the results log, output, progress, usage and trace files at the shard's directory."""
+    global OUTPUT_FILE, RESULTS_LOG, PROGRESS_FILE, USAGE_LOG, REQUEST_TRACE
+    shard_dir = shard_output_dir(index, count)
+    os.makedirs(shard_dir, exist_ok=True)
+    OUTPUT_FILE, RESULTS_LOG, PROGRESS_FILE, USAGE_LOG, REQUEST_TRACE = (
+        os.path.join(shard_dir, os.path.basename(path))
+        for path in (OUTPUT_FILE, RESULTS_LOG, PROGRESS_FILE, USAGE_LOG, REQUEST_TRACE)
+    )
+
+def load_progress(progress_file: str = None):
     """Load progress from previous run if it exists."""
+    progress_file = progress_file or PROGRESS_FILE
     try:
-        if os.path.exists(PROGRESS_FILE):
-            with open(PROGRESS_FILE, 'r') as f:
+        if os.path.exists(progress_file):
+            with open(progress_file, 'r') as f:
                 content = f.read().strip()
                 if content:
                     return json.loads(content)
@@ -181,346 +1193,2069 @@ def load_progress():
         logging.warning(f"Could not load progress file: {e}")
     return {'processed_files': [], 'failed_files': []}
 
-def save_progress(processed_files, failed_files):
-    """Save current progress to file."""
+def save_progress(processed_files, failed_files, batch_job=None, commit=None):
+    """Save current progress to file, including any pending message batch.
+
+    `commit` is the git commit the stored analyses correspond to, which
+    --changed diffs against on the next run.
+    """
     try:
+        progress = {
+            'processed_files': processed_files,
+            'failed_files': failed_files,
+            'timestamp': datetime.now().isoformat()
+        }
+        if batch_job:
+            progress['batch'] = batch_job
+        if commit:
+            progress['commit'] = commit
         with open(PROGRESS_FILE, 'w') as f:
-            json.dump({
-                'processed_files': processed_files,
-                'failed_files': failed_files,
-                'timestamp': datetime.now().isoformat()
-            }, f)
+            json.dump(progress, f)
     except Exception as e:
         logging.error(f"Error saving progress: {e}")
 
-def analyze_imports(filepath: str) -> dict:
-    """Analyze imports and return information about dependencies and potential issues."""
+# --- Import analysis ---
+JS_EXTENSIONS = ('.js', '.jsx', '.ts', '.tsx')
+JS_RESOLVE_SUFFIXES = ('', '.ts', '.tsx', '.d.ts', '.js', '.jsx', '.mjs', '.cjs', '.json',
+                       '/index.ts', '/index.tsx', '/index.js', '/index.jsx')
+NODE_BUILTINS = {
+    'assert', 'buffer', 'child_process', 'crypto', 'events', 'fs', 'http', 'https', 'net', 'os',
+    'path', 'querystring', 'readline', 'stream', 'tls', 'url', 'util', 'worker_threads', 'zlib'
+}
+PYTHON_STDLIB = set(getattr(sys, 'stdlib_module_names', ())) | {
+    'os', 'sys', 're', 'json', 'time', 'datetime', 'pathlib', 'typing'
+}
+
+# Import statements matched at a keyword found with str.find; multi-line import
+# clauses are covered because the clause may span newlines up to its quote
+_JS_IMPORT_AT = re.compile(r"""
+    (?:import|export)[^'"`;]*?(?<![\w$])from\s*(?P<q1>['"])(?P<from_spec>[^'"\n]+)(?P=q1)
+  | import\s*\(?\s*(?P<q2>['"])(?P<bare_spec>[^'"\n]+)(?P=q2)
+  | require\s*\(\s*(?P<q3>['"])(?P<require_spec>[^'"\n]+)(?P=q3)
+""", re.VERBOSE)
+_QUOTED = re.compile(r"""'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*"|`(?:\\.|[^`\\])*`""")
+_IDENTIFIER_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$.')
+_JSON_COMMENTS = re.compile(r'"(?:\\.|[^"\\])*"|//[^\n]*|/\*[\s\S]*?\*/')
+_JSON_TRAILING_COMMAS = re.compile(r',(\s*[}\]])')
+
+def _keyword_positions(content: str, keywords) -> List[int]:
+    """Start offsets of whole-word occurrences of `keywords`, in order."""
+    positions = []
+    for keyword in keywords:
+        pos = content.find(keyword)
+        while pos != -1:
+            end = pos + len(keyword)
+            if ((pos == 0 or content[pos - 1] not in _IDENTIFIER_CHARS)
+                    and (end == len(content) or content[end] not in _IDENTIFIER_CHARS)):
+                positions.append(pos)
+            pos = content.find(keyword, end)
+    positions.sort()
+    return positions
+
+def _in_js_comment_or_string(content: str, pos: int) -> bool:
+    """Whether `pos` sits inside a comment or a string opened earlier on its line."""
+    block_start = content.rfind('/*', 0, pos)
+    if block_start != -1 and content.rfind('*/', block_start, pos) == -1:
+        return True
+    line_start = content.rfind('\n', 0, pos) + 1
+    prefix = _QUOTED.sub('', content[line_start:pos])
+    return '//' in prefix or any(quote in prefix for quote in '\'"`')
+
+def extract_js_imports(content: str) -> List[str]:
+    """Module specifiers imported, re-exported or required by JS/TS source."""
+    specs = []
+    last_end = 0
+    for pos in _keyword_positions(content, ('import', 'export', 'require')):
+        if pos < last_end:
+            continue
+        match = _JS_IMPORT_AT.match(content, pos)
+        if not match or _in_js_comment_or_string(content, pos):
+            continue
+        specs.append(match.group('from_spec') or match.group('bare_spec') or match.group('require_spec'))
+        last_end = match.end()
+    return specs
+
+def extract_python_imports(content: str) -> List[tuple]:
+    """`(module, level, names)` for each import statement in Python source.
+
+    Only lines that start an import statement are parsed with `ast`, including
+    parenthesized and backslash-continued multi-line imports, so large modules
+    are not parsed whole.
+    """
+    imports = []
+    last_end = 0
+    for pos in _keyword_positions(content, ('import',)):
+        if pos < last_end:
+            continue
+        line_start = content.rfind('\n', 0, pos) + 1
+        line_end = content.find('\n', pos)
+        line_end = len(content) if line_end == -1 else line_end
+        statement = content[line_start:line_end].strip()
+        if not statement.startswith(('import ', 'from ')):
+            continue
+        # Extend over parenthesized or backslash-continued lines
+        while ((statement.count('(') > statement.count(')') or statement.endswith('\\'))
+               and line_end < len(content)):
+            next_end = content.find('\n', line_end + 1)
+            next_end = len(content) if next_end == -1 else next_end
+            statement = f"{statement}\n{content[line_end + 1:next_end].strip()}"
+            line_end = next_end
+        last_end = line_end
+        try:
+            nodes = ast.parse(statement.split(';', 1)[0]).body
+        except SyntaxError:
+            continue
+        for node in nodes:
+            if isinstance(node, ast.Import):
+                imports.extend((alias.name, 0, []) for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                imports.append((node.module or '', node.level, [alias.name for alias in node.names]))
+    return imports
+
+def npm_package_name(spec: str) -> str:
+    """Package name for a bare specifier, keeping the scope of scoped packages."""
+    parts = spec.split('/')
+    return '/'.join(parts[:2]) if spec.startswith('@') and len(parts) > 1 else parts[0]
+
+class ModuleResolver:
+    """Resolves import specifiers against an in-memory index of the project tree.
+
+    The tree is indexed once and tsconfig.json `paths` are loaded once, so each
+    existence check is a set lookup and repeated specifiers hit a memo.
+    """
+    def __init__(self, root_dir: str, files=None):
+        self.root_dir = os.path.abspath(root_dir)
+        self.files = set(files) if files is not None else self._index_tree()
+        self.aliases = self._load_ts_paths()
+        self._memo = {}
+
+    def _index_tree(self) -> Set[str]:
+        """Root-relative paths of every file outside the ignored directories."""
+        files = set()
+        stack = [(self.root_dir, "")]
+        while stack:
+            directory, rel_dir = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name in IGNORED_DIRS:
+                            continue
+                        rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel_path))
+                        else:
+                            files.add(rel_path)
+            except OSError as e:
+                logging.warning(f"Could not index {directory}: {e}")
+        return files
+
+    def _load_ts_paths(self) -> List[tuple]:
+        """`(prefix, is_wildcard, targets)` for each tsconfig `paths` entry."""
+        tsconfig_path = os.path.join(self.root_dir, 'tsconfig.json')
+        aliases = []
+        try:
+            with open(tsconfig_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            # tsconfig allows comments and trailing commas
+            text = _JSON_COMMENTS.sub(lambda m: m.group(0) if m.group(0).startswith('"') else '', text)
+            options = json.loads(_JSON_TRAILING_COMMAS.sub(r'\1', text)).get('compilerOptions', {})
+        except FileNotFoundError:
+            options = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read {tsconfig_path}: {e}")
+            options = {}
+
+        base_url = options.get('baseUrl', '.')
+        for pattern, targets in (options.get('paths') or {}).items():
+            wildcard = pattern.endswith('*')
+            normalized = [posixpath.normpath(posixpath.join(base_url, target)) for target in targets]
+            aliases.append((pattern[:-1] if wildcard else pattern, wildcard, normalized))
+        if not aliases:
+            # Next.js projects default to "@/*" -> "src/*"
+            aliases.append(('@/', True, ['src/*']))
+        return aliases
+
+    def relpath(self, filepath: str) -> str:
+        return os.path.relpath(os.path.abspath(filepath), self.root_dir).replace(os.sep, '/')
+
+    def _probe(self, base: str, suffixes) -> str:
+        for suffix in suffixes:
+            if base + suffix in self.files:
+                return base + suffix
+        return None
+
+    def is_alias(self, spec: str) -> bool:
+        return any(spec.startswith(prefix) if wildcard else spec == prefix
+                   for prefix, wildcard, _ in self.aliases)
+
+    def resolve_js(self, spec: str, from_rel: str) -> str:
+        """Root-relative path a relative or aliased specifier resolves to, or None."""
+        key = (posixpath.dirname(from_rel), spec) if spec.startswith('.') else ('', spec)
+        if key in self._memo:
+            return self._memo[key]
+
+        resolved = None
+        if spec.startswith('.'):
+            resolved = self._probe(posixpath.normpath(posixpath.join(key[0], spec)), JS_RESOLVE_SUFFIXES)
+        else:
+            for prefix, wildcard, targets in self.aliases:
+                if wildcard and spec.startswith(prefix):
+                    rest = spec[len(prefix):]
+                elif spec == prefix:
+                    rest = ''
+                else:
+                    continue
+                for target in targets:
+                    resolved = self._probe(posixpath.normpath(target.replace('*', rest)), JS_RESOLVE_SUFFIXES)
+                    if resolved:
+                        break
+                if resolved:
+                    break
+        self._memo[key] = resolved
+        return resolved
+
+    def resolve_python(self, module: str, level: int, names: List[str], from_rel: str) -> str:
+        """Root-relative path of a local Python module, or None for packages."""
+        from_dir = posixpath.dirname(from_rel)
+        if level:
+            base_dir = from_dir
+            for _ in range(level - 1):
+                base_dir = posixpath.dirname(base_dir)
+            candidates = [posixpath.join(base_dir, *module.split('.'))] if module else \
+                [posixpath.join(base_dir, name) for name in names] + [base_dir]
+        else:
+            # Absolute imports of sibling scripts or top-level project modules
+            top = module.split('.')[0]
+            candidates = [posixpath.join(from_dir, top), top] if from_dir else [top]
+        for candidate in candidates:
+            candidate = posixpath.normpath(candidate)
+            resolved = self._probe(candidate, ('.py', '/__init__.py'))
+            if resolved:
+                return resolved
+        return None
+
+_module_resolvers = {}
+
+def get_module_resolver(root_dir: str = None, refresh: bool = False) -> ModuleResolver:
+    """Shared resolver for `root_dir` (default CODEBASE_ROOT), built on first use."""
+    root_dir = os.path.abspath(root_dir or CODEBASE_ROOT)
+    if refresh or root_dir not in _module_resolvers:
+        _module_resolvers[root_dir] = ModuleResolver(root_dir)
+    return _module_resolvers[root_dir]
+
+def analyze_imports(filepath: str, content: str = None, resolver: ModuleResolver = None) -> dict:
+    """Analyze imports and return information about dependencies and potential issues.
+
+    Pass `content` when the file has already been read to avoid reading it again.
+    """
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
+        if content is None:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                content = f.read()
+        resolver = resolver or get_module_resolver()
+        from_rel = resolver.relpath(filepath)
+
         # Track different types of imports
         analysis = {
             'npm_packages': set(),  # For package.json dependencies
             'python_packages': set(),  # For requirements.txt
             'local_imports': [],  # Project files being imported
+            'resolved_imports': [],  # Root-relative paths of those project files
             'import_errors': []  # Issues with imports
         }
-        
+
         # Check for Node.js/TypeScript imports
-        if filepath.endswith(('.js', '.jsx', '.ts', '.tsx')):
-            # Match import statements
-            import_lines = re.findall(r'(?:import|require)\s*[\({]?\s*["\']([^"\']+)["\']', content)
-            for imp in import_lines:
-                if imp.startswith('.'):
-                    # Local import - verify file exists
-                    import_path = os.path.normpath(os.path.join(os.path.dirname(filepath), imp))
-                    if not os.path.exists(f"{import_path}.ts") and not os.path.exists(f"{import_path}.tsx") \
-                       and not os.path.exists(f"{import_path}.js") and not os.path.exists(f"{import_path}.jsx"):
+        if filepath.endswith(JS_EXTENSIONS):
+            for imp in extract_js_imports(content):
+                if imp.startswith('.') or resolver.is_alias(imp):
+                    resolved = resolver.resolve_js(imp, from_rel)
+                    if resolved:
+                        analysis['local_imports'].append(imp)
+                        analysis['resolved_imports'].append(resolved)
+                    elif imp.startswith('.'):
                         analysis['import_errors'].append(f"Missing local import: {imp}")
                     else:
-                        analysis['local_imports'].append(imp)
-                elif imp.startswith('@/'):
-                    # Project alias import - verify in src directory
-                    alias_path = imp.replace('@/', 'src/')
-                    if not os.path.exists(os.path.join(CODEBASE_ROOT, f"{alias_path}.ts")) and \
-                       not os.path.exists(os.path.join(CODEBASE_ROOT, f"{alias_path}.tsx")):
                         analysis['import_errors'].append(f"Invalid alias import: {imp}")
-                    else:
-                        analysis['local_imports'].append(imp)
-                else:
+                elif not imp.startswith('node:') and npm_package_name(imp) not in NODE_BUILTINS:
                     # NPM package
-                    package_name = imp.split('/')[0]
-                    analysis['npm_packages'].add(package_name)
-                    
+                    analysis['npm_packages'].add(npm_package_name(imp))
+
         # Check for Python imports
         elif filepath.endswith('.py'):
-            # Match import statements
-            import_lines = re.findall(r'^(?:import|from)\s+([^\s]+)', content, re.MULTILINE)
-            for imp in import_lines:
-                if imp.startswith('.'):
-                    # Local import - verify file exists
-                    import_path = os.path.normpath(os.path.join(os.path.dirname(filepath), imp.lstrip('.').replace('.', '/')))
-                    if not os.path.exists(f"{import_path}.py"):
-                        analysis['import_errors'].append(f"Missing local import: {imp}")
-                    else:
-                        analysis['local_imports'].append(imp)
+            for module, level, names in extract_python_imports(content):
+                imp = '.' * level + module
+                resolved = resolver.resolve_python(module, level, names, from_rel)
+                if resolved:
+                    analysis['local_imports'].append(imp)
+                    analysis['resolved_imports'].append(resolved)
+                elif level:
+                    analysis['import_errors'].append(f"Missing local import: {imp}")
                 else:
                     # Python package
-                    package_name = imp.split('.')[0]
-                    if package_name not in {'os', 'sys', 're', 'json', 'time', 'datetime', 'pathlib', 'typing'}:
+                    package_name = module.split('.')[0]
+                    if package_name and package_name not in PYTHON_STDLIB:
                         analysis['python_packages'].add(package_name)
-        
+
         # Convert sets to lists for JSON serialization
-        analysis['npm_packages'] = list(analysis['npm_packages'])
-        analysis['python_packages'] = list(analysis['python_packages'])
-        
+        analysis['npm_packages'] = sorted(analysis['npm_packages'])
+        analysis['python_packages'] = sorted(analysis['python_packages'])
+
         return analysis
-        
+
     except Exception as e:
         logging.error(f"Error analyzing imports in {filepath}: {e}")
         return {
             'npm_packages': [],
             'python_packages': [],
             'local_imports': [],
+            'resolved_imports': [],
             'import_errors': [f"Error analyzing imports: {str(e)}"]
         }
 
-def generate_dependency_summary(analyses) -> dict:
+def generate_dependency_summary(analyses, root_dir: str = CODEBASE_ROOT) -> dict:
     """Generate a summary of all required dependencies from analyses."""
-    summary = {
-        'npm_packages': set(),
-        'python_packages': set(),
-        'import_errors': [],
-        'local_import_errors': []
-    }
-    
-    for analysis in analyses:
-        if 'imports' in analysis:
-            imp_analysis = analysis['imports']
-            summary['npm_packages'].update(imp_analysis.get('npm_packages', []))
-            summary['python_packages'].update(imp_analysis.get('python_packages', []))
-            if imp_analysis.get('import_errors'):
-                summary['import_errors'].extend([
-                    f"{analysis['filepath']}: {error}"
-                    for error in imp_analysis['import_errors']
-                ])
-    
-    return {
-        'npm_packages': sorted(list(summary['npm_packages'])),
-        'python_packages': sorted(list(summary['python_packages'])),
-        'import_errors': sorted(summary['import_errors'])
-    }
+    return build_import_graph(analyses, root_dir).dependency_summary()
 
-async def analyze_file_with_claude(filepath: str, plan_data: str, client, rate_limiter):
-    """Analyze a file using Claude API and return structured analysis."""
-    try:
-        # Read file contents
-        with open(filepath, "r", encoding='utf-8') as f:
-            code = f.read()
-        
-        # Analyze imports first
-        import_analysis = analyze_imports(filepath)
-        
-        await rate_limiter.acquire()
-        
-        # Make API call with system message as top-level parameter
-        response = await client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=4096,
-            system="You are an expert software engineer analyzing code implementation against requirements. Analyze the code and return a detailed analysis of implemented features, missing requirements, and suggestions for improvement.",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Analyze this file against the planned requirements:
-
-                    File: {filepath}
-                    
-                    Planned Requirements:
-                    ```
-                    {plan_data}
-                    ```
-                    
-                    Implementation:
-                    ```
-                    {code}
-                    ```
-
-                    Return the analysis as a JSON object with this EXACT structure:
-                    {{
-                        "filepath": "{filepath}",
-                        "analysis": {{
-                            "implemented": [
-                                {{
-                                    "requirement": "string",
-                                    "status": "Fully Implemented | Partially Implemented",
-                                    "details": "string"
-                                }}
-                            ],
-                            "missing": [
-                                {{
-                                    "requirement": "string",
-                                    "priority": "High | Medium | Low",
-                                    "details": "string"
-                                }}
-                            ],
-                            "suggestions": [
-                                {{
-                                    "type": "Addition | Improvement",
-                                    "description": "string"
-                                }}
-                            ]
-                        }},
-                        "validation": {{
-                            "issues": ["string"],
-                            "suggestions": [
-                                {{
-                                    "type": "Organization",
-                                    "description": "string"
-                                }}
-                            ]
-                        }}
-                    }}
-
-                    Focus on:
-                    1. Actual implemented features vs requirements
-                    2. Missing critical functionality
-                    3. Code organization and structure
-                    4. Potential improvements and suggestions
-                    5. Validation issues (TypeScript, ESLint, etc.)
-                    """
-                }
-            ]
-        )
+def reverse_dependents(rel_paths: Set[str], graph: ImportGraph, root_dir: str = CODEBASE_ROOT) -> Set[str]:
+    """Absolute paths of the files directly importing any of the root-relative `rel_paths`."""
+    return {os.path.join(root_dir, *importer.split('/'))
+            for rel_path in rel_paths for importer in graph.importers(rel_path)}
 
-        try:
-            content = response.content[0].text
-            # Remove control characters and find JSON
-            cleaned_content = re.sub(r'[\x00-\x08\x0b-\x0c\x0e-\x1f\x7f]', '', content)
-            json_match = re.search(r'\{[\s\S]*\}', cleaned_content)
-            if json_match:
-                analysis_result = json.loads(json_match.group(0))
-                # Add import analysis to the result
-                analysis_result['imports'] = import_analysis
-                return analysis_result
-            else:
-                raise ValueError("No JSON object found in response")
-                
-        except (json.JSONDecodeError, ValueError) as e:
-            logging.error(f"Failed to parse JSON response for {filepath}: {str(e)}")
+# Keys allowed in each object of an analysis, by path; '[]' stands for any array item.
+# A packed response nests the same structure under files[].
+RESPONSE_KEYS = {
+    (): {'filepath', 'analysis', 'validation', 'files'},
+    ('analysis',): {'implemented', 'missing', 'suggestions'},
+    ('analysis', 'implemented', '[]'): {'requirement', 'status', 'details'},
+    ('analysis', 'missing', '[]'): {'requirement', 'priority', 'details'},
+    ('analysis', 'suggestions', '[]'): {'type', 'description'},
+    ('validation',): {'issues', 'suggestions'},
+    ('validation', 'suggestions', '[]'): {'type', 'description'},
+}
+# Expected kind of value by path: '{' object, '[' array, '"' string
+RESPONSE_TYPES = {
+    ('files',): '[', ('files', '[]'): '{', ('filepath',): '"',
+    ('analysis',): '{', ('analysis', 'implemented'): '[', ('analysis', 'missing'): '[',
+    ('analysis', 'suggestions'): '[', ('analysis', 'implemented', '[]'): '{',
+    ('analysis', 'missing', '[]'): '{', ('analysis', 'suggestions', '[]'): '{',
+    ('validation',): '{', ('validation', 'issues'): '[', ('validation', 'issues', '[]'): '"',
+    ('validation', 'suggestions'): '[', ('validation', 'suggestions', '[]'): '{',
+}
+
+class SchemaViolation(ValueError):
+    """A streamed response left the analysis schema."""
+
+class StreamInterrupted(ConnectionError):
+    """The connection failed while a response was being streamed."""
+
+class StreamingJSONValidator:
+    """Incrementally checks streamed text against the analysis schema.
+
+    `feed` consumes text as it arrives and raises SchemaViolation as soon as
+    the output cannot become a valid analysis: prose instead of JSON, keys or
+    value types outside RESPONSE_KEYS/RESPONSE_TYPES, or runaway strings and
+    arrays. Once the top-level object closes, `start` and `end` delimit it.
+    """
+    def __init__(self):
+        self.position = 0
+        self.start = None
+        self.end = None
+        self.stack = []  # [kind, path, expecting, current key, item count]
+        self.in_string = False
+        self.escape = False
+        self.string_is_key = False
+        self.string_length = 0
+        self.key_chars = []
+        self.in_literal = False
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None
+
+    @staticmethod
+    def _schema_path(path: tuple) -> tuple:
+        return path[2:] if path[:2] == ('files', '[]') else path
+
+    def _begin_value(self, kind: str) -> tuple:
+        """Check a value starting in the current container; return its path."""
+        frame = self.stack[-1]
+        if frame[2] != 'value':
+            raise SchemaViolation(f"Unexpected value at offset {self.position}")
+        if frame[0] == '{':
+            path = frame[1] + (frame[3],)
+        else:
+            frame[4] += 1
+            if frame[4] > STREAM_MAX_ITEMS:
+                raise SchemaViolation(f"More than {STREAM_MAX_ITEMS} items in {'.'.join(frame[1])}")
+            path = frame[1] + ('[]',)
+        expected = RESPONSE_TYPES.get(self._schema_path(path), RESPONSE_TYPES.get(path))
+        if expected and expected != kind:
+            raise SchemaViolation(f"Expected {expected} for {'.'.join(path)}, got {kind}")
+        frame[2] = 'comma'
+        return path
+
+    def _open(self, kind: str, path: tuple):
+        self.stack.append([kind, path, 'key' if kind == '{' else 'value', None, 0])
+
+    def feed(self, text: str):
+        for char in text:
+            self.position += 1
+            if self.end is not None:
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.string_is_key:
+                        self._end_key()
+                    continue
+                self.string_length += 1
+                if self.string_is_key:
+                    self.key_chars.append(char)
+                if self.string_length > STREAM_MAX_STRING:
+                    raise SchemaViolation(f"String longer than {STREAM_MAX_STRING} characters")
+                continue
+            if self.start is None:
+                if char == '{':
+                    self.start = self.position - 1
+                    self._open('{', ())
+                elif not char.isspace() and self.position > STREAM_PREAMBLE_CHARS:
+                    raise SchemaViolation("No JSON object at the start of the response")
+                continue
+            if char.isspace():
+                self.in_literal = False
+                continue
+            frame = self.stack[-1]
+            if char == '"':
+                self.in_literal = False
+                self.in_string = True
+                self.string_length = 0
+                self.string_is_key = frame[0] == '{' and frame[2] == 'key'
+                if self.string_is_key:
+                    self.key_chars = []
+                else:
+                    self._begin_value('"')
+            elif char == ':' and frame[0] == '{' and frame[2] == 'colon':
+                frame[2] = 'value'
+            elif char == ',' and frame[2] == 'comma':
+                self.in_literal = False
+                frame[2] = 'key' if frame[0] == '{' else 'value'
+            elif char in '{[':
+                self._open(char, self._begin_value(char))
+            elif char in '}]':
+                self.in_literal = False
+                empty = frame[2] in ('key', 'value') and (frame[3] is None and frame[4] == 0)
+                if char != ('}' if frame[0] == '{' else ']') or not (frame[2] == 'comma' or empty):
+                    raise SchemaViolation(f"Unexpected {char!r} at offset {self.position}")
+                self.stack.pop()
+                if not self.stack:
+                    self.end = self.position
+            elif self.in_literal:
+                continue
+            elif char in '-0123456789tfn':
+                self._begin_value('literal')
+                self.in_literal = True
+            else:
+                raise SchemaViolation(f"Unexpected {char!r} at offset {self.position}")
+
+    def _end_key(self):
+        frame = self.stack[-1]
+        key = "".join(self.key_chars)
+        allowed = RESPONSE_KEYS.get(self._schema_path(frame[1]))
+        if allowed is not None and key not in allowed:
+            raise SchemaViolation(f"Unexpected key {key!r} in {'.'.join(frame[1]) or 'response'}")
+        frame[3] = key
+        frame[2] = 'colon'
+
+class StreamedMessage:
+    """The parts of a Message the analysis reads, assembled from a response stream."""
+    def __init__(self):
+        self.parts = []
+        self.stop_reason = None
+        self.usage = types.SimpleNamespace(input_tokens=0, output_tokens=0, cache_creation_input_tokens=0,
+                                           cache_read_input_tokens=0)
+        self.ttft = None
+        self.span = None
+
+    @property
+    def text(self) -> str:
+        text = "".join(self.parts)
+        return text[self.span[0]:self.span[1]] if self.span else text
+
+    @property
+    def content(self) -> List:
+        return [types.SimpleNamespace(type='text', text=self.text)]
+
+async def consume_stream(stream, sent: float) -> StreamedMessage:
+    """Read a Messages API event stream, validating the text as it arrives.
+
+    Closes the stream and raises SchemaViolation as soon as the output leaves
+    the analysis schema, so a bad completion stops costing output tokens.
+    """
+    import anthropic
+    message = StreamedMessage()
+    validator = StreamingJSONValidator()
+    try:
+        async for event in stream:
+            if event.type == 'message_start':
+                usage = event.message.usage
+                for field in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'):
+                    setattr(message.usage, field, getattr(usage, field, 0) or 0)
+            elif event.type == 'content_block_delta' and getattr(event.delta, 'type', None) == 'text_delta':
+                if message.ttft is None:
+                    message.ttft = time.monotonic() - sent
+                message.parts.append(event.delta.text)
+                validator.feed(event.delta.text)
+            elif event.type == 'message_delta':
+                message.stop_reason = event.delta.stop_reason
+                message.usage.output_tokens = getattr(event.usage, 'output_tokens', 0) or 0
+    except anthropic.APIError:
+        raise
+    except SchemaViolation as e:
+        await stream.close()
+        # No message_delta arrives after an abort, so count what was generated so far
+        message.usage.output_tokens = estimate_tokens("".join(message.parts))
+        e.partial = message
+        raise
+    except Exception as e:
+        # Transport errors surface from the HTTP client unwrapped while iterating
+        raise StreamInterrupted(f"Stream interrupted: {e!r}") from e
+    if validator.done:
+        message.span = (validator.start, validator.end)
+    return message
+
+def extract_json(content: str) -> dict:
+    """Pull the JSON object out of a model response."""
+    # Remove control characters and find JSON
+    cleaned_content = re.sub(r'[\x00-\x08\x0b-\x0c\x0e-\x1f\x7f]', '', content)
+    json_match = re.search(r'\{[\s\S]*\}', cleaned_content)
+    if not json_match:
+        raise ValueError("No JSON object found in response")
+    return json.loads(json_match.group(0))
+
+def finalize_analysis(analysis_result: dict, filepath: str, import_analysis: dict, cache=None, cache_key=None) -> dict:
+    """Cache a parsed analysis and attach the file path and import analysis."""
+    if cache_key:
+        cache.put(cache_key, analysis_result)
+    analysis_result['filepath'] = filepath
+    # Add import analysis to the result
+    analysis_result['imports'] = import_analysis
+    return analysis_result
+
+async def send_analysis_request(user_prompt: str, plan_data: str, client, rate_limiter,
+                                max_tokens: int = 4096, description: str = "", token_usage=None,
+                                stream: bool = STREAM_RESPONSES):
+    """Send one analysis request behind the shared, prompt-cached system prefix.
+
+    With `stream` the response is validated while it arrives; one that leaves
+    the analysis schema is cut off and requested again up to
+    STREAM_SCHEMA_RETRIES times before SchemaViolation is raised.
+    """
+    system_blocks = build_system_blocks(plan_data)
+    estimated_tokens = estimate_tokens(system_blocks[-1]['text']) + estimate_tokens(user_prompt)
+
+    # The system prefix (instructions, plan and schema) is identical for every
+    # request and marked for prompt caching; only the user message varies
+    request = {
+        "model": MODEL_NAME,
+        "max_tokens": max_tokens,
+        "system": system_blocks,
+        "messages": [
+            {
+                "role": "user",
+                "content": user_prompt
+            }
+        ]
+    }
+    for attempt in range(STREAM_SCHEMA_RETRIES + 1 if stream else 1):
+        try:
+            response = await rate_limiter.call(
+                lambda: client.messages.with_raw_response.create(**request, stream=stream),
+                tokens=estimated_tokens,
+                description=description,
+                consume=consume_stream if stream else None
+            )
+        except SchemaViolation as e:
+            if token_usage:
+                token_usage.record(description, getattr(getattr(e, 'partial', None), 'usage', None))
+            if rate_limiter.metrics:
+                rate_limiter.metrics.parse_failure(description, f"stream aborted: {e}")
+            if attempt >= STREAM_SCHEMA_RETRIES:
+                raise
+            logging.warning(f"{description}: {e}; requesting again")
+            continue
+        if token_usage:
+            token_usage.record(description, getattr(response, 'usage', None))
+        return response
+
+def _chunk_boundaries(lines: List[str], filepath: str) -> Dict[int, int]:
+    """Map line indexes where a declaration starts to a nesting rank (0 = top level)."""
+    # Pretty-printed JSON nests its top-level entries one level in
+    base_indent = 0
+    if filepath.endswith('.json'):
+        first_entry = next((line for line in lines[1:] if line.strip()), "")
+        base_indent = len(first_entry) - len(first_entry.lstrip())
+
+    boundaries = {}
+    for index, line in enumerate(lines):
+        stripped = line.lstrip()
+        indent = len(line) - len(stripped)
+        if not stripped or indent < base_indent:
+            continue
+        # Closing brackets and continuation lines end a declaration rather than start one
+        if stripped[0] in '}])' or stripped.startswith(('*', '//', '.', '#')):
+            continue
+        boundaries[index] = indent - base_indent
+
+    if filepath.endswith('.py'):
+        try:
+            tree = ast.parse("".join(lines))
+        except SyntaxError:
+            return boundaries
+        # Column-0 lines inside strings are not boundaries; nested defs stay as a fallback
+        boundaries = {
+            index: rank for index, rank in boundaries.items()
+            if rank and lines[index].lstrip().startswith(('def ', 'async def ', 'class ', '@'))
+        }
+        for node in tree.body:
+            first_line = min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+            boundaries[first_line - 1] = 0
+    return boundaries
+
+def split_into_chunks(code: str, filepath: str, max_tokens: int = CHUNK_TOKENS) -> List[tuple]:
+    """Split code into `(first_line, last_line, text)` chunks of at most `max_tokens`.
+
+    Each cut is placed at the least nested declaration boundary that fits,
+    preferring top-level declarations and falling back to a mid-declaration
+    cut only when nothing else fits. Line numbers are 1-based and inclusive.
+    """
+    max_chars = max_tokens * 4
+    lines = []
+    for line_no, line in enumerate(code.splitlines(keepends=True), start=1):
+        # Minified or generated files can have single lines over the budget
+        for offset in range(0, max(len(line), 1), max_chars):
+            lines.append((line_no, line[offset:offset + max_chars]))
+
+    boundaries = _chunk_boundaries([text for _, text in lines], filepath)
+
+    # Character offset of each line, to keep cuts from producing tiny chunks
+    offsets = [0]
+    for _, text in lines:
+        offsets.append(offsets[-1] + len(text))
+
+    def best_cut(first: int, last: int):
+        """Latest, least nested boundary in (first, last], preferring at least half-full chunks."""
+        candidates = [index for index in range(first + 1, last + 1) if index in boundaries]
+        roomy = [index for index in candidates if offsets[index] - offsets[first] >= max_chars // 2]
+        best = None
+        for index in roomy or candidates:
+            if best is None or boundaries[index] <= boundaries[best]:
+                best = index
+        return best
+
+    chunks = []
+    start = 0
+    for index in range(len(lines)):
+        if offsets[index + 1] - offsets[start] > max_chars and index > start:
+            cut = best_cut(start, index) or index
+            chunks.append((start, cut))
+            start = cut
+    chunks.append((start, len(lines)))
+
+    return [
+        (lines[first][0], lines[end - 1][0], "".join(text for _, text in lines[first:end]))
+        for first, end in chunks if end > first
+    ]
+
+def _item_key(item, field: str) -> str:
+    text = item.get(field, '') if isinstance(item, dict) else str(item)
+    return re.sub(r'\W+', ' ', str(text).lower()).strip()
+
+def merge_chunk_analyses(results: List[dict]) -> dict:
+    """Merge per-chunk analyses into one, de-duplicating repeated items.
+
+    Implemented requirements prefer the strongest status, missing ones keep the
+    highest priority, and anything fully implemented in some chunk is no
+    longer reported as missing.
+    """
+    priority_rank = {'High': 0, 'Medium': 1, 'Low': 2}
+    implemented = {}
+    missing = {}
+    suggestions = {}
+    issues = {}
+    validation_suggestions = {}
+
+    for result in results:
+        analysis = result.get('analysis', {})
+        validation = result.get('validation', {})
+        for item in analysis.get('implemented', []):
+            key = _item_key(item, 'requirement')
+            if key not in implemented or item.get('status') == 'Fully Implemented':
+                implemented[key] = item
+        for item in analysis.get('missing', []):
+            key = _item_key(item, 'requirement')
+            existing = missing.get(key)
+            if existing is None or (priority_rank.get(item.get('priority'), 3)
+                                    < priority_rank.get(existing.get('priority'), 3)):
+                missing[key] = item
+        for item in analysis.get('suggestions', []):
+            suggestions.setdefault(_item_key(item, 'description'), item)
+        for item in validation.get('issues', []):
+            issues.setdefault(_item_key(item, ''), item)
+        for item in validation.get('suggestions', []):
+            validation_suggestions.setdefault(_item_key(item, 'description'), item)
+
+    fully_implemented = {key for key, item in implemented.items() if item.get('status') == 'Fully Implemented'}
+    return {
+        'analysis': {
+            'implemented': list(implemented.values()),
+            'missing': [item for key, item in missing.items() if key not in fully_implemented],
+            'suggestions': list(suggestions.values())
+        },
+        'validation': {
+            'issues': list(issues.values()),
+            'suggestions': list(validation_suggestions.values())
+        }
+    }
+
+async def analyze_file_in_chunks(filepath: str, code: str, import_analysis: dict, plan_data: str, client,
+                                 rate_limiter, cache=None, cache_key=None, token_usage=None,
+                                 max_chunk_tokens: int = CHUNK_TOKENS, plan_sections: str = None,
+                                 stream: bool = STREAM_RESPONSES):
+    """Analyze a large file as parallel chunk requests and merge the results.
+
+    The caller holds one of `rate_limiter`'s slots, which runs chunks one after
+    another; every further chunk in flight takes a slot of its own, so a large
+    file never exceeds the adaptive concurrency limit. With `plan_sections`,
+    every chunk carries those sections instead of relying on `plan_data` in the
+    system prefix.
+    """
+    chunks = split_into_chunks(code, filepath, max_tokens=max_chunk_tokens)
+    logging.info(f"Analyzing {filepath} in {len(chunks)} chunks")
+
+    async def analyze_chunk(number: int, first_line: int, last_line: int, text: str):
+        description = f"{filepath} [chunk {number}/{len(chunks)}]"
+        try:
+            response = await send_analysis_request(
+                build_chunk_prompt(filepath, text, number, len(chunks), first_line, last_line, plan_sections),
+                plan_data, client, rate_limiter, description=description, token_usage=token_usage, stream=stream
+            )
+            return extract_json(response.content[0].text)
+        except (json.JSONDecodeError, ValueError) as e:
+            logging.error(f"Failed to parse JSON response for {description}: {str(e)}")
+            # Aborted streams were already recorded by send_analysis_request
+            if rate_limiter.metrics and not isinstance(e, SchemaViolation):
+                rate_limiter.metrics.parse_failure(description, str(e))
+            return None
+        except Exception as e:
+            logging.error(f"Error analyzing {description}: {str(e)}")
+            return None
+
+    pending = collections.deque(enumerate(chunks, start=1))
+    chunk_results = [None] * len(chunks)
+
+    async def lane():
+        while pending:
+            number, (first_line, last_line, text) = pending.popleft()
+            chunk_results[number - 1] = await analyze_chunk(number, first_line, last_line, text)
+
+    started = set()
+
+    async def extra_lane():
+        async with rate_limiter.slot():
+            started.add(asyncio.current_task())
+            await lane()
+
+    helpers = [asyncio.create_task(extra_lane()) for _ in range(len(chunks) - 1)]
+    try:
+        await lane()
+    except BaseException:
+        for helper in helpers:
+            helper.cancel()
+        raise
+    finally:
+        # Lanes still waiting for a slot have nothing left to send
+        for helper in helpers:
+            if helper not in started:
+                helper.cancel()
+        await asyncio.gather(*helpers, return_exceptions=True)
+    if not all(chunk_results):
+        # A partial merge would silently under-report the file, so fail it instead
+        logging.error(f"Failed to analyze {filepath}: "
+                      f"{sum(1 for r in chunk_results if not r)} of {len(chunks)} chunks failed")
+        return None
+
+    merged = merge_chunk_analyses(chunk_results)
+    merged['chunks'] = len(chunks)
+    return finalize_analysis(merged, filepath, import_analysis, cache, cache_key)
+
+def prepare_file(filepath: str, cache_suffix: str = None, plan_terms: bool = False) -> dict:
+    """Do the local work for one file: read, hash, extract imports and estimate tokens.
+
+    Runs in a worker process, so it only takes and returns picklable values. A
+    file that cannot be read comes back with an 'error' entry instead of 'code'.
+    With `plan_terms`, the query terms for plan section selection are included.
+    """
+    try:
+        with open(filepath, "r", encoding='utf-8') as f:
+            code = f.read()
+    except Exception as e:
+        logging.error(f"Error reading {filepath}: {str(e)}")
+        return {'filepath': filepath, 'error': str(e)}
+    return {
+        'filepath': filepath,
+        'code': code,
+        'tokens': estimate_tokens(code),
+        'cache_key': cache_key_for(code, cache_suffix) if cache_suffix else None,
+        'import_analysis': analyze_imports(filepath, content=code),
+        'plan_terms': plan_query_terms(filepath, code) if plan_terms else None
+    }
+
+def prepare_unit(filepaths: List[str], cache_suffix: str = None, plan_terms: bool = False) -> List[dict]:
+    """Prepare every file of a work unit in one worker round trip."""
+    return [prepare_file(filepath, cache_suffix, plan_terms) for filepath in filepaths]
+
+def create_prep_executor(workers: int = PREP_WORKERS):
+    """Process pool for local pre-analysis, or None to use the loop's default thread pool."""
+    if workers <= 0:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+async def analyze_file_with_claude(filepath: str, plan_data: str, client, rate_limiter, cache=None,
+                                   token_usage=None, prepared: dict = None, plan_index=None,
+                                   stream: bool = STREAM_RESPONSES):
+    """Analyze a file using Claude API and return structured analysis.
+
+    `prepared` is the file's prepare_file() output when the pipeline already
+    did the local work; otherwise it is done on a thread off the event loop.
+    With a `plan_index`, only the plan sections relevant to the file are sent.
+    """
+    try:
+        if prepared is None:
+            prepared = await asyncio.to_thread(prepare_file, filepath, cache.key_suffix if cache else None,
+                                               plan_index is not None)
+        if 'error' in prepared:
+            return None
+        code = prepared['code']
+        import_analysis = prepared['import_analysis']
+
+        # Reuse a stored analysis of identical content without calling the API
+        cache_key = prepared['cache_key'] if cache else None
+        if cache_key:
+            cached = await asyncio.to_thread(cache.get, cache_key)
+            if cached:
+                return finalize_analysis(cached, filepath, import_analysis)
+        
+        plan_sections = None
+        if plan_index:
+            plan_sections = plan_index.select(prepared['plan_terms'])
+            plan_data = None
+
+        # Files too large for one prompt or one response are analyzed in parts
+        if prepared['tokens'] > CHUNK_THRESHOLD_TOKENS:
+            return await analyze_file_in_chunks(filepath, code, import_analysis, plan_data, client, rate_limiter,
+                                                cache=cache, cache_key=cache_key, token_usage=token_usage,
+                                                plan_sections=plan_sections, stream=stream)
+
+        response = await send_analysis_request(
+            build_file_prompt(filepath, code, plan_sections), plan_data, client, rate_limiter,
+            description=filepath, token_usage=token_usage, stream=stream
+        )
+
+        try:
+            content = response.content[0].text
+            return finalize_analysis(extract_json(content), filepath, import_analysis, cache, cache_key)
+        except (json.JSONDecodeError, ValueError) as e:
+            if (getattr(response, 'stop_reason', None) == 'max_tokens'
+                    and prepared['tokens'] > 2 * MIN_CHUNK_TOKENS):
+                # Truncated output: retry as smaller parts rather than failing the file
+                logging.warning(f"Response for {filepath} hit max_tokens, retrying in chunks")
+                return await analyze_file_in_chunks(
+                    filepath, code, import_analysis, plan_data, client, rate_limiter, cache=cache,
+                    cache_key=cache_key, token_usage=token_usage,
+                    max_chunk_tokens=max(MIN_CHUNK_TOKENS, prepared['tokens'] // 2), plan_sections=plan_sections,
+                    stream=stream
+                )
+            logging.error(f"Failed to parse JSON response for {filepath}: {str(e)}")
             logging.debug(f"Raw response content: {content}")
+            if rate_limiter.metrics:
+                rate_limiter.metrics.parse_failure(filepath, str(e))
             return None
 
     except Exception as e:
         logging.error(f"Error analyzing {filepath}: {str(e)}")
         return None
 
-async def save_analysis_results(analyses, output_file):
-    """Save analysis results to file, creating a new file if it doesn't exist."""
+def estimate_file_tokens(filepath: str, default: int = 0) -> int:
+    """Token estimate from the file size on disk, without reading the file."""
+    try:
+        return os.path.getsize(filepath) // 4 + 1
+    except OSError:
+        return default
+
+def plan_work_units(files: List[str], pack_tokens: int = PACK_TOKEN_BUDGET,
+                    small_file_tokens: int = SMALL_FILE_TOKENS, max_files: int = PACK_MAX_FILES) -> List[List[int]]:
+    """Group indices of neighbouring small files into packed requests.
+
+    Sizes come from the file size on disk, so no file is read here. Files above
+    `small_file_tokens` always get their own request; a `pack_tokens` of 0
+    disables packing.
+    """
+    units = []
+    current = []
+    current_tokens = 0
+    for index, filepath in enumerate(files):
+        tokens = estimate_file_tokens(filepath, default=small_file_tokens + 1)
+        if not pack_tokens or tokens > small_file_tokens:
+            units.append([index])
+            continue
+        if current and (current_tokens + tokens > pack_tokens or len(current) >= max_files):
+            units.append(current)
+            current = []
+            current_tokens = 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        units.append(current)
+    return units
+
+def parse_duration(value: str) -> float:
+    """Parse a duration such as "900", "90s", "30m" or "2h" into seconds."""
+    scale = {'s': 1, 'm': 60, 'h': 3600}.get(value[-1:].lower())
+    try:
+        seconds = float(value[:-1] if scale else value) * (scale or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a duration such as 90s, 30m or 2h, got {value!r}")
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"Duration must be positive, got {value!r}")
+    return seconds
+
+def schedule_priority(filepath: str, root_dir: str = CODEBASE_ROOT) -> int:
+    """Index of the first SCHEDULE_PRIORITY pattern matching `filepath`, or len(SCHEDULE_PRIORITY)."""
+    rel_path = relative_path(filepath, root_dir)
+    return next((rank for rank, pattern in enumerate(SCHEDULE_PRIORITY) if fnmatch.fnmatchcase(rel_path, pattern)),
+                len(SCHEDULE_PRIORITY))
+
+def schedule_files(files: List[str], root_dir: str = CODEBASE_ROOT) -> List[str]:
+    """Order files for a limited run: priority paths first, then smallest first.
+
+    Small files first fit the most files into a budget and keep files of
+    similar size next to each other, which is what plan_work_units packs.
+    """
+    return sorted(files, key=lambda filepath: (schedule_priority(filepath, root_dir),
+                                               estimate_file_tokens(filepath), filepath))
+
+def request_history(trace_path: str = REQUEST_TRACE) -> dict:
+    """Median latency and output tokens per file of the successful requests in a previous run's trace."""
+    latencies = []
+    output_tokens = files = 0
     try:
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(analyses, f, indent=2, ensure_ascii=False)
+        with open(trace_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                if row.get('type') != 'request' or row.get('status') != 200:
+                    continue
+                latencies.append(row['latency'])
+                output_tokens += row.get('output_tokens', 0)
+                packed = re.search(r"\(\+(\d+) packed\)$", row.get('label', ''))
+                files += 1 + int(packed.group(1)) if packed else 1
+    except (OSError, TypeError, ValueError, KeyError):
+        pass
+    return {
+        'latency': percentile(latencies, 0.5) if latencies else ESTIMATED_LATENCY,
+        'output_tokens': output_tokens / files if files and output_tokens else ESTIMATED_OUTPUT_TOKENS,
+        'measured': bool(latencies)
+    }
+
+class CostEstimator:
+    """Projects the requests, tokens, cost and time of work units before they are sent.
+
+    Input tokens use the same four-characters-per-token approximation as rate
+    limiting, applied to the code plus the per-request prompt around it; the
+    system prefix is billed as a prompt cache read. Output tokens per file and
+    latency per request come from `history` (see request_history).
+    """
+    def __init__(self, plan_data: str, plan_top_k: int = PLAN_TOP_K, history: dict = None,
+                 model: str = MODEL_NAME):
+        self.history = history or request_history(None)
+        self.model = model
+        self.prefix_tokens = estimate_tokens(build_system_blocks(None if plan_top_k else plan_data)[-1]['text'])
+        self.prompt_tokens = estimate_tokens(build_file_prompt("", "")) + plan_top_k * PLAN_SECTION_TOKENS
+
+    def unit(self, file_tokens: List[int]) -> dict:
+        """Projected usage of one work unit, given the token estimate of each file it sends."""
+        tokens = sum(file_tokens)
+        if not file_tokens:
+            requests = 0
+        elif len(file_tokens) == 1 and tokens > CHUNK_THRESHOLD_TOKENS:
+            requests = math.ceil(tokens / CHUNK_TOKENS)
+        else:
+            requests = 1
+        output_tokens = self.history['output_tokens'] * max(len(file_tokens), requests)
+        if len(file_tokens) > 1:
+            output_tokens = min(output_tokens, PACK_MAX_OUTPUT_TOKENS)
+        usage = {
+            'requests': requests,
+            'input_tokens': tokens + self.prompt_tokens * requests,
+            'output_tokens': round(output_tokens),
+            'cache_creation_input_tokens': 0,
+            'cache_read_input_tokens': self.prefix_tokens * requests,
+            'seconds': self.history['latency'] * requests
+        }
+        usage['cost'] = self.cost(usage) or 0.0
+        return usage
+
+    def cost(self, totals: dict) -> float:
+        return usage_cost(self.model, totals)
+
+class RunBudget:
+    """Admits work units only while they fit within a cost and/or wall-time limit.
+
+    Spending is the token usage recorded so far plus the estimates of units
+    still in flight, so concurrent requests cannot jointly overshoot
+    `max_cost` by more than the estimates are off. A unit is refused when it
+    is not expected to finish within `deadline` seconds of the run's start.
+    """
+    def __init__(self, estimator: CostEstimator, token_usage, max_cost: float = None, deadline: float = None):
+        self.estimator = estimator
+        self.token_usage = token_usage
+        self.max_cost = max_cost
+        self.deadline = deadline
+        self.started = time.monotonic()
+        self.reserved = 0.0
+        self.skipped = 0
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() - self.started >= self.deadline
+
+    def spent(self) -> float:
+        return (self.estimator.cost(self.token_usage.totals) or 0.0) if self.token_usage else 0.0
+
+    def admit(self, estimate: dict) -> bool:
+        if self.deadline is not None and time.monotonic() - self.started + estimate['seconds'] > self.deadline:
+            return False
+        if self.max_cost is not None and self.spent() + self.reserved + estimate['cost'] > self.max_cost:
+            return False
+        self.reserved += estimate['cost']
+        return True
+
+    def release(self, estimate: dict):
+        self.reserved -= estimate['cost']
+
+def project_run(files: List[str], estimator: CostEstimator, pack_tokens: int = PACK_TOKEN_BUDGET,
+                concurrency: int = DEFAULT_CONCURRENCY, cached: Set[str] = frozenset(),
+                max_cost: float = None, deadline: float = None) -> dict:
+    """Projected totals for analyzing `files` in order, and the part that fits the limits.
+
+    Mirrors RunBudget: units are admitted in order while the running cost stays
+    within `max_cost` (units that do not fit are skipped) and the projected
+    wall time with `concurrency` requests in flight stays within `deadline`.
+    Files in `cached` cost nothing.
+    """
+    fields = ('files', 'requests', 'input_tokens', 'output_tokens', 'cache_creation_input_tokens',
+              'cache_read_input_tokens', 'seconds', 'cost')
+    total = dict.fromkeys(fields, 0)
+    admitted = dict.fromkeys(fields, 0)
+    by_priority = collections.defaultdict(lambda: dict.fromkeys(fields, 0))
+    for unit in plan_work_units(files, pack_tokens=pack_tokens):
+        usage = estimator.unit([estimate_file_tokens(files[index]) for index in unit
+                                if files[index] not in cached])
+        usage['files'] = len(unit)
+        for totals in (total, by_priority[min(schedule_priority(files[index]) for index in unit)]):
+            for field in fields:
+                totals[field] += usage[field]
+        within_cost = max_cost is None or admitted['cost'] + usage['cost'] <= max_cost
+        within_time = deadline is None or (admitted['seconds'] + usage['seconds']) / max(1, concurrency) <= deadline
+        if within_cost and within_time:
+            for field in fields:
+                admitted[field] += usage[field]
+    for totals in (total, admitted, *by_priority.values()):
+        totals['wall'] = totals['seconds'] / max(1, concurrency)
+    return {'total': total, 'admitted': admitted, 'by_priority': dict(by_priority)}
+
+def cached_files(files: List[str], cache) -> Set[str]:
+    """Files whose current contents already have a cached analysis."""
+    cached = set()
+    for filepath in files:
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                key = cache.key_for(f.read())
+        except (OSError, UnicodeDecodeError):
+            continue
+        if key in cache:
+            cached.add(filepath)
+    return cached
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+def print_projection(projection: dict, estimator: CostEstimator, concurrency: int, cached: int = 0,
+                     max_cost: float = None, deadline: float = None):
+    """Print the --dry-run projection of a run."""
+    def describe(totals: dict) -> str:
+        input_tokens = (totals['input_tokens'] + totals['cache_read_input_tokens']
+                        + totals['cache_creation_input_tokens'])
+        cost = f"${totals['cost']:.2f}" if estimator.cost(totals) is not None else "unknown cost"
+        return (f"{totals['files']} files in {totals['requests']} requests, {input_tokens:,} input / "
+                f"{totals['output_tokens']:,} output tokens, {cost}, ~{format_duration(totals['wall'])}")
+
+    history = estimator.history
+    print(f"\nDry run with {estimator.model} at concurrency {concurrency} "
+          f"({'last run' if history['measured'] else 'default'} p50 latency {history['latency']:.1f}s, "
+          f"{history['output_tokens']:.0f} output tokens per file):")
+    print(f"  Projected: {describe(projection['total'])}")
+    if cached:
+        print(f"  {cached} files have cached analyses and cost nothing")
+    labels = list(SCHEDULE_PRIORITY) + ["other files"]
+    for rank, totals in sorted(projection['by_priority'].items()):
+        print(f"    {labels[rank]:<16} {describe(totals)}")
+    if max_cost is not None or deadline is not None:
+        limits = [f"${max_cost:.2f}"] if max_cost is not None else []
+        limits += [format_duration(deadline)] if deadline is not None else []
+        print(f"  Within {' and '.join(limits)}: {describe(projection['admitted'])}")
+
+# Comments match outside the group, so findall returns them as empty strings
+_CODE_TOKENS = re.compile(r"""//[^\n]*|/\*[\s\S]*?\*/|#[^\n]*|"""
+                          r"""([a-z_$][\w$]*|\d[\w.]*|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|\S)""")
+_PATH_WORDS = re.compile(r"[a-z0-9]{3,}")
+
+def code_fingerprint(filepath: str, root_dir: str = CODEBASE_ROOT) -> tuple:
+    """(shingle count, bottom-k sketch) of a file's code, or None if it is too small or unreadable.
+
+    Shingles are hashed token 4-grams of the lowercased code without comments
+    or whitespace. Words of the file's own path are blanked first, so files
+    that differ only in the feature they are named after (BillingLayout vs
+    CasesLayout) compare equal.
+    """
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            text = f.read().lower()
+    except (OSError, UnicodeDecodeError):
+        return None
+    for word in set(_PATH_WORDS.findall(os.path.splitext(relative_path(filepath, root_dir))[0].lower())):
+        text = text.replace(word, "\0")
+    tokens = list(filter(None, _CODE_TOKENS.findall(text)))
+    if len(tokens) < DEDUP_MIN_TOKENS:
+        return None
+    shingles = set(map(hash, zip(tokens, tokens[1:], tokens[2:], tokens[3:])))
+    return len(shingles), array.array('q', sorted(shingles)[:DEDUP_SKETCH_SIZE])
+
+def sketch_similarity(first: array.array, second: array.array) -> float:
+    """Jaccard similarity estimated from two bottom-k sketches."""
+    first_set, second_set = set(first), set(second)
+    shared = first_set & second_set
+    size = max(len(first), len(second))
+    union = sorted(first_set | second_set)[:size]
+    return sum(1 for value in union if value in shared) / len(union)
+
+def group_near_duplicates(files: List[str], threshold: float = DEDUP_THRESHOLD,
+                          root_dir: str = CODEBASE_ROOT) -> Dict[str, List[tuple]]:
+    """Group files whose normalized code is nearly identical.
+
+    Only files with the same extension are compared. Candidates come from an
+    index of the few smallest hashes of each sketch and are confirmed against
+    `threshold` with the sketch estimate, so only the sketches are kept in
+    memory. Returns `{representative: [(member, similarity), ...]}` for groups
+    that have members; the first file of a group in `files` order represents it.
+    """
+    representatives = []  # (filepath, shingle count, sketch)
+    exact = {}  # (extension, shingle count, sketch) -> representative id
+    index = collections.defaultdict(list)  # (extension, hash) -> representative ids
+    groups = collections.defaultdict(list)
+    for filepath in files:
+        fingerprint = code_fingerprint(filepath, root_dir)
+        if fingerprint is None:
+            continue
+        count, sketch = fingerprint
+        extension = os.path.splitext(filepath)[1]
+        key = (extension, count, sketch.tobytes())
+        if key in exact:
+            groups[representatives[exact[key]][0]].append((filepath, 1.0))
+            continue
+
+        best, best_score = None, threshold
+        # The most recent groups per indexed hash, so a hash shared by many files stays cheap
+        per_hash = max(1, DEDUP_MAX_CANDIDATES // DEDUP_INDEXED_HASHES)
+        candidates = {candidate for value in sketch[:DEDUP_INDEXED_HASHES]
+                      for candidate in index.get((extension, value), ())[-per_hash:]}
+        for candidate in sorted(candidates):
+            _, other_count, other_sketch = representatives[candidate]
+            # Sets this different in size, or sketches sharing this little, cannot reach the threshold
+            if (min(count, other_count) < threshold * max(count, other_count)
+                    or len(set(sketch).intersection(other_sketch)) < threshold * max(len(sketch), len(other_sketch))):
+                continue
+            score = sketch_similarity(sketch, other_sketch)
+            if score >= best_score:
+                best, best_score = candidate, score
+        if best is not None:
+            groups[representatives[best][0]].append((filepath, best_score))
+            continue
+
+        exact[key] = len(representatives)
+        for value in sketch[:DEDUP_INDEXED_HASHES]:
+            index[(extension, value)].append(len(representatives))
+        representatives.append((filepath, count, sketch))
+    return dict(groups)
+
+def prepare_imports(filepaths: List[str]) -> List[dict]:
+    """Import analyses of `filepaths`; runs on the prep executor like prepare_unit."""
+    return [analyze_imports(filepath) for filepath in filepaths]
+
+def fan_out_analysis(result: dict, filepath: str, similarity: float, import_analysis: dict) -> dict:
+    """A representative's `result` reused for its near-duplicate `filepath`.
+
+    The member gets its own `import_analysis`, mentions of the representative's
+    path and file name are rewritten to the member's, and `duplicate_of` and
+    `similarity` record where the analysis came from.
+    """
+    source = result['filepath']
+    text = json.dumps({'analysis': result.get('analysis', {}), 'validation': result.get('validation', {})},
+                      ensure_ascii=False)
+    for old, new in ((source, filepath), (os.path.basename(source), os.path.basename(filepath))):
+        # Plain paths only, so the replacement cannot break the JSON escaping
+        if old != new and json.dumps(old)[1:-1] == old and json.dumps(new)[1:-1] == new:
+            text = text.replace(old, new)
+    return {**result, **json.loads(text), 'filepath': filepath, 'imports': import_analysis,
+            'duplicate_of': source, 'similarity': round(similarity, 3)}
+
+async def analyze_packed_files(filepaths: List[str], plan_data: str, client, rate_limiter, cache=None,
+                               token_usage=None, prepared: List[dict] = None, plan_index=None,
+                               stream: bool = STREAM_RESPONSES) -> List:
+    """Analyze several small files in one request and split the response per file.
+
+    Returns results aligned with `filepaths`. Files the response leaves out are
+    retried with their own request. `prepared` is the unit's prepare_unit()
+    output when the pipeline already did the local work. With a `plan_index`,
+    the request carries the union of the files' relevant plan sections.
+    """
+    if prepared is None:
+        prepared = await asyncio.to_thread(prepare_unit, filepaths, cache.key_suffix if cache else None,
+                                           plan_index is not None)
+    results = [None] * len(filepaths)
+    pending = []
+    for position, (filepath, item) in enumerate(zip(filepaths, prepared)):
+        if 'error' in item:
+            continue
+        cache_key = item['cache_key'] if cache else None
+        cached = await asyncio.to_thread(cache.get, cache_key) if cache_key else None
+        if cached:
+            results[position] = finalize_analysis(cached, filepath, item['import_analysis'])
+        else:
+            pending.append((position, filepath, item))
+
+    if len(pending) == 1:
+        position, filepath, item = pending[0]
+        results[position] = await analyze_file_with_claude(filepath, plan_data, client, rate_limiter,
+                                                           cache=cache, token_usage=token_usage, prepared=item,
+                                                           plan_index=plan_index, stream=stream)
+        return results
+    if not pending:
+        return results
+
+    label = f"{pending[0][1]} (+{len(pending) - 1} packed)"
+    plan_sections = plan_index.select(*(item['plan_terms'] for _, _, item in pending)) if plan_index else None
+    by_path = {}
+    try:
+        response = await send_analysis_request(
+            build_packed_prompt([(filepath, item['code']) for _, filepath, item in pending], plan_sections),
+            None if plan_index else plan_data, client, rate_limiter, max_tokens=PACK_MAX_OUTPUT_TOKENS,
+            description=label, token_usage=token_usage, stream=stream
+        )
+        entries = extract_json(response.content[0].text).get('files', [])
+        by_path = {entry.get('filepath'): entry for entry in entries if isinstance(entry, dict)}
+    except (json.JSONDecodeError, ValueError) as e:
+        logging.error(f"Failed to parse JSON response for packed request {label}: {str(e)}")
+        if rate_limiter.metrics and not isinstance(e, SchemaViolation):
+            rate_limiter.metrics.parse_failure(label, str(e))
+    except Exception as e:
+        logging.error(f"Error analyzing packed request {label}: {str(e)}")
+
+    for position, filepath, item in pending:
+        entry = by_path.get(filepath)
+        if entry and 'analysis' in entry:
+            results[position] = finalize_analysis(entry, filepath, item['import_analysis'], cache,
+                                                  item['cache_key'] if cache else None)
+        else:
+            logging.warning(f"{filepath} missing from packed response, analyzing it individually")
+            results[position] = await analyze_file_with_claude(filepath, plan_data, client, rate_limiter,
+                                                               cache=cache, token_usage=token_usage, prepared=item,
+                                                               plan_index=plan_index, stream=stream)
+    return results
+
+async def analyze_files_concurrently(files: List[str], plan_data: str, client, rate_limiter,
+                                     concurrency: int = DEFAULT_CONCURRENCY, on_complete=None,
+                                     cache=None, token_usage=None, pack_tokens: int = 0,
+                                     executor=None, prefetch: int = PREP_QUEUE_SIZE, plan_index=None,
+                                     stream: bool = STREAM_RESPONSES, budget: RunBudget = None,
+                                     keep_results: bool = True) -> List:
+    """Analyze files with a pool of workers pulling from a shared queue.
+
+    Results are returned in the same order as `files` (None for failures) so the
+    output stays deterministic regardless of completion order. `on_complete` is
+    awaited as `on_complete(index, filepath, result)` whenever a file finishes.
+    With `pack_tokens` set, small files are grouped into shared requests.
+
+    Local work (reading, hashing, import extraction) runs on `executor`, or the
+    default thread pool, and is queued at most `prefetch` units ahead of the
+    API workers so it overlaps with network waits without buffering the tree.
+    With a `plan_index`, requests carry only the relevant plan sections.
+
+    With a `budget`, a unit is only sent if it fits the remaining cost and time
+    limits; refused units are counted in `budget.skipped`, left as None and not
+    reported to `on_complete`, so they stay pending for a later run.
+
+    With `keep_results` off, results are only handed to `on_complete` and None
+    is returned, so a large run does not hold every analysis in memory.
+    """
+    loop = asyncio.get_running_loop()
+    cache_suffix = cache.key_suffix if cache else None
+    units = plan_work_units(files, pack_tokens=pack_tokens)
+    queue = asyncio.Queue(maxsize=max(1, prefetch))
+    results = [None] * len(files) if keep_results else None
+
+    # Enough workers for the rate controller to grow into; slot() enforces the live limit
+    worker_count = max(concurrency, getattr(rate_limiter, 'max_concurrency', concurrency))
+    worker_count = max(1, min(worker_count, len(units)))
+
+    async def producer():
+        for position, unit in enumerate(units):
+            if budget and budget.expired:
+                # Nothing prepared from here on could still be sent
+                budget.skipped += sum(len(unit) for unit in units[position:])
+                break
+            prepared = loop.run_in_executor(executor, prepare_unit, [files[index] for index in unit], cache_suffix,
+                                            plan_index is not None)
+            await queue.put((unit, prepared))
+        for _ in range(worker_count):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            unit, prepared = item
+            estimate = None
+            try:
+                prepared = await prepared
+                async with rate_limiter.slot():
+                    if budget:
+                        # Checked once a slot is free, so queueing time counts against the deadline
+                        estimate = budget.estimator.unit([entry['tokens'] for entry in prepared if 'error' not in entry
+                                                          and not (cache and entry['cache_key'] in cache)])
+                        if not budget.admit(estimate):
+                            budget.skipped += len(unit)
+                            estimate = None
+                            continue
+                    if len(unit) == 1:
+                        unit_results = [await analyze_file_with_claude(
+                            filepath=files[unit[0]],
+                            plan_data=plan_data,
+                            client=client,
+                            rate_limiter=rate_limiter,
+                            cache=cache,
+                            token_usage=token_usage,
+                            prepared=prepared[0],
+                            plan_index=plan_index,
+                            stream=stream
+                        )]
+                    else:
+                        unit_results = await analyze_packed_files(
+                            [files[index] for index in unit],
+                            plan_data=plan_data,
+                            client=client,
+                            rate_limiter=rate_limiter,
+                            cache=cache,
+                            token_usage=token_usage,
+                            prepared=prepared,
+                            plan_index=plan_index,
+                            stream=stream
+                        )
+                for index, result in zip(unit, unit_results):
+                    if keep_results:
+                        results[index] = result
+                    if on_complete:
+                        await on_complete(index, files[index], result)
+            finally:
+                if estimate:
+                    budget.release(estimate)
+                queue.task_done()
+
+    if not units:
+        return results
+    tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(worker_count)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return results
+
+def build_batch_requests(files: List[str], plan_data: str, cache=None,
+                         pack_tokens: int = PACK_TOKEN_BUDGET, executor=None, plan_index=None) -> tuple:
+    """Build Message Batch requests for every file that misses the cache.
+
+    Returns `(requests, entries, cached_results)`. `entries` maps each request's
+    custom_id to the files it covers and is persisted with the batch so results
+    can be matched up by a later invocation. Requests mirror the interactive
+    path: small files are packed and oversized files are chunked. Files are
+    prepared on `executor` when one is given. With a `plan_index`, each request
+    carries its relevant plan sections instead of the full plan.
+    """
+    system_blocks = build_system_blocks(None if plan_index else plan_data)
+    prepare = functools.partial(prepare_file, cache_suffix=cache.key_suffix if cache else None,
+                                plan_terms=plan_index is not None)
+    prepared = []
+    terms = {}
+    cached_results = []
+    for item in (executor.map(prepare, files, chunksize=16) if executor else map(prepare, files)):
+        if 'error' in item:
+            continue
+        filepath, code, cache_key = item['filepath'], item['code'], item['cache_key']
+        cached = cache.get(cache_key) if cache_key else None
+        if cached:
+            cached_results.append(finalize_analysis(cached, filepath, item['import_analysis']))
+        else:
+            prepared.append((filepath, code, cache_key))
+            terms[filepath] = item['plan_terms']
+
+    requests = []
+    entries = {}
+
+    def add_request(prompt: str, max_tokens: int, entry: dict):
+        custom_id = f"req-{len(requests)}"
+        requests.append({
+            "custom_id": custom_id,
+            "params": {
+                "model": MODEL_NAME,
+                "max_tokens": max_tokens,
+                "system": system_blocks,
+                "messages": [{"role": "user", "content": prompt}]
+            }
+        })
+        entries[custom_id] = entry
+
+    for unit in plan_work_units([filepath for filepath, _, _ in prepared], pack_tokens=pack_tokens):
+        items = [prepared[index] for index in unit]
+        plan_sections = plan_index.select(*(terms[filepath] for filepath, _, _ in items)) if plan_index else None
+        if len(items) > 1:
+            add_request(build_packed_prompt([(filepath, code) for filepath, code, _ in items], plan_sections),
+                        PACK_MAX_OUTPUT_TOKENS,
+                        {"kind": "pack", "files": [[filepath, key] for filepath, _, key in items]})
+            continue
+        filepath, code, cache_key = items[0]
+        if estimate_tokens(code) > CHUNK_THRESHOLD_TOKENS:
+            chunks = split_into_chunks(code, filepath)
+            for number, (first_line, last_line, text) in enumerate(chunks, start=1):
+                add_request(build_chunk_prompt(filepath, text, number, len(chunks), first_line, last_line,
+                                               plan_sections), 4096,
+                            {"kind": "chunk", "files": [[filepath, cache_key]], "chunk": number,
+                             "chunks": len(chunks)})
+        else:
+            add_request(build_file_prompt(filepath, code, plan_sections), 4096,
+                        {"kind": "file", "files": [[filepath, cache_key]]})
+
+    return requests, entries, cached_results
+
+async def submit_batch(client, requests: List[dict], entries: dict) -> dict:
+    """Create a Message Batch and return the job record kept in the progress file."""
+    message_batch = await client.messages.batches.create(requests=requests)
+    return {
+        'id': message_batch.id,
+        'submitted_at': datetime.now().isoformat(),
+        'requests': entries
+    }
+
+async def ingest_batch_results(client, batch_job: dict, store, cache=None, token_usage=None) -> tuple:
+    """Stream an ended batch's results into the results store.
+
+    Returns `(processed, failed)` sets of file paths.
+    """
+    entries = batch_job['requests']
+    processed = set()
+    failed = set()
+    chunk_parts = collections.defaultdict(dict)
+
+    async for item in await client.messages.batches.results(batch_job['id']):
+        entry = entries.get(item.custom_id)
+        if not entry:
+            continue
+        files = entry['files']
+        if item.result.type != 'succeeded':
+            logging.error(f"Batch request {item.custom_id} for {files[0][0]} {item.result.type}")
+            failed.update(filepath for filepath, _ in files)
+            continue
+
+        message = item.result.message
+        if token_usage:
+            token_usage.record(files[0][0], getattr(message, 'usage', None))
+        try:
+            parsed = extract_json(message.content[0].text)
+        except (ValueError, IndexError, AttributeError) as e:
+            logging.error(f"Failed to parse batch result {item.custom_id} for {files[0][0]}: {str(e)}")
+            failed.update(filepath for filepath, _ in files)
+            continue
+
+        if entry['kind'] == 'chunk':
+            chunk_parts[files[0][0]][entry['chunk']] = parsed
+            continue
+        by_path = ({result.get('filepath'): result for result in parsed.get('files', []) if isinstance(result, dict)}
+                   if entry['kind'] == 'pack' else {files[0][0]: parsed})
+        for filepath, cache_key in files:
+            result = by_path.get(filepath)
+            if result and 'analysis' in result:
+                store.append(finalize_analysis(result, filepath, analyze_imports(filepath), cache, cache_key))
+                processed.add(filepath)
+            else:
+                logging.error(f"{filepath} missing from batch result {item.custom_id}")
+                failed.add(filepath)
+
+    # Chunked files are only complete once every part came back
+    chunked = {entry['files'][0][0]: (entry['files'][0][1], entry['chunks'])
+               for entry in entries.values() if entry['kind'] == 'chunk'}
+    for filepath, (cache_key, total) in chunked.items():
+        parts = chunk_parts.get(filepath, {})
+        if len(parts) == total and filepath not in failed:
+            merged = merge_chunk_analyses([parts[number] for number in sorted(parts)])
+            merged['chunks'] = total
+            store.append(finalize_analysis(merged, filepath, analyze_imports(filepath), cache, cache_key))
+            processed.add(filepath)
+        else:
+            failed.add(filepath)
+
+    # Requests that produced no result line at all
+    covered = processed | failed
+    failed.update(filepath for entry in entries.values() for filepath, _ in entry['files']
+                  if filepath not in covered)
+    return processed, failed - processed
+
+async def resume_batch(client, batch_job: dict, store, cache=None, token_usage=None, wait: bool = False):
+    """Check a submitted batch and ingest it once it has ended.
+
+    Returns `(processed, failed)` when results were ingested, or None while the
+    batch is still processing.
+    """
+    while True:
+        message_batch = await client.messages.batches.retrieve(batch_job['id'])
+        counts = message_batch.request_counts
+        if message_batch.processing_status == 'ended':
+            break
+        print(f"Batch {batch_job['id']} is {message_batch.processing_status}: "
+              f"{counts.processing} processing, {counts.succeeded} succeeded, {counts.errored} errored")
+        if not wait:
+            return None
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+    print(f"Batch {batch_job['id']} ended: {counts.succeeded} succeeded, {counts.errored} errored, "
+          f"{counts.expired} expired, {counts.canceled} canceled")
+    return await ingest_batch_results(client, batch_job, store, cache=cache, token_usage=token_usage)
+
+def save_analysis_results(results_log, output_file):
+    """Compact the results log into the final analysis JSON file."""
+    try:
+        count = compact_results(results_log, output_file)
+        logging.info(f"Wrote {count} analyses to {output_file}")
     except Exception as e:
         logging.error(f"Error saving analysis results: {e}")
 
-def generate_directory_tree(root_dir: str) -> str:
+# Common descriptions for files and folders in the directory tree
+TREE_DESCRIPTIONS = {
+    # Folders
+    ".vscode": "Contains the file extensions.json.",
+    "analysis_output": "Contains the analysis output files.",
+    "public": "Static assets directory containing SVG files and other public resources.",
+    "src": "Source code directory containing all application code.",
+    "app": "Next.js App Router directory containing pages and API routes.",
+    "components": "Reusable React components directory.",
+    # Files
+    ".cursorrules": "Summary: Contains the UI/UX plan, app structure, file descriptions, and API routes.",
+    ".env": "Contains the ANTHROPIC_API_KEY necessary for authenticating with the specific API.",
+    ".env.local": "Contains environment variables including NEXT_PUBLIC_SUPABASE_URL and credentials.",
+    ".gitignore": "File containing rules for ignoring specific files and directories in the project repository.",
+    "app-structure.txt": "This file contains a listing of the folder path with various files and subdirectories.",
+    "codebase_analysis.py": "This file performs code analysis, including checking for validation issues and analyzing imports.",
+    "components.json": "Config file specifying UI schema, including Tailwind CSS configurations and aliases.",
+    "eslint.config.mjs": "Configures ESLint rules for the project based on Next.js and TypeScript conventions.",
+    "next-env.d.ts": "Type definitions for Next.js, including references to necessary global image types.",
+    "next.config.js": "Configuration settings for a Next.js project, enabling react strict mode and SWC minification.",
+    "package.json": "Defines project details, including scripts, dependencies, and devDependencies.",
+    "postcss.config.js": "Configuration file for PostCSS with plugins for Tailwind CSS and Autoprefixer.",
+    "postcss.config.mjs": "Configuration file for PostCSS, defining plugins including Tailwind CSS.",
+    "README.md": "README.md: Contains information about a Next.js project, including setup instructions.",
+}
+# Path components left out of the tree; matched against whole names only
+TREE_IGNORED_DIRS = {
+    '.git', 'node_modules', '.next', '__pycache__', '.vscode',
+    '.idea', 'dist', 'build', 'coverage', '.turbo',
+    '.vercel', '.cache', '.husky', '.github'
+}
+TREE_VISIBLE_DOTFILES = {'.env', '.env.local', '.cursorrules'}
+TREE_MAX_DEPTH = 0  # Directory levels expanded below the root; 0 expands all
+TREE_MAX_ENTRIES = 0  # Lines of tree output before it is truncated; 0 is unlimited
+
+def _tree_entries(path: str) -> List[tuple]:
+    """Visible (name, path, is_dir) children of a directory, directories first."""
+    entries = []
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                name = entry.name
+                if name in TREE_IGNORED_DIRS or (name.startswith('.') and name not in TREE_VISIBLE_DOTFILES):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((name, entry.path, is_dir))
+    except OSError as e:
+        logging.warning(f"Could not list {path}: {e}")
+    entries.sort(key=lambda item: (not item[2], item[0]))
+    return entries
+
+def iter_directory_tree(root_dir: str, max_depth: int = TREE_MAX_DEPTH, max_entries: int = TREE_MAX_ENTRIES):
+    """Yield the lines of the formatted directory tree with descriptions.
+
+    Walks iteratively with os.scandir, reusing each DirEntry's type, and only
+    holds the listings of the directories on the current path. Directories
+    below `max_depth` are shown but not expanded, and output stops after
+    `max_entries` lines; 0 disables either limit.
+    """
+    yield "Legal Buddy Web App"
+    root_dir = os.path.abspath(root_dir)
+    emitted = 0
+    # Each frame: [visible entries, index of the next one, prefix, depth of the entries]
+    stack = [[[(os.path.basename(root_dir), root_dir, os.path.isdir(root_dir))], 0, "", 0]]
+    while stack:
+        frame = stack[-1]
+        entries, index, prefix, depth = frame
+        if index == len(entries):
+            stack.pop()
+            continue
+        frame[1] += 1
+        if max_entries and emitted >= max_entries:
+            yield f"{prefix}└── … (truncated after {max_entries} entries)"
+            break
+        name, path, is_dir = entries[index]
+        is_last = index == len(entries) - 1
+        description = TREE_DESCRIPTIONS.get(name, "")
+        description_text = f" # {description}" if description else ""
+        yield f"{prefix}{'└── ' if is_last else '├── '}{'📁 ' if is_dir else '📄 '}{name}{description_text}"
+        emitted += 1
+        if is_dir and (not max_depth or depth < max_depth):
+            children = _tree_entries(path)
+            if children:
+                stack.append([children, 0, prefix + ("    " if is_last else "│   "), depth + 1])
+    yield ""
+    yield "Legend:"
+    yield "📁 Directory"
+    yield "📄 File"
+
+def generate_directory_tree(root_dir: str, max_depth: int = TREE_MAX_DEPTH, max_entries: int = TREE_MAX_ENTRIES) -> str:
     """Generate a formatted directory tree structure with descriptions."""
-    tree = ["Legal Buddy Web App"]
-    
-    # Common descriptions for files and folders
-    DESCRIPTIONS = {
-        # Folders
-        ".vscode": "Contains the file extensions.json.",
-        "analysis_output": "Contains the analysis output files.",
-        "public": "Static assets directory containing SVG files and other public resources.",
-        "src": "Source code directory containing all application code.",
-        "app": "Next.js App Router directory containing pages and API routes.",
-        "components": "Reusable React components directory.",
-        # Files
-        ".cursorrules": "Summary: Contains the UI/UX plan, app structure, file descriptions, and API routes.",
-        ".env": "Contains the ANTHROPIC_API_KEY necessary for authenticating with the specific API.",
-        ".env.local": "Contains environment variables including NEXT_PUBLIC_SUPABASE_URL and credentials.",
-        ".gitignore": "File containing rules for ignoring specific files and directories in the project repository.",
-        "app-structure.txt": "This file contains a listing of the folder path with various files and subdirectories.",
-        "codebase_analysis.py": "This file performs code analysis, including checking for validation issues and analyzing imports.",
-        "components.json": "Config file specifying UI schema, including Tailwind CSS configurations and aliases.",
-        "eslint.config.mjs": "Configures ESLint rules for the project based on Next.js and TypeScript conventions.",
-        "next-env.d.ts": "Type definitions for Next.js, including references to necessary global image types.",
-        "next.config.js": "Configuration settings for a Next.js project, enabling react strict mode and SWC minification.",
-        "package.json": "Defines project details, including scripts, dependencies, and devDependencies.",
-        "postcss.config.js": "Configuration file for PostCSS with plugins for Tailwind CSS and Autoprefixer.",
-        "postcss.config.mjs": "Configuration file for PostCSS, defining plugins including Tailwind CSS.",
-        "README.md": "README.md: Contains information about a Next.js project, including setup instructions.",
-    }
-    
-    IGNORED_DIRS = {
-        '.git', 'node_modules', '.next', '__pycache__', '.vscode',
-        '.idea', 'dist', 'build', 'coverage', '.turbo',
-        '.vercel', '.cache', '.husky', '.github'
-    }
-    
-    def add_to_tree(path: Path, prefix: str = "", is_last: bool = True):
-        """Recursively build tree structure with descriptions."""
-        if any(ignored in str(path) for ignored in IGNORED_DIRS):
-            return
+    return "\n".join(iter_directory_tree(root_dir, max_depth, max_entries))
+
+def write_app_structure(output_file: str, tree_output, dependency_summary: dict = None):
+    """Write app_structure.md with the directory tree and, once known, the dependencies.
+
+    `tree_output` is the tree as a string or an iterable of lines, which are
+    streamed to the file as they are produced.
+    """
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write("# Legal Buddy Web App Structure\n\n")
+        f.write("```\n")
+        if isinstance(tree_output, str):
+            f.write(tree_output)
+        else:
+            for number, line in enumerate(tree_output):
+                f.write(f"\n{line}" if number else line)
+        f.write("\n```\n")
+        if dependency_summary:
+            f.write("\n\n## Dependencies\n")
+            f.write("\n### NPM Packages Required\n")
+            for pkg in dependency_summary['npm_packages']:
+                f.write(f"- {pkg}\n")
             
-        if path.name.startswith('.') and path.name not in {'.env', '.env.local', '.cursorrules'}:
-            return
+            f.write("\n### Python Packages Required\n")
+            for pkg in dependency_summary['python_packages']:
+                f.write(f"- {pkg}\n")
             
-        icon = "📁 " if path.is_dir() else "📄 "
-        connector = "└── " if is_last else "├── "
-        
-        # Get description or use a default
-        description = DESCRIPTIONS.get(path.name, "")
-        description_text = f" # {description}" if description else ""
-        
-        # Add path to tree with description
-        tree.append(f"{prefix}{connector}{icon}{path.name}{description_text}")
-        
-        if path.is_dir():
-            items = sorted(list(path.iterdir()), key=lambda x: (not x.is_dir(), x.name))
-            for i, item in enumerate(items):
-                is_last_item = i == len(items) - 1
-                new_prefix = prefix + ("    " if is_last else "│   ")
-                add_to_tree(item, new_prefix, is_last_item)
-    
-    root = Path(root_dir)
-    add_to_tree(root)
-    
-    tree.extend([
-        "",
-        "Legend:",
-        "📁 Directory",
-        "📄 File"
-    ])
-    
-    return "\n".join(tree)
+            if dependency_summary['import_errors']:
+                f.write("\n### Import Issues\n")
+                for error in dependency_summary['import_errors']:
+                    f.write(f"- {error}\n")
+
+            if dependency_summary.get('import_cycles'):
+                f.write("\n### Import Cycles\n")
+                for cycle in dependency_summary['import_cycles']:
+                    f.write(f"- {' -> '.join(cycle)}\n")
+
+            if dependency_summary.get('unused_modules'):
+                f.write("\n### Unused Local Modules\n")
+                for rel_path in dependency_summary['unused_modules']:
+                    f.write(f"- {rel_path}\n")
+    os.replace(tmp_file, output_file)
+
+class FileWatcher:
+    """Detects changed code files by polling mtimes.
 
-async def main():
-    """Main execution function."""
+    Each poll only stats the known files and the directories that hold them;
+    the tree is rediscovered when a directory's mtime changes, i.e. when
+    entries were added, removed or replaced. The output directory is ignored
+    like any other excluded path, so a round's own writes do not trigger the next.
+    """
+    def __init__(self, root_dir: str, use_git: bool = True):
+        self.root_dir = root_dir
+        self.use_git = use_git
+        self.matcher = IgnoreMatcher.from_root(root_dir)
+        self.files = {}
+        self.dirs = {}
+        self.structure_changed = False
+        self._rescan()
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _watch_dir(self, directory: str):
+        """Track `directory` and its non-ignored subdirectories, so new folders are noticed."""
+        self.dirs[directory] = self._stat(directory)
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.is_dir(follow_symlinks=False) or entry.name in IGNORED_DIRS:
+                        continue
+                    rel_path = os.path.relpath(entry.path, self.root_dir).replace(os.sep, '/')
+                    if entry.path not in self.dirs and not self.matcher.ignored(rel_path, True):
+                        self.dirs[entry.path] = self._stat(entry.path)
+        except OSError:
+            pass
+
+    def _rescan(self, changed_dirs=()):
+        files = discover_files(self.root_dir, use_git=self.use_git)
+        self.files = {path: self._stat(path) for path in files}
+        for path in files:
+            directory = os.path.dirname(path)
+            while directory not in self.dirs and directory.startswith(self.root_dir):
+                self.dirs[directory] = self._stat(directory)
+                directory = os.path.dirname(directory)
+        for directory in [self.root_dir, *changed_dirs]:
+            self._watch_dir(directory)
+
+    def poll(self) -> tuple:
+        """Return `(modified, deleted)` path sets since the previous poll."""
+        changed_dirs = [directory for directory, stat in self.dirs.items() if self._stat(directory) != stat]
+        previous = self.files
+        if changed_dirs:
+            for directory in changed_dirs:
+                if self._stat(directory) is None:
+                    del self.dirs[directory]
+            self._rescan([directory for directory in changed_dirs if directory in self.dirs])
+        else:
+            self.files = {path: self._stat(path) for path in previous}
+
+        deleted = {path for path in previous if self.files.get(path) is None}
+        for path in deleted:
+            self.files.pop(path, None)
+        modified = {path for path, stat in self.files.items() if previous.get(path) != stat}
+        if deleted or modified - previous.keys():
+            self.structure_changed = True
+        return modified, deleted
+
+    async def changes(self, interval: float = WATCH_INTERVAL, debounce: float = WATCH_DEBOUNCE) -> tuple:
+        """Wait for changes and return them once no new change arrived for `debounce` seconds."""
+        modified = set()
+        deleted = set()
+        last_change = 0.0
+        while True:
+            await asyncio.sleep(min(interval, debounce) if modified or deleted else interval)
+            new_modified, new_deleted = await asyncio.to_thread(self.poll)
+            if new_modified or new_deleted:
+                modified = (modified - new_deleted) | new_modified
+                deleted = (deleted - new_modified) | new_deleted
+                last_change = time.monotonic()
+            elif (modified or deleted) and time.monotonic() - last_change >= debounce:
+                return sorted(modified), sorted(deleted)
+
+async def watch_for_changes(plan_data: str, client, rate_limiter, processed_files: Set[str], failed_files: Set[str],
+                            cache=None, concurrency: int = DEFAULT_CONCURRENCY, pack_tokens: int = 0,
+                            use_git: bool = True, commit: str = None, interval: float = WATCH_INTERVAL,
+                            debounce: float = WATCH_DEBOUNCE, plan_index=None, stream: bool = STREAM_RESPONSES,
+                            tree_depth: int = TREE_MAX_DEPTH, tree_entries: int = TREE_MAX_ENTRIES,
+                            import_graph: ImportGraph = None):
+    """Re-analyze files as they change until cancelled.
+
+    The client, plan, cache and file index stay warm between rounds. Each round
+    re-analyzes the changed files and the files importing them, then rewrites
+    app_structure.md and todo.md from the import graph and todo index kept in
+    memory.
+    """
+    structure_file = os.path.join(OUTPUT_DIR, "app_structure.md")
+    todo_file = os.path.join(OUTPUT_DIR, "todo.md")
+    watcher = FileWatcher(CODEBASE_ROOT, use_git=use_git)
+    tree_output = generate_directory_tree(CODEBASE_ROOT, tree_depth, tree_entries)
+    import_graph = import_graph or update_import_graph(set())
+    todo_index = TodoIndex(CODEBASE_ROOT)
+    for analysis in iter_results(RESULTS_LOG):
+        todo_index.add_analysis(analysis)
+
+    store = ResultStore(RESULTS_LOG)
+    token_usage = TokenUsage()
+    print(f"\nWatching {len(watcher.files)} files for changes (Ctrl+C to stop)...")
+    try:
+        while True:
+            modified, deleted = await watcher.changes(interval, debounce)
+            started = time.monotonic()
+            for filepath in deleted:
+                store.delete(filepath)
+                import_graph.remove(relative_path(filepath, CODEBASE_ROOT))
+                todo_index.remove_file(filepath)
+                processed_files.discard(filepath)
+                failed_files.discard(filepath)
+
+            # Files importing a changed file get their import analysis refreshed too
+            touched = {relative_path(path, CODEBASE_ROOT) for path in modified + deleted}
+            dependents = reverse_dependents(touched, import_graph)
+            files = sorted((set(modified) | dependents) & watcher.files.keys())
+            get_module_resolver(CODEBASE_ROOT, refresh=watcher.structure_changed)
+
+            results = await analyze_files_concurrently(
+                files, plan_data=plan_data, client=client, rate_limiter=rate_limiter, concurrency=concurrency,
+                cache=cache, token_usage=token_usage, pack_tokens=pack_tokens, plan_index=plan_index,
+                stream=stream
+            )
+            for filepath, result in zip(files, results):
+                if result:
+                    store.append(result)
+                    import_graph.update(relative_path(filepath, CODEBASE_ROOT), result.get('imports', {}))
+                    todo_index.add_analysis(result)
+                    processed_files.add(filepath)
+                    failed_files.discard(filepath)
+                else:
+                    failed_files.add(filepath)
+            store.sync()
+            save_progress(list(processed_files), list(failed_files), None, commit)
+
+            if watcher.structure_changed:
+                tree_output = generate_directory_tree(CODEBASE_ROOT, tree_depth, tree_entries)
+                watcher.structure_changed = False
+            import_graph.save(IMPORT_GRAPH)
+            write_app_structure(structure_file, tree_output, import_graph.dependency_summary())
+            write_todo(todo_file, todo_index)
+            todo_index.save(TODO_INDEX)
+
+            failed = sum(1 for result in results if not result)
+            print(f"[{datetime.now():%H:%M:%S}] Re-analyzed {len(files)} files ({failed} failed), "
+                  f"removed {len(deleted)} in {time.monotonic() - started:.1f}s")
+    finally:
+        store.close()
+        token_usage.close()
+        save_progress(list(processed_files), list(failed_files), None, commit)
+        save_analysis_results(RESULTS_LOG, OUTPUT_FILE)
+        print(f"Watch mode token usage: {token_usage.summary()}")
+
+def update_import_graph(updated_files: Set[str] = None, removed_files=(), graph: ImportGraph = None) -> ImportGraph:
+    """Bring IMPORT_GRAPH in line with the stored analyses, save it and return it.
+
+    With `updated_files`, only those files' analyses (and `removed_files`) are
+    applied to `graph` or the saved index; otherwise, or if there is no index
+    yet, it is rebuilt from every stored analysis.
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    if graph is None and updated_files is not None:
+        graph = ImportGraph.load(IMPORT_GRAPH)
+    if graph is None or updated_files is None:
+        graph = build_import_graph(iter_analyses(RESULTS_LOG, OUTPUT_FILE), CODEBASE_ROOT)
+    else:
+        for filepath in removed_files:
+            graph.remove(relative_path(filepath, CODEBASE_ROOT))
+        if updated_files:
+            for analysis in iter_results(RESULTS_LOG):
+                if analysis['filepath'] in updated_files:
+                    graph.update(relative_path(analysis['filepath'], CODEBASE_ROOT), analysis.get('imports', {}))
+    graph.save(IMPORT_GRAPH)
+    return graph
+
+def update_app_structure(tree_depth: int = TREE_MAX_DEPTH, tree_entries: int = TREE_MAX_ENTRIES,
+                         graph: ImportGraph = None) -> str:
+    """Rewrite app_structure.md from the directory tree and the import graph; return its path."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    tree_output_file = os.path.join(OUTPUT_DIR, "app_structure.md")
+    graph = graph or update_import_graph(set())
+    write_app_structure(tree_output_file, iter_directory_tree(CODEBASE_ROOT, tree_depth, tree_entries),
+                        graph.dependency_summary())
+    return tree_output_file
+
+def update_todo(updated_files: Set[str] = None, removed_files=()) -> str:
+    """Rewrite todo.md from the stored analyses; return its path.
+
+    With `updated_files`, only those files' analyses (and `removed_files`) are
+    applied to the saved TODO_INDEX; otherwise, or if there is no index yet,
+    every stored analysis is clustered again.
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    todo_file = os.path.join(OUTPUT_DIR, "todo.md")
+    index = None
+    if updated_files is not None:
+        changed = (analysis for analysis in iter_results(RESULTS_LOG) if analysis['filepath'] in updated_files)
+        index = update_todo_index(TODO_INDEX, changed, removed_files, CODEBASE_ROOT)
+    if index is None:
+        index = build_todo_index(iter_analyses(RESULTS_LOG, OUTPUT_FILE), CODEBASE_ROOT)
+    write_todo(todo_file, index)
+    index.save(TODO_INDEX)
+    return todo_file
+
+def scan_dependencies(use_git: bool = True) -> tuple:
+    """Bring the import graph in line with the working tree by local import analysis, without the API.
+
+    Only files whose mtime or size differ from the stamp saved in IMPORT_GRAPH
+    are analyzed again. When files were added or deleted, files with import
+    errors and files importing a deleted file are re-resolved too. Returns the
+    saved graph and the number of files analyzed.
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    graph = ImportGraph.load(IMPORT_GRAPH) or ImportGraph()
+    resolver = get_module_resolver(CODEBASE_ROOT, refresh=True)
+    files = {resolver.relpath(filepath): filepath for filepath in discover_files(CODEBASE_ROOT, use_git=use_git)}
+    deleted = graph.nodes.keys() - files.keys()
+    stale = set()
+    if deleted or not files.keys() <= graph.nodes.keys():
+        stale = {rel_path for rel_path, node in graph.nodes.items() if node['errors']}
+        stale |= {importer for rel_path in deleted for importer in graph.importers(rel_path)}
+    for rel_path in deleted:
+        graph.remove(rel_path)
+
+    analyzed = 0
+    for rel_path, filepath in files.items():
+        # Stamped before reading, so an edit made while analyzing is picked up next time
+        stamp = file_stamp(filepath)
+        if rel_path in stale or stamp is None or graph.stamp(rel_path) != stamp:
+            graph.update(rel_path, analyze_imports(filepath, resolver=resolver), stamp)
+            analyzed += 1
+    graph.save(IMPORT_GRAPH)
+    return graph, analyzed
+
+def merge_shards(shard_dir: str = SHARD_DIR) -> int:
+    """Combine --shard outputs into the main results, progress, app structure and todo list.
+
+    Shard logs are replayed into RESULTS_LOG oldest first, so when a file was
+    analyzed by more than one shard (e.g. after changing N) the newest result
+    wins. Returns the number of shards merged.
+    """
+    shard_logs = sorted(
+        (path for path in (os.path.join(shard_dir, name, os.path.basename(RESULTS_LOG))
+                           for name in (os.listdir(shard_dir) if os.path.isdir(shard_dir) else []))
+         if os.path.exists(path)),
+        key=os.path.getmtime
+    )
+    if not shard_logs:
+        print(f"No shard results found in {shard_dir}")
+        return 0
+
+    progress = load_progress()
+    processed_files = set(progress['processed_files'])
+    failed_files = set(progress['failed_files'])
+    commits = set()
+    migrate_json_to_log(OUTPUT_FILE, RESULTS_LOG)
+    with ResultStore(RESULTS_LOG) as store:
+        for shard_log in shard_logs:
+            records = append_log(shard_log, store)
+            shard_progress = load_progress(os.path.join(os.path.dirname(shard_log), os.path.basename(PROGRESS_FILE)))
+            shard_processed = set(shard_progress['processed_files'])
+            processed_files |= shard_processed
+            failed_files = (failed_files - shard_processed) | set(shard_progress['failed_files'])
+            commits.add(shard_progress.get('commit'))
+            print(f"Merged {records} records from {os.path.relpath(shard_log, shard_dir)}")
+
+    # The merged results only correspond to a commit every shard analyzed
+    commit = commits.pop() if len(commits) == 1 else None
+    if len(commits) > 1:
+        print("Shards were run at different commits; no analyzed commit recorded.")
+    save_progress(list(processed_files), list(failed_files), commit=commit)
+    save_analysis_results(RESULTS_LOG, OUTPUT_FILE)
+
+    tree_output_file = update_app_structure(graph=update_import_graph())
+    todo_file = update_todo()
+    print(f"\nMerged {len(shard_logs)} shards into {OUTPUT_FILE}; updated {tree_output_file} and {todo_file}")
+    return len(shard_logs)
+
+async def main(concurrency: int = DEFAULT_CONCURRENCY, use_cache: bool = True, use_git: bool = True,
+               max_concurrency: int = None, pack_tokens: int = PACK_TOKEN_BUDGET, batch: bool = False,
+               wait: bool = False, prep_workers: int = PREP_WORKERS, since: str = None,
+               changed: bool = False, watch: bool = False, watch_interval: float = WATCH_INTERVAL,
+               plan_top_k: int = PLAN_TOP_K, chrome_trace: str = None, stream: bool = STREAM_RESPONSES,
+               shard: tuple = None, tree_depth: int = TREE_MAX_DEPTH, tree_entries: int = TREE_MAX_ENTRIES,
+               dry_run: bool = False, max_cost: float = None, deadline: float = None, dedup: bool = DEDUP_FILES):
+    """Main execution function.
+
+    With `since` (a git ref) or `changed` (the commit recorded by the last
+    completed run), only files changed since then and the files importing
+    them are re-analyzed. With `watch`, the process then keeps running and
+    re-analyzes files as they change. `plan_top_k` plan sections are sent per
+    file, or the whole plan when it is 0. Per-request metrics go to
+    REQUEST_TRACE and, with `chrome_trace`, to a Chrome trace file.
+
+    With `shard` (i, N), only the files hashing to shard i are analyzed and
+    results and progress go to the shard's own directory; `merge_shards`
+    combines the shards afterwards.
+
+    With `max_cost` (USD) or `deadline` (seconds), files are scheduled by
+    SCHEDULE_PRIORITY and size, and work that would exceed either limit is
+    left for the next run. `dry_run` only prints the projected requests,
+    tokens, cost and wall time. With `dedup`, near-duplicate files (outside
+    --batch) reuse the analysis of one representative per group.
+    """
     # Initialize these at the start to avoid UnboundLocalError
     processed_files = set()
     failed_files = set()
-    analyses = []
+    store = None
+    token_usage = None
+    metrics = None
+    batch_job = None
+    analyzed_commit = None
+    import_graph = None
+    # Reverse dependencies span every shard, so they come from the merged results
+    merged_results_log = RESULTS_LOG
+    if shard:
+        use_shard_outputs(*shard)
     
     try:
-        # Load existing analyses if any
-        existing_analyses = []
-        if os.path.exists(OUTPUT_FILE):
-            try:
-                with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
-                    existing_analyses = json.load(f)
-            except json.JSONDecodeError:
-                logging.warning("Could not load existing analyses, starting fresh")
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
 
         # Generate and save the directory tree first
-        tree_output = generate_directory_tree(CODEBASE_ROOT)
         tree_output_file = os.path.join(OUTPUT_DIR, "app_structure.md")
         
-        print(f"\nGenerating App Structure...")
-        with open(tree_output_file, "w", encoding="utf-8") as f:
-            f.write("# Legal Buddy Web App Structure\n\n")
-            f.write("```\n")
-            f.write(tree_output)
-            f.write("\n```\n")
-        print(f"App structure saved to {tree_output_file}\n")
-
-        client = anthropic.AsyncAnthropic(api_key=API_KEY)
-        rate_limiter = RateLimit()
+        # Shards share OUTPUT_DIR, so the app structure is left to the merge
+        if not shard and not dry_run:
+            print(f"\nGenerating App Structure...")
+            write_app_structure(tree_output_file, iter_directory_tree(CODEBASE_ROOT, tree_depth, tree_entries))
+            print(f"App structure saved to {tree_output_file}\n")
 
         # Load progress and existing analyses
         progress_data = load_progress()
         processed_files = set(progress_data['processed_files'])
         failed_files = set(progress_data['failed_files'])
+        batch_job = progress_data.get('batch')
+        analyzed_commit = progress_data.get('commit')
+        head_commit = git_head(CODEBASE_ROOT)
         
-        # Load existing analyses if any
-        if os.path.exists(OUTPUT_FILE):
-            try:
-                with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
-                    analyses = json.load(f)
-            except json.JSONDecodeError:
-                analyses = []
+        # Seed the append-only results log from an older codebase_analysis.json
+        migrated = migrate_json_to_log(OUTPUT_FILE, RESULTS_LOG)
+        if migrated:
+            logging.info(f"Migrated {migrated} existing analyses into {RESULTS_LOG}")
+        store = ResultStore(RESULTS_LOG)
+        token_usage = TokenUsage(USAGE_LOG)
 
         # Load plan
         plan_data = load_plan(PLAN_FILE)
@@ -528,66 +3263,450 @@ async def main():
             print(f"Error loading plan. Exiting.")
             return
 
-        # Get code files
-        code_files = get_code_files(CODEBASE_ROOT)
-        print(f"Found {len(code_files)} files to analyze...")
+        plan_index = None
+        if plan_top_k > 0:
+            plan_index = PlanIndex(plan_data, top_k=plan_top_k)
+            logging.info(f"Indexed {len(plan_index.sections)} plan sections, sending the top {plan_top_k} per file")
+
+        cache = None
+        if use_cache:
+            # Responses depend on which plan sections were sent, so each mode keeps its own entries
+            cache = AnalysisCache(plan_data, prompt_version=f"{PROMPT_VERSION}-k{plan_top_k}" if plan_index
+                                  else PROMPT_VERSION)
+            if not dry_run:
+                cache.evict()
+
+        # Files whose todos change this run, so todo.md can be refreshed incrementally
+        updated_files = set()
+        removed_files = set()
+
+        if batch and batch_job:
+            # A previously submitted batch is resumed instead of submitting a new one
+            remaining_files = []
+        else:
+            since_ref = since or (analyzed_commit if changed else None)
+            if changed and not since_ref:
+                print("No analyzed commit recorded yet, analyzing every file.")
+            incremental = None
+            if since_ref:
+                import_graph = ImportGraph.load(IMPORT_GRAPH) or build_import_graph(
+                    iter_results(merged_results_log), CODEBASE_ROOT)
+                incremental = get_changed_files(CODEBASE_ROOT, since_ref, import_graph, use_git=use_git)
+                if incremental is None:
+                    print(f"Could not diff against {since_ref}. Exiting.")
+                    return
+
+            if incremental:
+                changed_files, dependent_files, deleted_files = incremental
+                for filepath in deleted_files:
+                    store.delete(filepath)
+                    removed_files.add(filepath)
+                    processed_files.discard(filepath)
+                    failed_files.discard(filepath)
+                # Earlier failures are retried along with the changed files
+                retry_files = {filepath for filepath in failed_files if os.path.isfile(filepath)}
+                remaining_files = sorted(set(changed_files) | set(dependent_files) | retry_files)
+                print(f"Since {since_ref[:12]}: {len(changed_files)} changed, {len(dependent_files)} dependent, "
+                      f"{len(deleted_files)} deleted; {len(remaining_files)} files to analyze...")
+            else:
+                # Get code files; with the cache enabled every file is re-checked by content
+                remaining_files = get_code_files(CODEBASE_ROOT, skip_processed=not use_cache, use_git=use_git)
+                print(f"Found {len(remaining_files)} files to analyze...")
+
+            if shard:
+                index, count = shard
+                remaining_files = [f for f in remaining_files if shard_of(f, count, CODEBASE_ROOT) == index - 1]
+                print(f"Shard {index}/{count}: {len(remaining_files)} files to analyze...")
+
+        # Near-duplicates of a representative are filled in when its analysis completes
+        duplicates = {}
+        if dedup and not batch and remaining_files:
+            start = time.perf_counter()
+            duplicates = group_near_duplicates(remaining_files, root_dir=CODEBASE_ROOT)
+            members = {member for group in duplicates.values() for member, _ in group}
+            if members:
+                remaining_files = [filepath for filepath in remaining_files if filepath not in members]
+                print(f"Near-duplicates: {len(members)} files will reuse the analysis of {len(duplicates)} "
+                      f"similar files (grouped in {time.perf_counter() - start:.2f}s)")
+
+        budget = None
+        if max_cost is not None or deadline is not None or dry_run:
+            # Read before this run's metrics overwrite the trace
+            estimator = CostEstimator(plan_data, plan_top_k, request_history(REQUEST_TRACE))
+            if max_cost is not None or deadline is not None:
+                remaining_files = schedule_files(remaining_files, CODEBASE_ROOT)
+                budget = RunBudget(estimator, token_usage, max_cost=max_cost, deadline=deadline)
+            if dry_run:
+                cached = cached_files(remaining_files, cache) if cache else set()
+                print_projection(project_run(remaining_files, estimator, pack_tokens=pack_tokens,
+                                             concurrency=concurrency, cached=cached, max_cost=max_cost,
+                                             deadline=deadline),
+                                 estimator, concurrency, cached=len(cached), max_cost=max_cost, deadline=deadline)
+                store.close()
+                token_usage.close()
+                return
+
+        # Heavy dependencies load only on the paths that call the API
+        import anthropic
+        from tqdm import tqdm
+
+        # Retries are handled by RateLimit so it can see every throttled response
+        client = anthropic.AsyncAnthropic(api_key=API_KEY, max_retries=0)
+        metrics = RequestMetrics(REQUEST_TRACE, model=MODEL_NAME)
+        rate_limiter = RateLimit(concurrent_limit=concurrency, max_concurrency=max_concurrency, metrics=metrics)
+
+        executor = create_prep_executor(prep_workers) if remaining_files else None
+
+        if batch:
+            if not batch_job and remaining_files:
+                with executor or contextlib.nullcontext():
+                    requests, entries, cached_results = build_batch_requests(
+                        remaining_files, plan_data, cache=cache, pack_tokens=pack_tokens, executor=executor,
+                        plan_index=plan_index
+                    )
+                for result in cached_results:
+                    store.append(result)
+                    processed_files.add(result['filepath'])
+                    failed_files.discard(result['filepath'])
+                if requests:
+                    batch_job = await submit_batch(client, requests, entries)
+                    save_progress(list(processed_files), list(failed_files), batch_job, analyzed_commit)
+                    print(f"Submitted message batch {batch_job['id']} with {len(requests)} requests")
+            if batch_job:
+                outcome = await resume_batch(client, batch_job, store, cache=cache,
+                                             token_usage=token_usage, wait=wait)
+                if outcome:
+                    batch_processed, batch_failed = outcome
+                    processed_files |= batch_processed
+                    failed_files = (failed_files - batch_processed) | batch_failed
+                    batch_job = None
+            remaining_files = []
+            # Batch results are not tracked per file, so todo.md is rebuilt in full
+            updated_files = None
 
         # Process files
-        remaining_files = [f for f in code_files if f not in processed_files]
-        
-        with tqdm(total=len(remaining_files), desc="Analyzing files") as pbar:
-            for filepath in remaining_files:
-                result = await analyze_file_with_claude(
-                    filepath=filepath,
-                    plan_data=plan_data,
-                    client=client,
-                    rate_limiter=rate_limiter
-                )
+        last_progress_save = time.monotonic()
+        # Findings per analyzed file, for comparing relevance-filtered and full-plan runs
+        findings = collections.Counter()
+
+        with tqdm(total=len(remaining_files), desc="Analyzing files") as pbar, \
+                executor or contextlib.nullcontext():
+            async def on_complete(index, filepath, result):
+                nonlocal last_progress_save
                 if result:
-                    analyses.append(result)
+                    # Append each result; the JSON file is only rebuilt at the end
+                    store.append(result)
+                    findings['files'] += 1
+                    for field in ('implemented', 'missing'):
+                        findings[field] += len(result.get('analysis', {}).get(field, []))
+                    findings['issues'] += len(result.get('validation', {}).get('issues', []))
+                    updated_files.add(filepath)
                     processed_files.add(filepath)
-                    # Save results after each successful analysis
-                    await save_analysis_results(analyses, OUTPUT_FILE)
+                    failed_files.discard(filepath)
+                    members = duplicates.get(filepath, ())
+                    # Members' imports are read on the prep executor, off the event loop
+                    member_imports = await asyncio.get_running_loop().run_in_executor(
+                        executor, prepare_imports, [member for member, _ in members]) if members else []
+                    for (member, similarity), import_analysis in zip(members, member_imports):
+                        store.append(fan_out_analysis(result, member, similarity, import_analysis))
+                        updated_files.add(member)
+                        processed_files.add(member)
+                        failed_files.discard(member)
                 else:
                     failed_files.add(filepath)
+                    failed_files.update(member for member, _ in duplicates.get(filepath, ()))
                 pbar.update(1)
-                
-                # Save progress after each file
-                save_progress(list(processed_files), list(failed_files))
+
+                # Save progress periodically rather than after every file
+                if time.monotonic() - last_progress_save >= PROGRESS_SAVE_INTERVAL:
+                    store.sync()
+                    save_progress(list(processed_files), list(failed_files), batch_job, analyzed_commit)
+                    last_progress_save = time.monotonic()
+
+            await analyze_files_concurrently(
+                remaining_files,
+                plan_data=plan_data,
+                client=client,
+                rate_limiter=rate_limiter,
+                concurrency=concurrency,
+                on_complete=on_complete,
+                cache=cache,
+                token_usage=token_usage,
+                pack_tokens=pack_tokens,
+                executor=executor,
+                plan_index=plan_index,
+                stream=stream,
+                budget=budget,
+                keep_results=False
+            )
+
+        store.close()
+        token_usage.close()
+        # Stored analyses now reflect the checked-out commit, unless a batch is pending or files were skipped
+        if not batch_job and head_commit and not (budget and budget.skipped):
+            analyzed_commit = head_commit
+        save_progress(list(processed_files), list(failed_files), batch_job, analyzed_commit)
+        save_analysis_results(RESULTS_LOG, OUTPUT_FILE)
 
         # Generate and append dependency summary to app structure
-        dependency_summary = generate_dependency_summary(analyses)
-        with open(tree_output_file, 'a', encoding='utf-8') as f:
-            f.write("\n\n## Dependencies\n")
-            f.write("\n### NPM Packages Required\n")
-            for pkg in dependency_summary['npm_packages']:
-                f.write(f"- {pkg}\n")
-            
-            f.write("\n### Python Packages Required\n")
-            for pkg in dependency_summary['python_packages']:
-                f.write(f"- {pkg}\n")
-            
-            if dependency_summary['import_errors']:
-                f.write("\n### Import Issues\n")
-                for error in dependency_summary['import_errors']:
-                    f.write(f"- {error}\n")
+        if not shard:
+            import_graph = update_import_graph(updated_files, removed_files, import_graph)
+            write_app_structure(tree_output_file, iter_directory_tree(CODEBASE_ROOT, tree_depth, tree_entries),
+                                import_graph.dependency_summary())
+            update_todo(updated_files, removed_files)
 
+        if budget and budget.skipped:
+            print(f"\n{budget.skipped} files did not fit the cost/time limits and are left for the next run "
+                  f"(estimated spend ${budget.spent():.2f} in {format_duration(time.monotonic() - budget.started)})")
+        if batch_job:
+            print(f"\nMessage batch {batch_job['id']} is still processing; re-run with --batch to collect it.")
+        if shard:
+            print(f"\nShard {shard[0]}/{shard[1]} done; run `python codebase_analysis.py merge` once all shards finish.")
         print(f"\nAnalysis complete. Results saved to {OUTPUT_FILE}")
         print(f"Total files processed: {len(processed_files)}")
         print(f"Failed analyses: {len(failed_files)}")
+        if analyzed_commit:
+            print(f"Analysis corresponds to commit {analyzed_commit[:12]}")
+        if cache:
+            lookups = cache.hits + cache.misses
+            print(f"Cache hits: {cache.hits}/{lookups} ({cache.hit_rate:.1%})")
+        print(f"Token usage: {token_usage.summary()}")
+        if plan_index:
+            print(f"Plan relevance: {plan_index.summary()}")
+        if findings['files']:
+            print(f"Findings per file ({f'top {plan_top_k} plan sections' if plan_index else 'full plan'}): "
+                  f"{findings['implemented'] / findings['files']:.1f} implemented, "
+                  f"{findings['missing'] / findings['files']:.1f} missing, "
+                  f"{findings['issues'] / findings['files']:.1f} issues")
+        print(f"Rate control: {rate_limiter.retries} retries ({rate_limiter.throttled} throttled), "
+              f"final concurrency {rate_limiter.concurrent_limit}")
+        print(f"\nPerformance report (trace in {REQUEST_TRACE}):\n{metrics.report()}")
+        if chrome_trace:
+            metrics.write_chrome_trace(chrome_trace)
+            print(f"Chrome trace written to {chrome_trace}")
+
+        if watch:
+            await watch_for_changes(plan_data, client, rate_limiter, processed_files, failed_files, cache=cache,
+                                    concurrency=concurrency, pack_tokens=pack_tokens, use_git=use_git,
+                                    commit=analyzed_commit, interval=watch_interval, plan_index=plan_index,
+                                    stream=stream, tree_depth=tree_depth, tree_entries=tree_entries,
+                                    import_graph=import_graph)
 
     except KeyboardInterrupt:
         print("\nAnalysis interrupted by user. Progress has been saved.")
-        save_progress(list(processed_files), list(failed_files))
+        save_progress(list(processed_files), list(failed_files), batch_job, analyzed_commit)
         # Save any completed analyses
-        if analyses:
-            await save_analysis_results(analyses, OUTPUT_FILE)
+        if token_usage:
+            token_usage.close()
+        if store:
+            store.close()
+            save_analysis_results(RESULTS_LOG, OUTPUT_FILE)
     except Exception as e:
         print(f"\nError: {str(e)}")
-        save_progress(list(processed_files), list(failed_files))
+        save_progress(list(processed_files), list(failed_files), batch_job, analyzed_commit)
         # Save any completed analyses
-        if analyses:
-            await save_analysis_results(analyses, OUTPUT_FILE)
+        if token_usage:
+            token_usage.close()
+        if store:
+            store.close()
+            save_analysis_results(RESULTS_LOG, OUTPUT_FILE)
+    finally:
+        if metrics:
+            metrics.close()
+
+def parse_args(argv=None):
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Analyze the codebase against the .cursorrules plan.")
+    parser.add_argument(
+        "command", nargs="?", choices=("analyze", "merge", "tree", "todo", "deps"), default="analyze",
+        help="analyze (default) runs the analysis; merge combines the outputs of --shard runs; "
+             "tree and todo rewrite app_structure.md and todo.md from stored results; "
+             "deps updates the import graph by local import analysis and prints the dependencies "
+             "or answers --importers/--impact/--unused/--cycles queries"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+        help=f"Initial number of files to analyze in parallel (default: {DEFAULT_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--max-concurrency", type=int, default=None,
+        help="Upper bound for adaptive concurrency (default: twice --concurrency)"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Disable the content-addressed response cache and skip files by path only"
+    )
+    parser.add_argument(
+        "--pack-tokens", type=int, default=PACK_TOKEN_BUDGET,
+        help=f"Token budget for packing small files into one request, 0 to disable (default: {PACK_TOKEN_BUDGET})"
+    )
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="Submit pending files as one Message Batch, or collect a previously submitted batch"
+    )
+    parser.add_argument(
+        "--wait", action="store_true",
+        help="With --batch, poll until the batch has ended and ingest its results"
+    )
+    parser.add_argument(
+        "--prep-workers", type=int, default=PREP_WORKERS,
+        help=f"Processes for reading and pre-analyzing files, 0 to use threads (default: {PREP_WORKERS})"
+    )
+    incremental = parser.add_mutually_exclusive_group()
+    incremental.add_argument(
+        "--since", metavar="REF",
+        help="Only re-analyze files changed since this git ref, plus the files that import them"
+    )
+    incremental.add_argument(
+        "--changed", action="store_true",
+        help="Like --since, using the commit recorded by the last completed run"
+    )
+    parser.add_argument(
+        "--plan-sections", type=int, default=PLAN_TOP_K, metavar="K",
+        help="Send only the K plan sections most relevant to each file instead of the whole "
+             "prompt-cached plan, e.g. 4 (default: whole plan)"
+    )
+    parser.add_argument(
+        "--no-stream", action="store_true",
+        help="Wait for complete responses instead of streaming and validating them as they arrive"
+    )
+    parser.add_argument(
+        "--no-dedup", action="store_true",
+        help="Analyze near-duplicate files separately instead of reusing one analysis per group"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Print the projected requests, tokens, cost and wall time without calling the API"
+    )
+    parser.add_argument(
+        "--max-cost", type=float, metavar="USD",
+        help="Stop sending requests before the estimated spend exceeds this many dollars; files under "
+             f"{', '.join(SCHEDULE_PRIORITY)} go first, then smaller files"
+    )
+    parser.add_argument(
+        "--deadline", type=parse_duration, metavar="DURATION",
+        help="Only start requests expected to finish within this time, e.g. 900, 15m or 1h; "
+             "prioritized like --max-cost"
+    )
+    parser.add_argument(
+        "--chrome-trace", metavar="PATH",
+        help="Also export per-request timings as a Chrome/Perfetto trace JSON file"
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="After the initial run, keep re-analyzing files as they change"
+    )
+    parser.add_argument(
+        "--watch-interval", type=float, default=WATCH_INTERVAL,
+        help=f"Seconds between change polls in --watch mode (default: {WATCH_INTERVAL})"
+    )
+    parser.add_argument(
+        "--shard", type=parse_shard, metavar="I/N",
+        help="Analyze only the I-th of N stable hash partitions of the files, writing to "
+             f"{SHARD_DIR}/I-of-N; combine the shards with the merge command"
+    )
+    parser.add_argument(
+        "--tree-depth", type=int, default=TREE_MAX_DEPTH,
+        help="Directory levels to expand in app_structure.md (default: all)"
+    )
+    parser.add_argument(
+        "--tree-entries", type=int, default=TREE_MAX_ENTRIES,
+        help="Truncate the app_structure.md tree after this many entries (default: no limit)"
+    )
+    parser.add_argument(
+        "--importers", metavar="PATH", action="append", default=[],
+        help="With deps, list the files importing PATH (repeatable)"
+    )
+    parser.add_argument(
+        "--impact", metavar="PATH", action="append", default=[],
+        help="With deps, list every file importing PATH directly or transitively (repeatable)"
+    )
+    parser.add_argument(
+        "--unused", action="store_true",
+        help="With deps, list local modules that nothing imports"
+    )
+    parser.add_argument(
+        "--cycles", action="store_true",
+        help="With deps, list import cycles"
+    )
+    parser.add_argument(
+        "--no-git", action="store_true",
+        help="Discover files by scanning the directory tree instead of using git ls-files "
+             "(nested .gitignore files are honoured either way)"
+    )
+    args = parser.parse_args(argv)
+    if args.shard and args.watch:
+        parser.error("--watch cannot be combined with --shard")
+    if args.batch and (args.dry_run or args.max_cost is not None or args.deadline is not None):
+        parser.error("--dry-run, --max-cost and --deadline cannot be combined with --batch")
+    return args
+
+def graph_path(path: str) -> str:
+    """Root-relative graph key for a path given relative to the working directory or the root."""
+    if not os.path.isabs(path) and not os.path.exists(path):
+        return posixpath.normpath(path.replace(os.sep, '/'))
+    return relative_path(os.path.abspath(path), CODEBASE_ROOT)
+
+def print_graph_queries(graph: ImportGraph, args):
+    """Print the answers to the deps query options."""
+    for path in args.importers:
+        importers = sorted(graph.importers(graph_path(path)))
+        print(f"\nFiles importing {graph_path(path)} ({len(importers)}):")
+        for importer in importers:
+            print(f"- {importer}")
+    for path in args.impact:
+        impacted = sorted(graph.impact([graph_path(path)]))
+        print(f"\nFiles affected by {graph_path(path)} ({len(impacted)}):")
+        for rel_path in impacted:
+            print(f"- {rel_path}")
+    if args.unused:
+        unused = graph.unused()
+        print(f"\nUnused local modules ({len(unused)}):")
+        for rel_path in unused:
+            print(f"- {rel_path}")
+    if args.cycles:
+        cycles = graph.cycles()
+        print(f"\nImport cycles ({len(cycles)}):")
+        for cycle in cycles:
+            print(f"- {' -> '.join(cycle)}")
+
+def run_cli(argv=None):
+    """Command-line entry point; only the analyze command loads the API client."""
+    args = parse_args(argv)
+    configure_runtime()
+    if args.command == "merge":
+        merge_shards()
+    elif args.command == "tree":
+        print(f"App structure saved to {update_app_structure(max(0, args.tree_depth), max(0, args.tree_entries))}")
+    elif args.command == "todo":
+        print(f"Todo list saved to {update_todo()}")
+    elif args.command == "deps":
+        start = time.perf_counter()
+        graph, analyzed = scan_dependencies(use_git=not args.no_git)
+        print(f"Import graph: {len(graph)} files, {analyzed} analyzed in {time.perf_counter() - start:.2f}s")
+        if args.importers or args.impact or args.unused or args.cycles:
+            print_graph_queries(graph, args)
+        else:
+            summary = graph.dependency_summary()
+            print(f"NPM packages ({len(summary['npm_packages'])}): {', '.join(summary['npm_packages'])}")
+            print(f"Python packages ({len(summary['python_packages'])}): {', '.join(summary['python_packages'])}")
+            print(f"Import errors ({len(summary['import_errors'])}):")
+            for error in summary['import_errors']:
+                print(f"- {error}")
+            print(f"Import cycles: {len(summary['import_cycles'])}, "
+                  f"unused local modules: {len(summary['unused_modules'])}")
+    else:
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(main(concurrency=max(1, args.concurrency), use_cache=not args.no_cache,
+                             use_git=not args.no_git, max_concurrency=args.max_concurrency,
+                             pack_tokens=max(0, args.pack_tokens), batch=args.batch, wait=args.wait,
+                             prep_workers=max(0, args.prep_workers), since=args.since, changed=args.changed,
+                             watch=args.watch, watch_interval=max(0.1, args.watch_interval),
+                             plan_top_k=max(0, args.plan_sections), chrome_trace=args.chrome_trace,
+                             stream=not args.no_stream, shard=args.shard,
+                             tree_depth=max(0, args.tree_depth), tree_entries=max(0, args.tree_entries),
+                             dry_run=args.dry_run, max_cost=args.max_cost, deadline=args.deadline,
+                             dedup=not args.no_dedup))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_cli()
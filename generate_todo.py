@@ -1,76 +1,291 @@
 import json
+import logging
 import os
+import re
+import zlib
+from collections import defaultdict
+from functools import lru_cache
+from analysis_store import iter_analyses
+
+PRIORITIES = ('High', 'Medium', 'Low')
+
+# Near-duplicate grouping of todo items
+SIMILARITY_THRESHOLD = 0.6  # Jaccard similarity of word shingles to merge two items
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # Bands of MINHASH_PERMUTATIONS // LSH_BANDS rows; candidates share at least one band
+MAX_LISTED_FILES = 8  # Files named in a grouped entry before "+N more"
+FILE_PLACEHOLDER = "<file>"
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [((index * 0x9E3779B97F4A7C15 + 1) % _MERSENNE_PRIME | 1,
+                  (index * 0xC2B2AE3D27D4EB4F + 7) % _MERSENNE_PRIME) for index in range(MINHASH_PERMUTATIONS)]
+_WORDS = re.compile(r"[a-z0-9]+|<file>")
+
+def todo_entries(file_analysis) -> list:
+    """(priority, text) for each todo of one file's analysis, without the file prefix."""
+    entries = []
+    for item in file_analysis['analysis'].get('missing', []):
+        priority = item['priority'] if item['priority'] in ('High', 'Medium') else 'Low'
+        entries.append((priority, f"{item['requirement']}: {item['details']}"))
+    for issue in file_analysis['validation'].get('issues', []):
+        entries.append(('Medium', f"Fix: {issue}"))
+    return entries
+
+@lru_cache(maxsize=4096)
+def _stem_pattern(stem: str):
+    return re.compile(rf"\b{re.escape(stem)}\b")
+
+def generic_text(text: str, filepath: str) -> str:
+    """`text` with mentions of the file's own name replaced, so per-file variants compare equal."""
+    name = os.path.basename(filepath)
+    stem = os.path.splitext(name)[0]
+    if stem not in text:
+        return text
+    text = text.replace(name, FILE_PLACEHOLDER)
+    # Stems repeat across a tree (page, route, index), so their patterns are cached
+    if len(stem) > 2 and stem in text:
+        text = _stem_pattern(stem).sub(FILE_PLACEHOLDER, text)
+    return text
+
+def shingles(text: str) -> frozenset:
+    """Words and word bigrams of `text`."""
+    words = _WORDS.findall(text.lower())
+    return frozenset(words) | {f"{first} {second}" for first, second in zip(words, words[1:])} or frozenset({""})
+
+def minhash(text_shingles: frozenset) -> tuple:
+    """MinHash signature of a shingle set."""
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in text_shingles]
+    return tuple(min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in _PERMUTATIONS)
+
+def jaccard(first: frozenset, second: frozenset) -> float:
+    return len(first & second) / len(first | second)
+
+class TodoIndex:
+    """Todo items grouped into clusters of near-duplicates across files.
+
+    Identical texts (after replacing the file's own name) share a cluster
+    directly; other texts are matched through MinHash LSH buckets and joined
+    when their exact shingle similarity reaches `threshold`. A cluster keeps
+    one representative text and one file's own wording, plus each file's
+    highest priority, so memory grows with the number of distinct items rather
+    than with the number of files. Files can be re-added or removed
+    individually, which lets todo.md be regenerated from only the analyses
+    that changed; clusters no file refers to any more are dropped.
+    """
+    def __init__(self, root_dir: str = None, threshold: float = SIMILARITY_THRESHOLD):
+        self.root_dir = root_dir
+        self.threshold = threshold
+        # Cluster id -> {'text', 'shingles', 'aliases', 'sample': [filepath, text], 'files': {filepath: priority}}
+        self.clusters = {}
+        self.next_id = 0
+        self.exact = {}  # Generic text -> cluster id
+        self.buckets = defaultdict(list)  # (band, band hash) -> cluster ids
+        self.by_file = defaultdict(set)  # filepath -> cluster ids
+
+    def _bands(self, signature: tuple):
+        rows = len(signature) // LSH_BANDS
+        for band in range(LSH_BANDS):
+            yield band, hash(signature[band * rows:(band + 1) * rows])
+
+    def _cluster_for(self, text: str) -> int:
+        cluster_id = self.exact.get(text)
+        if cluster_id is not None:
+            return cluster_id
+        text_shingles = shingles(text)
+        signature = minhash(text_shingles)
+        best, best_score = None, self.threshold
+        # LSH only proposes candidates; the exact similarity decides
+        candidates = {candidate for key in self._bands(signature) for candidate in self.buckets.get(key, ())}
+        for candidate in sorted(candidates):
+            score = jaccard(text_shingles, self.clusters[candidate]['shingles'])
+            if score >= best_score:
+                best, best_score = candidate, score
+        if best is None:
+            best = self.next_id
+            self.next_id += 1
+            self.clusters[best] = {'text': text, 'shingles': text_shingles, 'aliases': [], 'sample': None,
+                                   'files': {}}
+            for key in self._bands(signature):
+                self.buckets[key].append(best)
+        self.exact[text] = best
+        self.clusters[best]['aliases'].append(text)
+        return best
+
+    def _drop_cluster(self, cluster_id: int):
+        cluster = self.clusters.pop(cluster_id)
+        for text in cluster['aliases']:
+            del self.exact[text]
+        for key in self._bands(minhash(cluster['shingles'])):
+            self.buckets[key].remove(cluster_id)
+            if not self.buckets[key]:
+                del self.buckets[key]
+
+    def _add(self, cluster_id: int, filepath: str, priority: str):
+        files = self.clusters[cluster_id]['files']
+        current = files.get(filepath)
+        if current is None or PRIORITIES.index(priority) < PRIORITIES.index(current):
+            files[filepath] = priority
+        self.by_file[filepath].add(cluster_id)
+
+    def remove_file(self, filepath: str):
+        for cluster_id in self.by_file.pop(filepath, ()):
+            cluster = self.clusters[cluster_id]
+            del cluster['files'][filepath]
+            if not cluster['files']:
+                self._drop_cluster(cluster_id)
+            elif cluster['sample'] and cluster['sample'][0] == filepath:
+                cluster['sample'] = None
+
+    def add_analysis(self, file_analysis: dict):
+        """Add one file's todos, replacing any it had before."""
+        filepath = file_analysis['filepath']
+        self.remove_file(filepath)
+        for priority, text in todo_entries(file_analysis):
+            cluster_id = self._cluster_for(generic_text(text, filepath))
+            self._add(cluster_id, filepath, priority)
+            cluster = self.clusters[cluster_id]
+            if cluster['sample'] is None:
+                cluster['sample'] = [filepath, text]
+
+    def _display_path(self, filepath: str) -> str:
+        if self.root_dir and os.path.isabs(filepath):
+            return os.path.relpath(filepath, self.root_dir).replace(os.sep, '/')
+        return filepath
+
+    def entries(self, priority: str):
+        """Yield the todo lines of one priority; each cluster is listed under its highest priority."""
+        selected = []
+        rank = PRIORITIES.index(priority)
+        for cluster in self.clusters.values():
+            if min(map(PRIORITIES.index, cluster['files'].values())) == rank:
+                selected.append((min(cluster['files']), cluster))
+        # Sorted by first affected file so full and incremental rebuilds render alike
+        selected.sort(key=lambda pair: (pair[0], pair[1]['text']))
+        for first_file, cluster in selected:
+            files = sorted(cluster['files'])
+            if len(files) == 1:
+                # Near-duplicates within one file collapse to its first wording
+                sample_file, sample_text = cluster['sample'] or (None, None)
+                if sample_file != first_file:
+                    # The wording kept was another file's, which has since been removed
+                    sample_text = cluster['text'].replace(FILE_PLACEHOLDER, os.path.basename(first_file))
+                yield f"- [{os.path.basename(first_file)}] {sample_text}"
+                continue
+            listed = ", ".join(self._display_path(path) for path in files[:MAX_LISTED_FILES])
+            more = f" +{len(files) - MAX_LISTED_FILES} more" if len(files) > MAX_LISTED_FILES else ""
+            yield f"- {cluster['text']} ({len(files)} files: {listed}{more})"
+
+    def save(self, path: str):
+        """Write the clusters with their files' priorities as JSON lines, atomically."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for cluster in self.clusters.values():
+                record = {'text': cluster['text'], 'files': cluster['files']}
+                if cluster['sample']:
+                    record['sample'] = cluster['sample']
+                f.write(json.dumps(record, ensure_ascii=False))
+                f.write("\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, root_dir: str = None, threshold: float = SIMILARITY_THRESHOLD) -> "TodoIndex":
+        """Read an index written by save(); raises ValueError if it is not one."""
+        index = cls(root_dir, threshold)
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if not record['files']:
+                    continue
+                if not all(priority in PRIORITIES for priority in record['files'].values()):
+                    raise ValueError(f"Unexpected todo index record in {path}")
+                cluster_id = index._cluster_for(record['text'])
+                for filepath, priority in record['files'].items():
+                    index._add(cluster_id, filepath, priority)
+                cluster = index.clusters[cluster_id]
+                if cluster['sample'] is None and record.get('sample'):
+                    cluster['sample'] = record['sample']
+        return index
+
+def render_todo(index: TodoIndex):
+    """Yield todo.md line by line from a TodoIndex."""
+    headings = {'High': "## High Priority", 'Medium': "## Medium Priority", 'Low': "## Low Priority"}
+    yield "# Development Todo List\n"
+    for number, priority in enumerate(PRIORITIES):
+        if number:
+            yield ""
+        yield headings[priority]
+        yield from index.entries(priority)
+
+def write_todo(todo_file: str, index: TodoIndex):
+    """Write todo.md atomically so readers never see a partial list."""
+    tmp_file = f"{todo_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        for number, line in enumerate(render_todo(index)):
+            f.write(f"\n{line}" if number else line)
+    os.replace(tmp_file, todo_file)
+
+def build_todo_index(analyses, root_dir: str = None) -> TodoIndex:
+    """Cluster the todos of streamed analyses."""
+    index = TodoIndex(root_dir)
+    for file_analysis in analyses:
+        index.add_analysis(file_analysis)
+    return index
+
+def update_todo_index(index_file: str, changed_analyses, removed_files=(), root_dir: str = None) -> TodoIndex:
+    """Apply only changed and removed files to a saved index; returns None if there is none or it is unreadable."""
+    if not os.path.exists(index_file):
+        return None
+    try:
+        index = TodoIndex.load(index_file, root_dir)
+    except (ValueError, KeyError, AttributeError) as e:
+        # Rebuilt in full by the caller, e.g. after the index format changed
+        logging.warning(f"Ignoring unreadable todo index {index_file}: {e}")
+        return None
+    for filepath in removed_files:
+        index.remove_file(filepath)
+    for file_analysis in changed_analyses:
+        index.add_analysis(file_analysis)
+    return index
 
 def generate_todo_summary():
     """Generates a prioritized todo list from existing analysis results."""
     # Get current directory
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    
+
     # Define paths explicitly
     analysis_dir = os.path.join(current_dir, "analysis_output")
     analysis_file = os.path.join(analysis_dir, "codebase_analysis.json")
+    results_log = os.path.join(analysis_dir, "codebase_analysis.jsonl")
     todo_file = os.path.join(analysis_dir, "todo.md")
-    
+    index_file = os.path.join(analysis_dir, "todo_index.jsonl")
+
     # Check if analysis directory exists
     if not os.path.exists(analysis_dir):
         print(f"Analysis directory not found at: {analysis_dir}")
         return
-        
-    # Check if analysis file exists
-    if not os.path.exists(analysis_file):
+
+    # Check if analysis results exist
+    if not os.path.exists(results_log) and not os.path.exists(analysis_file):
         print(f"Analysis file not found at: {analysis_file}")
         return
-        
-    print(f"Reading analysis from: {analysis_file}")
-    
+
+    print(f"Reading analysis from: {results_log if os.path.exists(results_log) else analysis_file}")
+
     try:
-        with open(analysis_file, 'r', encoding='utf-8') as f:
-            analyses = json.load(f)
-        
-        todo_content = "# Development Todo List\n\n"
-        
-        # Track items by priority
-        high_priority = []
-        medium_priority = []
-        low_priority = []
-        
-        for file_analysis in analyses:
-            filepath = os.path.basename(file_analysis['filepath'])
-            
-            # Get missing requirements
-            for item in file_analysis['analysis'].get('missing', []):
-                todo_item = f"- [{filepath}] {item['requirement']}: {item['details']}"
-                if item['priority'] == 'High':
-                    high_priority.append(todo_item)
-                elif item['priority'] == 'Medium':
-                    medium_priority.append(todo_item)
-                else:
-                    low_priority.append(todo_item)
-            
-            # Get validation issues
-            for issue in file_analysis['validation'].get('issues', []):
-                todo_item = f"- [{filepath}] Fix: {issue}"
-                medium_priority.append(todo_item)
-        
-        # Write prioritized lists
-        todo_content += "## High Priority\n"
-        todo_content += "\n".join(high_priority) + "\n\n"
-        
-        todo_content += "## Medium Priority\n"
-        todo_content += "\n".join(medium_priority) + "\n\n"
-        
-        todo_content += "## Low Priority\n"
-        todo_content += "\n".join(low_priority)
-        
+        # Stream results so the whole analysis never has to be loaded at once
+        index = build_todo_index(iter_analyses(results_log, analysis_file), current_dir)
+
         # Save to file
         print(f"Writing todo list to: {todo_file}")
-        with open(todo_file, 'w', encoding='utf-8') as f:
-            f.write(todo_content)
-        
+        write_todo(todo_file, index)
+        index.save(index_file)
+
         print(f"\nTodo list successfully generated at: {todo_file}")
-        
+
     except Exception as e:
         print(f"Error generating todo list: {str(e)}")
 
 if __name__ == "__main__":
-    generate_todo_summary() 
\ No newline at end of file
+    generate_todo_summary()
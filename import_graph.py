@@ -0,0 +1,204 @@
+"""Persistent index of the project's local import graph.
+
+Each analyzed file is a node holding its `analyze_imports` output: the
+root-relative paths it imports, the npm and Python packages it needs and its
+import errors. A reverse adjacency map and package counters are kept alongside,
+so "who imports X", transitive impact sets, unused modules, cycles and the
+dependency summary are answered without rescanning the analyses, and a file can
+be replaced or removed on its own. The index is saved as one JSON line per file.
+"""
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+from fnmatch import fnmatchcase
+
+MODULE_EXTENSIONS = ('.js', '.jsx', '.ts', '.tsx', '.mjs', '.cjs', '.py')  # Files that can be imported
+# Next.js route files, config, tests and type declarations are loaded by tooling, not imported
+ENTRY_POINT_NAMES = ('page.*', 'layout.*', 'route.*', 'loading.*', 'error.*', 'global-error.*', 'not-found.*',
+                     'template.*', 'default.*', 'middleware.*', 'instrumentation.*', '*.config.*', '*.d.ts',
+                     '*.test.*', '*.spec.*', 'test_*.py', '__main__.py', 'conftest.py')
+ENTRY_POINT_DIRS = {'scripts', 'benchmarks', 'tests', '__tests__', 'supabase', 'prisma'}
+
+def file_stamp(filepath: str):
+    """(mtime_ns, size) of `filepath`, or None if it cannot be read."""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def is_entry_point(rel_path: str) -> bool:
+    """Whether a file is run or loaded by convention rather than imported (root files count too)."""
+    if '/' not in rel_path:
+        return True
+    parts = rel_path.split('/')
+    if ENTRY_POINT_DIRS.intersection(parts[:-1]):
+        return True
+    return any(fnmatchcase(parts[-1], pattern) for pattern in ENTRY_POINT_NAMES)
+
+class ImportGraph:
+    """Local import graph keyed by root-relative paths."""
+    def __init__(self):
+        self.nodes = {}  # rel path -> {'imports', 'npm', 'python', 'errors', 'stamp'}
+        self.importers_of = defaultdict(set)  # rel path -> rel paths importing it
+        self.npm = Counter()  # npm package -> files needing it
+        self.python = Counter()  # Python package -> files needing it
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, rel_path: str):
+        return rel_path in self.nodes
+
+    def update(self, rel_path: str, import_analysis: dict, stamp=None):
+        """Replace the imports of one file; `stamp` records which version of it was analyzed."""
+        self.remove(rel_path)
+        node = {
+            'imports': sorted(set(import_analysis.get('resolved_imports', []))),
+            'npm': sorted(set(import_analysis.get('npm_packages', []))),
+            'python': sorted(set(import_analysis.get('python_packages', []))),
+            'errors': list(import_analysis.get('import_errors', [])),
+            'stamp': stamp,
+        }
+        self._link(rel_path, node)
+
+    def _link(self, rel_path: str, node: dict):
+        self.nodes[rel_path] = node
+        for target in node['imports']:
+            self.importers_of[target].add(rel_path)
+        self.npm.update(node['npm'])
+        self.python.update(node['python'])
+
+    def remove(self, rel_path: str):
+        node = self.nodes.pop(rel_path, None)
+        if node is None:
+            return
+        for target in node['imports']:
+            importers = self.importers_of.get(target)
+            if importers is not None:
+                importers.discard(rel_path)
+                if not importers:
+                    del self.importers_of[target]
+        self.npm.subtract(node['npm'])
+        self.python.subtract(node['python'])
+        # Drop packages no file needs any more so the counters stay bounded
+        self.npm = +self.npm
+        self.python = +self.python
+
+    def stamp(self, rel_path: str):
+        node = self.nodes.get(rel_path)
+        return node['stamp'] if node else None
+
+    def importers(self, rel_path: str) -> set:
+        """Files importing `rel_path` directly."""
+        return set(self.importers_of.get(rel_path, ()))
+
+    def impact(self, rel_paths) -> set:
+        """Files importing any of `rel_paths` directly or transitively, excluding `rel_paths` themselves."""
+        start = set(rel_paths)
+        seen = set()
+        stack = list(start)
+        while stack:
+            for importer in self.importers_of.get(stack.pop(), ()):
+                if importer not in seen:
+                    seen.add(importer)
+                    stack.append(importer)
+        return seen - start
+
+    def unused(self) -> list:
+        """Local modules that no file imports and that are not entry points by convention."""
+        return sorted(rel_path for rel_path in self.nodes
+                      if rel_path.endswith(MODULE_EXTENSIONS) and not self.importers_of.get(rel_path)
+                      and not is_entry_point(rel_path))
+
+    def cycles(self) -> list:
+        """Import cycles as sorted lists of files (strongly connected components), largest first."""
+        # Iterative Tarjan, so deep import chains cannot hit the recursion limit
+        index_of, lowlink = {}, {}
+        on_stack, stack, components = set(), [], []
+        for root in self.nodes:
+            if root in index_of:
+                continue
+            work = [(root, iter(self.nodes[root]['imports']))]
+            index_of[root] = lowlink[root] = len(index_of)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, targets = work[-1]
+                for target in targets:
+                    if target not in self.nodes:
+                        continue
+                    if target not in index_of:
+                        index_of[target] = lowlink[target] = len(index_of)
+                        stack.append(target)
+                        on_stack.add(target)
+                        work.append((target, iter(self.nodes[target]['imports'])))
+                        break
+                    if target in on_stack:
+                        lowlink[node] = min(lowlink[node], index_of[target])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index_of[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in self.nodes[node]['imports']:
+                            components.append(sorted(component))
+        return sorted(components, key=lambda component: (-len(component), component))
+
+    def dependency_summary(self) -> dict:
+        """Packages, import errors, cycles and unused modules for app_structure.md."""
+        return {
+            'npm_packages': sorted(self.npm),
+            'python_packages': sorted(self.python),
+            'import_errors': sorted(f"{rel_path}: {error}" for rel_path, node in self.nodes.items()
+                                    for error in node['errors']),
+            'import_cycles': self.cycles(),
+            'unused_modules': self.unused(),
+        }
+
+    def save(self, path: str):
+        """Write one JSON line per file, atomically."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for rel_path, node in self.nodes.items():
+                f.write(json.dumps({'path': rel_path, **node}, ensure_ascii=False))
+                f.write("\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ImportGraph":
+        """The graph saved at `path`, or None if there is none or it cannot be read."""
+        if not os.path.exists(path):
+            return None
+        graph = cls()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        graph._link(record.pop('path'), record)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not load import graph {path}: {e}")
+            return None
+        return graph
+
+def build_import_graph(analyses, root_dir: str) -> ImportGraph:
+    """Import graph of streamed analyses, whose filepaths are made relative to `root_dir`."""
+    graph = ImportGraph()
+    for analysis in analyses:
+        graph.update(relative_path(analysis['filepath'], root_dir), analysis.get('imports', {}))
+    return graph
+
+def relative_path(filepath: str, root_dir: str) -> str:
+    if not os.path.isabs(filepath):
+        return filepath.replace(os.sep, '/')
+    return os.path.relpath(filepath, root_dir).replace(os.sep, '/')
@@ -0,0 +1,191 @@
+"""Per-request metrics for analysis runs.
+
+Every API request is written as one JSON line to a trace file as it finishes
+(queue wait, latency, time to first token, attempts, status and token usage), so a run can be
+inspected or compared afterwards. `report` summarizes the run from aggregates
+kept as requests finish, and `write_chrome_trace` exports the requests for
+chrome://tracing or Perfetto by reading the trace back.
+"""
+import array
+import heapq
+import json
+import math
+import os
+import time
+
+# USD per million tokens: input, output, cache write, cache read
+MODEL_PRICES = {
+    'claude-3-5-sonnet-20241022': (3.00, 15.00, 3.75, 0.30),
+    'claude-3-5-haiku-20241022': (0.80, 4.00, 1.00, 0.08),
+}
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+SLOWEST_COUNT = 5  # Requests listed in the report
+
+def usage_cost(model: str, totals: dict) -> float:
+    """Estimated USD cost of token `totals` at `model`'s list prices, or None if unknown."""
+    prices = MODEL_PRICES.get(model)
+    if not prices:
+        return None
+    return sum(totals.get(field, 0) * price for field, price in zip(USAGE_FIELDS, prices)) / 1_000_000
+
+def percentile(values, fraction: float) -> float:
+    """Nearest-rank percentile of `values`, or 0.0 when empty."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Rounded first so float error (0.95 * 100 == 95.00000000000001) cannot push the rank up by one
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[min(len(ordered) - 1, max(0, rank - 1))]
+
+class RequestMetrics:
+    """Collects one record per request and writes it to a JSONL trace.
+
+    Only the aggregates the report needs are kept in memory (totals, latency
+    samples and the slowest requests), so a long run does not hold every row;
+    rows are kept in memory only when there is no trace file to read back.
+    """
+    def __init__(self, trace_path: str = None, model: str = None):
+        self.model = model
+        self.started = time.monotonic()
+        self.trace_path = trace_path
+        self.records = None if trace_path else []
+        self.parse_failures = 0
+        self.requests = 0
+        self.succeeded = 0
+        self.retries = 0
+        self.totals = dict.fromkeys(USAGE_FIELDS, 0)  # Of succeeded requests
+        self.latencies = array.array('d')  # Of succeeded requests
+        self.queue_waits = array.array('d')
+        self.ttfts = array.array('d')
+        self.first_start = None
+        self.last_end = None
+        self.slowest = []  # Min-heap of (latency, -sequence, label) of the slowest succeeded requests
+        self.file = None
+        if trace_path:
+            os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+            self.file = open(trace_path, 'w', encoding='utf-8')
+
+    def _write(self, row: dict):
+        if self.records is not None:
+            self.records.append(row)
+        if self.file and not self.file.closed:
+            self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def record(self, label: str, started: float, queue_wait: float, latency: float, attempts: int,
+               status: int, usage=None, error: str = None, ttft: float = None):
+        """Record one finished request; times are time.monotonic() based seconds."""
+        row = {
+            'type': 'request',
+            'label': label,
+            'start': round(started - self.started, 6),
+            'queue_wait': round(queue_wait, 6),
+            'latency': round(latency, 6),
+            'ttft': round(ttft, 6) if ttft is not None else None,
+            'total': round(time.monotonic() - started, 6),
+            'attempts': attempts,
+            'status': status
+        }
+        for field in USAGE_FIELDS:
+            row[field] = getattr(usage, field, 0) or 0
+        if error:
+            row['error'] = error
+        self._write(row)
+
+        self.requests += 1
+        self.retries += attempts - 1
+        self.queue_waits.append(row['queue_wait'])
+        if row['ttft'] is not None:
+            self.ttfts.append(row['ttft'])
+        end = row['start'] + row['total']
+        self.first_start = row['start'] if self.first_start is None else min(self.first_start, row['start'])
+        self.last_end = end if self.last_end is None else max(self.last_end, end)
+        if status == 200:
+            self.succeeded += 1
+            self.latencies.append(row['latency'])
+            for field in USAGE_FIELDS:
+                self.totals[field] += row[field]
+            entry = (row['latency'], -self.requests, label)
+            if len(self.slowest) < SLOWEST_COUNT:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def parse_failure(self, label: str, reason: str = ""):
+        """Record a response that could not be parsed into an analysis."""
+        row = {'type': 'parse_failure', 'label': label, 'time': round(time.monotonic() - self.started, 6),
+               'reason': reason}
+        self.parse_failures += 1
+        self._write(row)
+
+    def rows(self):
+        """Yield the recorded rows, read back from the trace file when there is one."""
+        if self.records is not None:
+            yield from self.records
+            return
+        if self.file and not self.file.closed:
+            self.file.flush()
+        with open(self.trace_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def close(self):
+        if self.file and not self.file.closed:
+            self.file.close()
+
+    def cost(self, totals: dict) -> float:
+        """Estimated USD cost of `totals` at the model's list prices, or None if unknown."""
+        return usage_cost(self.model, totals)
+
+    def report(self) -> str:
+        """Multi-line summary: latency percentiles, throughput, tokens, cost and slowest requests."""
+        if not self.requests:
+            return "No API requests were made."
+        elapsed = max(self.last_end - self.first_start, 1e-9)
+        latencies = self.latencies
+        lines = [
+            f"Requests: {self.succeeded} succeeded, {self.requests - self.succeeded} failed, "
+            f"{self.retries} retries, {self.parse_failures} parse failures",
+            f"Latency: p50 {percentile(latencies, 0.5):.2f}s, p95 {percentile(latencies, 0.95):.2f}s, "
+            f"max {max(latencies, default=0.0):.2f}s; queue wait p95 "
+            f"{percentile(self.queue_waits, 0.95):.2f}s",
+            f"Throughput: {self.succeeded / elapsed:.2f} req/s, "
+            f"{self.totals['output_tokens'] / elapsed:.0f} output tokens/s over {elapsed:.1f}s"
+        ]
+        if self.ttfts:
+            lines.insert(2, f"Time to first token: p50 {percentile(self.ttfts, 0.5):.2f}s, "
+                            f"p95 {percentile(self.ttfts, 0.95):.2f}s")
+        cost = self.cost(self.totals)
+        if cost is not None:
+            lines.append(f"Estimated cost: ${cost:.4f}")
+        slowest = sorted(self.slowest, reverse=True)
+        if slowest:
+            lines.append("Slowest: " + ", ".join(f"{label} ({latency:.2f}s)" for latency, _, label in slowest))
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: str):
+        """Export requests in the Chrome trace event format, one lane per concurrent request."""
+        events = []
+        lanes = []  # End time of the last request placed in each lane
+        requests, parse_failures = [], []
+        for row in self.rows():
+            (parse_failures if row['type'] == 'parse_failure' else requests).append(row)
+        for row in sorted(requests, key=lambda row: row['start']):
+            end = row['start'] + row['total']
+            lane = next((number for number, busy_until in enumerate(lanes) if busy_until <= row['start']), None)
+            if lane is None:
+                lane = len(lanes)
+                lanes.append(end)
+            lanes[lane] = end
+            args = {field: row[field] for field in ('attempts', 'status', 'ttft', *USAGE_FIELDS)}
+            if row['queue_wait']:
+                events.append({'name': 'queue wait', 'cat': 'wait', 'ph': 'X', 'pid': 1, 'tid': lane,
+                               'ts': row['start'] * 1e6, 'dur': row['queue_wait'] * 1e6})
+            events.append({'name': row['label'], 'cat': 'request', 'ph': 'X', 'pid': 1, 'tid': lane,
+                           'ts': (end - row['latency']) * 1e6, 'dur': row['latency'] * 1e6, 'args': args})
+        for row in parse_failures:
+            events.append({'name': f"parse failure: {row['label']}", 'ph': 'i', 's': 'g', 'pid': 1, 'tid': 0,
+                           'ts': row['time'] * 1e6})
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
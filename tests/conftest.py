@@ -0,0 +1,58 @@
+"""Shared fixtures: a synthetic repository and the fake Messages API.
+
+Runs go through `main()` exactly like the command line, with the working
+directory set to the synthetic repository so analysis_output/ lands inside
+the analyzed tree, as it does for a real checkout.
+"""
+import asyncio
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+import codebase_analysis as ca  # noqa: E402
+from fake_anthropic_server import FakeAnthropicServer  # noqa: E402
+from synthetic_repo import generate_repo  # noqa: E402
+
+# Module globals a run may repoint (e.g. use_shard_outputs), restored after each test
+RUN_GLOBALS = ('CODEBASE_ROOT', 'PLAN_FILE', 'API_KEY', 'OUTPUT_FILE', 'RESULTS_LOG', 'PROGRESS_FILE',
+               'USAGE_LOG', 'REQUEST_TRACE')
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    server = FakeAnthropicServer(latency=0.0).start()
+    monkeypatch.setenv('ANTHROPIC_BASE_URL', server.base_url)
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'fake')
+    yield server
+    server.stop()
+
+def use_repo(monkeypatch, root: str, files: int = 10, lines: int = 10) -> str:
+    """Generate a synthetic repository at `root` and point the analyzer and working directory at it."""
+    generate_repo(root, files=files, lines=lines)
+    monkeypatch.chdir(root)
+    for name in RUN_GLOBALS:
+        monkeypatch.setattr(ca, name, getattr(ca, name))
+    monkeypatch.setattr(ca, 'CODEBASE_ROOT', root)
+    monkeypatch.setattr(ca, 'PLAN_FILE', os.path.join(root, '.cursorrules'))
+    monkeypatch.setattr(ca, 'API_KEY', 'fake')
+    return root
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A 10-file synthetic repository, also the working directory; returns its root."""
+    return use_repo(monkeypatch, str(tmp_path / 'repo'))
+
+def run_main(**kwargs) -> str:
+    """Run one analysis with local, thread-based prep and return what it printed."""
+    kwargs.setdefault('use_git', False)
+    kwargs.setdefault('prep_workers', 0)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+        asyncio.run(ca.main(**kwargs))
+    return output.getvalue()
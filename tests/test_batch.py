@@ -0,0 +1,69 @@
+import json
+import os
+
+import codebase_analysis as ca
+from conftest import run_main
+
+def _write_steps(path: str, count: int):
+    with open(path, 'w', encoding='utf-8') as f:
+        for number in range(count):
+            f.write(f"export function step{number}(value: number): number {{\n"
+                    f"  return value * {number} + {number % 7}; // step {number} of the pipeline\n}}\n\n")
+
+def test_submit_wait_and_ingest(repo, fake_api):
+    large = os.path.join(repo, 'src', 'lib', 'large.ts')
+    _write_steps(large, 3000)
+    # Too big to pack, small enough for one request
+    _write_steps(os.path.join(repo, 'src', 'lib', 'medium.ts'), 200)
+    fake_api.batch_delay = 3600
+
+    run_main(batch=True, use_cache=False, pack_tokens=2000)
+    job = ca.load_progress()['batch']
+    assert list(fake_api.batches) == [job['id']]
+    entries = job['requests']
+    assert len(entries) == len(fake_api.batches[job['id']]['requests'])
+    kinds = {entry['kind'] for entry in entries.values()}
+    assert kinds == {'file', 'pack', 'chunk'}
+
+    # Still in progress: the saved batch is checked, not submitted again
+    output = run_main(batch=True, use_cache=False, pack_tokens=2000)
+    assert "in_progress" in output
+    assert list(fake_api.batches) == [job['id']]
+    assert ca.load_progress()['batch'] == job
+    assert fake_api.stats['requests'] == 0
+
+    # One single-file request errors and one packed request expires; the rest succeed
+    errored = next(custom_id for custom_id, entry in entries.items() if entry['kind'] == 'file')
+    expired = next(custom_id for custom_id, entry in entries.items() if entry['kind'] == 'pack')
+    batch_results = fake_api.batch_results
+
+    def with_failures(batch_id):
+        lines = []
+        for line in batch_results(batch_id).decode('utf-8').splitlines():
+            item = json.loads(line)
+            if item['custom_id'] == errored:
+                item['result'] = {'type': 'errored', 'error': {
+                    'type': 'error', 'error': {'type': 'api_error', 'message': "Fake failure"}}}
+            elif item['custom_id'] == expired:
+                item['result'] = {'type': 'expired'}
+            lines.append(json.dumps(item))
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    fake_api.batch_results = with_failures
+    fake_api.batch_delay = 0
+    run_main(batch=True, use_cache=False, pack_tokens=2000)
+
+    progress = ca.load_progress()
+    assert 'batch' not in progress
+    failed = {filepath for custom_id in (errored, expired) for filepath, _ in entries[custom_id]['files']}
+    assert len(failed) > 1
+    assert set(progress['failed_files']) == failed
+    discovered = set(ca.discover_files(repo, use_git=False))
+    assert set(progress['processed_files']) == discovered - failed
+
+    with open(ca.OUTPUT_FILE, encoding='utf-8') as f:
+        analyses = {analysis['filepath']: analysis for analysis in json.load(f)}
+    assert analyses.keys() == discovered - failed
+    chunks = sum(1 for entry in entries.values() if entry['kind'] == 'chunk')
+    assert chunks > 1 and analyses[large]['chunks'] == chunks
+    assert len(fake_api.batches) == 1 and fake_api.stats['requests'] == 0
@@ -0,0 +1,21 @@
+import json
+import os
+
+import codebase_analysis as ca
+from conftest import run_main
+
+def test_chunks_stay_within_concurrency_limit(repo, fake_api):
+    fake_api.latency = 0.05
+    large = os.path.join(repo, 'src', 'lib', 'large.ts')
+    with open(large, 'w', encoding='utf-8') as f:
+        for number in range(3000):
+            f.write(f"export function step{number}(value: number): number {{\n"
+                    f"  return value * {number} + {number % 7}; // step {number} of the pipeline\n}}\n\n")
+    assert ca.estimate_file_tokens(large) > 4 * ca.CHUNK_TOKENS
+
+    run_main(concurrency=2, max_concurrency=2, pack_tokens=0, dedup=False, use_cache=False)
+
+    assert fake_api.stats['peak_in_flight'] <= 2
+    with open(ca.OUTPUT_FILE, encoding='utf-8') as f:
+        analyses = {analysis['filepath']: analysis for analysis in json.load(f)}
+    assert analyses[large]['chunks'] > 4
@@ -0,0 +1,50 @@
+import json
+import os
+import threading
+
+import codebase_analysis as ca
+from conftest import run_main
+
+COPY = """import {{ useState }} from 'react';
+import {{ formatInvoice }} from '@/lib/billing0';
+
+export default function {name}() {{
+  const [items, setItems] = useState([]);
+  const total = items.reduce((sum, item) => sum + item.amount * item.quantity, 0);
+  const overdue = items.filter((item) => item.dueDate < Date.now() && !item.paid);
+  return <section className="invoice-list">{{formatInvoice(total)}} {{overdue.length}} overdue</section>;
+}}
+"""
+
+def test_near_duplicates_share_one_request(repo, fake_api, monkeypatch):
+    copies = []
+    for name in ('InvoiceListA', 'InvoiceListB', 'InvoiceListC', 'InvoiceListD'):
+        path = os.path.join(repo, 'src', 'components', 'invoices', f'{name}.tsx')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(COPY.format(name=name))
+        copies.append(path)
+
+    analyze_imports = ca.analyze_imports
+    import_threads = {}
+
+    def recording(filepath, *args, **kwargs):
+        import_threads[filepath] = threading.current_thread()
+        return analyze_imports(filepath, *args, **kwargs)
+
+    monkeypatch.setattr(ca, 'analyze_imports', recording)
+    run_main(use_cache=False, pack_tokens=0)
+
+    with open(ca.OUTPUT_FILE, encoding='utf-8') as f:
+        analyses = {analysis['filepath']: analysis for analysis in json.load(f)}
+    assert set(ca.discover_files(repo, use_git=False)) == analyses.keys()
+    # Unpacked and unchunked, so every file that was not reused cost exactly one request
+    assert fake_api.stats['requests'] == sum(1 for analysis in analyses.values() if 'duplicate_of' not in analysis)
+
+    members = [path for path in copies if 'duplicate_of' in analyses[path]]
+    assert len(members) == len(copies) - 1
+    representative = analyses[members[0]]['duplicate_of']
+    assert representative in copies and all(analyses[path]['duplicate_of'] == representative for path in members)
+    for path in members:
+        assert analyses[path]['imports']['npm_packages'] == ['react']
+        assert import_threads[path] is not threading.main_thread()
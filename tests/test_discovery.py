@@ -0,0 +1,25 @@
+import os
+
+import codebase_analysis as ca
+from conftest import run_main
+
+def test_output_dir_is_not_discovered(repo):
+    cache_file = os.path.join(ca.CACHE_DIR, 'entry.json')
+    os.makedirs(os.path.dirname(cache_file))
+    with open(cache_file, 'w') as f:
+        f.write('{}')
+    files = ca.discover_files(repo, use_git=False)
+    assert files
+    assert not [path for path in files if os.sep + ca.OUTPUT_DIR + os.sep in path]
+
+def test_unchanged_second_run_is_all_cache_hits(repo, fake_api):
+    run_main()
+    requests = fake_api.stats['requests']
+    processed = len(ca.load_progress()['processed_files'])
+    assert requests > 0
+
+    output = run_main()
+    assert fake_api.stats['requests'] == requests
+    assert len(ca.load_progress()['processed_files']) == processed
+    hits = next(line for line in output.splitlines() if line.startswith("Cache hits:"))
+    assert "(100.0%)" in hits
@@ -0,0 +1,76 @@
+import os
+import subprocess
+
+import pytest
+
+import codebase_analysis as ca
+from codebase_analysis import IgnoreMatcher
+
+# Expected results agree with `git check-ignore --no-index` for the same .gitignore
+CASES = [
+    # (patterns, path, is_dir, ignored)
+    (['src/*.ts'], 'src/a.ts', False, True),
+    (['src/*.ts'], 'src/x/b.ts', False, False),
+    (['/build'], 'build', True, True),
+    (['/build'], 'lib/build', True, False),
+    (['build'], 'lib/build', True, True),
+    (['*.log'], 'deep/dir/x.log', False, True),
+    (['**/foo'], 'foo', False, True),
+    (['**/foo'], 'a/b/foo', False, True),
+    (['**/foo/bar'], 'foo/bar', False, True),
+    (['**/foo/bar'], 'x/foo/bar', False, True),
+    (['a/**/b'], 'a/b', False, True),
+    (['a/**/b'], 'a/x/y/b', False, True),
+    (['a/**/b'], 'a/xb', False, False),
+    (['a/**'], 'a/x/y.ts', False, True),
+    (['a/**'], 'b/a/x.ts', False, False),
+    (['x**y'], 'xaby', False, True),
+    (['x**y'], 'xa/by', False, False),
+    (['logs/'], 'logs', True, True),
+    (['logs/'], 'logs', False, False),
+    (['logs/'], 'src/logs', True, True),
+    (['*.ts', '!keep.ts'], 'keep.ts', False, False),
+    (['*.ts', '!keep.ts'], 'drop.ts', False, True),
+    (['!keep.ts', '*.ts'], 'keep.ts', False, True),
+    (['file?.py'], 'file1.py', False, True),
+    (['file?.py'], 'file10.py', False, False),
+    (['[!a]x.py'], 'bx.py', False, True),
+    (['[!a]x.py'], 'ax.py', False, False),
+    (['[a-c].py'], 'b.py', False, True),
+    (['[a-c].py'], 'd.py', False, False),
+    (['\\#notes'], '#notes', False, True),
+]
+
+@pytest.mark.parametrize("patterns, path, is_dir, ignored", CASES)
+def test_matches_gitignore_semantics(patterns, path, is_dir, ignored):
+    assert IgnoreMatcher(patterns).ignored(path, is_dir) is ignored
+
+TREE = {
+    '.gitignore': "*.gen.ts\nbuild/\n",
+    'app.ts': "", 'app.gen.ts': "",
+    'pkg/.gitignore': "!keep.gen.ts\n/local.ts\n",
+    'pkg/keep.gen.ts': "", 'pkg/drop.gen.ts': "", 'pkg/local.ts': "", 'pkg/build/out.ts': "",
+    'pkg/sub/local.ts': "",
+    'pkg/sub/.gitignore': "*.ts\n!kept.ts\n",
+    'pkg/sub/kept.ts': "", 'other/local.ts': "",
+}
+
+def test_nested_gitignores_in_scan_and_git_modes(tmp_path):
+    root = str(tmp_path)
+    for rel_path, content in TREE.items():
+        path = os.path.join(root, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+    expected = ['app.ts', 'other/local.ts', 'pkg/keep.gen.ts', 'pkg/sub/kept.ts']
+
+    def discovered(use_git):
+        return sorted(os.path.relpath(path, root).replace(os.sep, '/')
+                      for path in ca.discover_files(root, use_git=use_git))
+
+    assert discovered(use_git=False) == expected
+    subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+    assert discovered(use_git=True) == expected
+    # Tracked files are listed by git even when ignored; discovery still leaves them out
+    subprocess.run(['git', 'add', '-f', '.'], cwd=root, check=True)
+    assert discovered(use_git=True) == expected
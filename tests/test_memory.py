@@ -0,0 +1,41 @@
+import tracemalloc
+
+import codebase_analysis as ca
+from conftest import run_main, use_repo
+
+SIZES = (300, 900)  # Both past the prefetch queue, so in-flight work is the same size
+MAX_RETAINED_KB_PER_FILE = 1.5  # Paths and offsets only; holding the analyses costs ~4 KB/file
+MAX_PEAK_KB_PER_FILE = 4.0
+
+def _loop_memory(monkeypatch, root: str, files: int, analyze) -> tuple:
+    """(peak, retained) bytes traced during main()'s analysis loop over a fresh `files`-file repository."""
+    use_repo(monkeypatch, root, files=files, lines=5)
+    measured = {}
+
+    async def measuring(*args, **kwargs):
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        results = await analyze(*args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+        measured['memory'] = (peak - start, current - start)
+        return results
+
+    monkeypatch.setattr(ca, 'analyze_files_concurrently', measuring)
+    run_main(use_cache=False, concurrency=16)
+    return measured['memory']
+
+def test_run_loop_memory_is_flat_per_file(tmp_path, monkeypatch, fake_api):
+    # Lazy imports and first-use caches are paid before measuring
+    use_repo(monkeypatch, str(tmp_path / 'warmup'), files=10)
+    run_main(use_cache=False)
+
+    analyze = ca.analyze_files_concurrently
+    tracemalloc.start()
+    try:
+        (small_peak, small_kept), (large_peak, large_kept) = (
+            _loop_memory(monkeypatch, str(tmp_path / f'repo{files}'), files, analyze) for files in SIZES)
+    finally:
+        tracemalloc.stop()
+    added = SIZES[1] - SIZES[0]
+    assert (large_kept - small_kept) / added / 1024 < MAX_RETAINED_KB_PER_FILE
+    assert (large_peak - small_peak) / added / 1024 < MAX_PEAK_KB_PER_FILE
@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import codebase_analysis as ca
+from conftest import run_main
+
+WINDOW = 2.0  # Budget window of both the fake server and the limiter, so budgets refill within a test
+
+async def _send(fake_api, rate_limiter, count: int, workers: int = 1):
+    """Send `count` single-file requests through `rate_limiter` from `workers` concurrent workers."""
+    import anthropic
+    client = anthropic.AsyncAnthropic(base_url=fake_api.base_url, api_key='fake', max_retries=0)
+    pending = list(range(count))
+
+    async def worker():
+        while pending:
+            number = pending.pop()
+            async with rate_limiter.slot():
+                await ca.send_analysis_request(f"File: src/file{number}.ts\n\nexport default {number};", "plan",
+                                               client, rate_limiter, description=f"file{number}.ts", stream=False)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    finally:
+        await client.close()
+
+def test_throttle_halves_the_limit_and_success_grows_it_back(fake_api, monkeypatch):
+    monkeypatch.setattr(ca.RateLimit, 'BASE_BACKOFF', 0.01)
+    admit = fake_api._admit
+    admitted = []
+
+    def first_overloaded(tokens):
+        admitted.append(tokens)
+        return (529, {}) if len(admitted) == 1 else admit(tokens)
+
+    fake_api._admit = first_overloaded
+    rate_limiter = ca.RateLimit(concurrent_limit=8, max_concurrency=16)
+    asyncio.run(_send(fake_api, rate_limiter, 1))
+    assert rate_limiter.throttled == 1
+    # Halved by the 529, then one additive step from the retry that succeeded
+    assert rate_limiter.concurrency == 4 + 1 / 4
+
+    asyncio.run(_send(fake_api, rate_limiter, 30))
+    assert rate_limiter.concurrent_limit >= 8
+    assert fake_api.stats['ok'] == 31
+
+def test_exhausted_budget_pauses_all_workers(fake_api, monkeypatch):
+    monkeypatch.setattr(ca.RateLimit, 'WINDOW', WINDOW)
+    fake_api.rpm, fake_api.window = 4, WINDOW
+    rate_limiter = ca.RateLimit(concurrent_limit=4)
+    # Learn the budget first, as a run does from its first responses
+    asyncio.run(_send(fake_api, rate_limiter, 1))
+    assert rate_limiter.requests_per_minute == 4
+
+    start = time.monotonic()
+    asyncio.run(_send(fake_api, rate_limiter, 7, workers=4))
+    assert fake_api.stats['ok'] == 8
+    # Two full windows were needed, and the workers waited them out instead of hammering the server
+    assert time.monotonic() - start >= WINDOW
+    assert fake_api.stats['rate_limited'] <= 1
+
+def test_remaining_zero_and_retry_after_block_until_reset(fake_api, monkeypatch):
+    monkeypatch.setattr(ca.RateLimit, 'WINDOW', WINDOW)
+    fake_api.rpm, fake_api.window = 1, WINDOW
+    rate_limiter = ca.RateLimit(concurrent_limit=4)
+    asyncio.run(_send(fake_api, rate_limiter, 1))
+    # The only request of the window reported `requests-remaining: 0`
+    assert rate_limiter.blocked_until > time.monotonic() + WINDOW / 2
+
+    rate_limiter = ca.RateLimit(concurrent_limit=4)
+    start = time.monotonic()
+    asyncio.run(_send(fake_api, rate_limiter, 1))
+    # Rejected with retry-after while the window was full, then retried once it reset
+    assert rate_limiter.throttled == 1 and fake_api.stats['rate_limited'] == 1
+    assert time.monotonic() - start >= 1.0
+    assert fake_api.stats['ok'] == 2
+
+def test_every_file_completes_under_throttling(repo, fake_api, monkeypatch):
+    monkeypatch.setattr(ca.RateLimit, 'WINDOW', WINDOW)
+    monkeypatch.setattr(ca.RateLimit, 'BASE_BACKOFF', 0.05)
+    fake_api.rpm, fake_api.window, fake_api.error_rate = 6, WINDOW, 0.3
+    run_main(use_cache=False, pack_tokens=0, concurrency=4)
+
+    progress = ca.load_progress()
+    assert not progress['failed_files']
+    assert sorted(progress['processed_files']) == ca.discover_files(repo, use_git=False)
+    assert fake_api.stats['overloaded'] > 0
+    assert fake_api.stats['ok'] == len(progress['processed_files'])
@@ -0,0 +1,15 @@
+from request_metrics import percentile
+
+def test_percentile_is_nearest_rank():
+    hundred = list(range(1, 101))
+    assert percentile(hundred, 0.95) == 95
+    assert percentile(hundred, 0.5) == 50
+    assert percentile(hundred, 0.99) == 99
+    assert percentile(list(range(1, 21)), 0.95) == 19
+    assert percentile(list(range(1, 21)), 0.5) == 10
+
+def test_percentile_edges():
+    assert percentile([], 0.95) == 0.0
+    assert percentile([7.0], 0.5) == 7.0
+    assert percentile([3, 1, 2], 0.0) == 1
+    assert percentile([3, 1, 2], 1.0) == 3
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+import codebase_analysis as ca
+from conftest import REPO_DIR, run_main
+
+SHARD_RUN = ("import asyncio, sys; sys.path.insert(0, {repo_dir!r}); import codebase_analysis as ca; "
+             "ca.CODEBASE_ROOT = {root!r}; ca.PLAN_FILE = {plan!r}; ca.API_KEY = 'fake'; "
+             "asyncio.run(ca.main(shard=({index}, {count}), use_git=False, prep_workers=0))")
+
+def test_shards_merge_without_duplicates_or_gaps(repo, fake_api):
+    count = 2
+    shards = [subprocess.Popen([sys.executable, '-c', SHARD_RUN.format(
+        repo_dir=REPO_DIR, root=repo, plan=ca.PLAN_FILE, index=index, count=count)],
+        cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for index in range(1, count + 1)]
+    assert [shard.wait(timeout=300) for shard in shards] == [0] * count
+
+    shard_files = []
+    for index in range(1, count + 1):
+        progress = ca.load_progress(os.path.join(ca.shard_output_dir(index, count), 'analysis_progress.json'))
+        assert not progress['failed_files']
+        shard_files.append(set(progress['processed_files']))
+    assert not shard_files[0] & shard_files[1]
+
+    assert ca.merge_shards() == count
+    with open(ca.OUTPUT_FILE, encoding='utf-8') as f:
+        merged = [analysis['filepath'] for analysis in json.load(f)]
+    # Shard outputs live under the output directory and must not become code files themselves
+    discovered = ca.discover_files(repo, use_git=False)
+    assert sorted(merged) == discovered
+    assert set(ca.load_progress()['processed_files']) == set(discovered) == shard_files[0] | shard_files[1]
+
+    # A merged tree has nothing left to analyze
+    requests = fake_api.stats['requests']
+    run_main(use_cache=False)
+    assert fake_api.stats['requests'] == requests
@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import pytest
+
+import codebase_analysis as ca
+from codebase_analysis import SchemaViolation, StreamingJSONValidator
+from fake_anthropic_server import fake_analysis
+from request_metrics import RequestMetrics
+
+def validate(text: str, piece: int = 7) -> StreamingJSONValidator:
+    """Feed `text` in small pieces, as deltas arrive from the API."""
+    validator = StreamingJSONValidator()
+    for start in range(0, len(text), piece):
+        validator.feed(text[start:start + piece])
+    return validator
+
+def streamed_object(text: str):
+    validator = validate(text)
+    assert validator.done
+    return json.loads(text[validator.start:validator.end])
+
+def test_fenced_output():
+    analysis = fake_analysis('src/app/page.tsx')
+    text = f"Here is the analysis:\n```json\n{json.dumps(analysis, indent=2)}\n```\nLet me know if anything is unclear."
+    assert streamed_object(text) == analysis
+
+def test_prose_instead_of_json_is_rejected():
+    with pytest.raises(SchemaViolation):
+        validate("I could not analyze this file because " * 10)
+
+def test_packed_files_payload():
+    payload = {'files': [fake_analysis('src/a.ts'), fake_analysis('src/b.ts')]}
+    assert streamed_object(json.dumps(payload)) == payload
+    payload['files'][1]['analysis']['notes'] = "outside the schema"
+    with pytest.raises(SchemaViolation, match="notes"):
+        validate(json.dumps(payload))
+
+def test_escaped_strings_and_literals():
+    analysis = {
+        'filepath': 'src/"quoted"\\path}.ts',
+        'analysis': {
+            'implemented': [{'requirement': 'Braces { and ] in text', 'status': True, 'details': None}],
+            'missing': [{'requirement': 'Escapes \n\té \\"', 'priority': 'High', 'details': -1.5e3}],
+            'suggestions': [],
+        },
+        'validation': {'issues': ['a "quoted" issue', '\\'], 'suggestions': []},
+    }
+    text = json.dumps(analysis)
+    assert streamed_object(text) == analysis
+    assert streamed_object(json.dumps(analysis, ensure_ascii=False)) == analysis
+
+def test_literal_where_container_expected_is_rejected():
+    with pytest.raises(SchemaViolation, match="analysis"):
+        validate('{"filepath": "a.ts", "analysis": 5}')
+
+def test_empty_containers():
+    assert streamed_object("{}") == {}
+    empty = {'analysis': {'implemented': [], 'missing': [], 'suggestions': []},
+             'validation': {'issues': [], 'suggestions': []}}
+    assert streamed_object(json.dumps(empty)) == empty
+    assert streamed_object(json.dumps(empty, indent=2)) == empty
+
+def test_unbalanced_close_is_rejected():
+    with pytest.raises(SchemaViolation):
+        validate('{"analysis": {"implemented": [}')
+
+async def _request(fake_api, metrics):
+    import anthropic
+    client = anthropic.AsyncAnthropic(base_url=fake_api.base_url, api_key='fake', max_retries=0)
+    rate_limiter = ca.RateLimit(metrics=metrics)
+    try:
+        return await ca.send_analysis_request("File: src/app/page.tsx\n\nexport default 1;", "plan", client,
+                                              rate_limiter, description="page.tsx", stream=True)
+    finally:
+        await client.close()
+
+def test_aborted_stream_is_requested_again(fake_api):
+    message_response = fake_api.message_response
+    calls = []
+
+    def first_malformed(body, malformed=False):
+        calls.append(body)
+        return message_response(body, malformed=len(calls) == 1)
+
+    fake_api.message_response = first_malformed
+    metrics = RequestMetrics()
+    response = asyncio.run(_request(fake_api, metrics))
+
+    assert ca.extract_json(response.content[0].text)['filepath'] == 'src/app/page.tsx'
+    assert fake_api.stats['requests'] == 2
+    assert metrics.parse_failures == 1
+
+def test_repeated_schema_violations_give_up(fake_api):
+    fake_api.malformed_rate = 1.0
+    metrics = RequestMetrics()
+    with pytest.raises(SchemaViolation):
+        asyncio.run(_request(fake_api, metrics))
+    assert fake_api.stats['requests'] == ca.STREAM_SCHEMA_RETRIES + 1
+    assert metrics.parse_failures == ca.STREAM_SCHEMA_RETRIES + 1
@@ -0,0 +1,58 @@
+import json
+
+from fake_anthropic_server import fake_analysis
+from generate_todo import build_todo_index, render_todo, update_todo_index
+
+def analyses(count: int, start: int = 0) -> list:
+    return [fake_analysis(f"src/app/page{number}.tsx") for number in range(start, start + count)]
+
+def test_index_size_follows_distinct_items(tmp_path):
+    index_file = str(tmp_path / 'todo_index.jsonl')
+    index = build_todo_index(analyses(200))
+    index.save(index_file)
+    with open(index_file, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+
+    # The three per-file todos only differ by file name, so 200 files make three clusters
+    assert len(index.clusters) == len(records) == 3
+    for record in records:
+        assert len(record['files']) == 200
+        # Each file is kept as its priority alone, not as its own copy of the text
+        assert set(record['files'].values()) <= {'High', 'Medium', 'Low'}
+
+def test_removed_files_drop_their_clusters():
+    index = build_todo_index(analyses(3))
+    solo = fake_analysis('src/lib/solo.ts')
+    solo['analysis']['missing'].append({'requirement': "Cache invalidation", 'priority': 'Low',
+                                        'details': "Entries never expire when the upstream feed changes"})
+    index.add_analysis(solo)
+    assert len(index.clusters) == 4
+
+    index.remove_file(solo['filepath'])
+    assert len(index.clusters) == 3
+    assert not any('Cache invalidation' in text for text in index.exact)
+    for analysis in analyses(3):
+        index.remove_file(analysis['filepath'])
+    assert not index.clusters and not index.exact and not index.buckets
+
+def test_incremental_update_renders_like_a_full_rebuild(tmp_path):
+    index_file = str(tmp_path / 'todo_index.jsonl')
+    build_todo_index(analyses(6)).save(index_file)
+    changed = fake_analysis('src/app/page2.tsx')
+    changed['analysis']['missing'][1]['priority'] = 'High'
+    removed = [f"src/app/page{number}.tsx" for number in (0, 1, 3, 4, 5)]
+    updated = update_todo_index(index_file, [changed, *analyses(2, start=6)], removed_files=removed)
+    rebuilt = build_todo_index([changed, *analyses(2, start=6)])
+    assert list(render_todo(updated)) == list(render_todo(rebuilt))
+
+    # A file left alone in a cluster shows its own wording, even though the kept one was page0's
+    updated.remove_file('src/app/page6.tsx')
+    updated.remove_file('src/app/page7.tsx')
+    lines = list(render_todo(updated))
+    assert lines == list(render_todo(build_todo_index([changed])))
+    assert "- [page2.tsx] Add loading state: page2.tsx has no loading state" in lines
+
+def test_unreadable_index_is_rebuilt(tmp_path):
+    index_file = tmp_path / 'todo_index.jsonl'
+    index_file.write_text(json.dumps({'text': "Fix: x", 'files': {'a.ts': [['High', "Fix: x"]]}}) + "\n")
+    assert update_todo_index(str(index_file), analyses(1)) is None
@@ -0,0 +1,27 @@
+import asyncio
+import contextlib
+import io
+
+import codebase_analysis as ca
+
+async def _watch_one_edit(path: str, settle: float) -> str:
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+        task = asyncio.create_task(ca.main(use_git=False, prep_workers=0, watch=True, watch_interval=0.05))
+        while "Watching" not in output.getvalue():
+            assert not task.done(), output.getvalue()
+            await asyncio.sleep(0.05)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("\n// edited\n")
+        # Rounds rewrite progress, cache and results; none of that may look like a change
+        await asyncio.sleep(settle)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    return output.getvalue()
+
+def test_one_edit_is_one_round(repo, fake_api):
+    edited = sorted(path for path in ca.discover_files(repo, use_git=False) if path.endswith('.tsx'))[0]
+    output = asyncio.run(_watch_one_edit(edited, settle=ca.WATCH_DEBOUNCE + 2.0))
+    rounds = [line for line in output.splitlines() if "Re-analyzed" in line]
+    assert len(rounds) == 1, rounds